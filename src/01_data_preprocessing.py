@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import argparse
 import os
 from datetime import datetime
+from multiprocessing import Pool
 
 import numpy as np
 from netCDF4 import Dataset, date2num, num2date
 
+import heatwave_clusters_utils as hclib
+
 # ----------------------------------------
 # 用户需定义的路径和变量
 # ----------------------------------------
@@ -20,49 +24,129 @@ output_path = "./data/processed/heatwave_processed.nc"
 
 var_name = "t2m"  # NetCDF 中的温度变量名（单位为 Kelvin）
 percentile_level = 90
+# 阈值滑动窗口半宽（天，可用 --window-days 覆盖）：0 只用同一月日的样本；
+# 7 / 15 表示用前后各 7 / 15 天窗口内的全部样本计算百分位
+threshold_window_days = 0
+min_consecutive_days = 3  # 热浪最少连续天数
+lat_chunk_size = 32  # 连续天数筛选时每次处理的纬度行数（控制内存）
+
+# 阈值缓存：相同的气候基准文件、变量、百分位与窗口只计算一次阈值表（可用 --no-threshold-cache 关闭）
+threshold_cache_dir = "./data/processed/threshold_cache"
+threshold_cache_hash_content = (
+    False  # True 时按文件内容哈希识别基准文件，而非路径+修改时间
+)
+
+# 处理模式（可用命令行参数 --mode 覆盖）：
+# "full"   一次性读入全部温度数据
+# "stream" 按时间块流式读取、计算并写出，内存占用受 memory_budget_mb 限制
+# "parallel" 把网格按纬度带分给多个进程并行计算，由主进程写入同一个输出文件
+# "append" 只把温度文件中比输出文件更新的日期追加到输出文件末尾（业务化逐日更新）
+processing_mode = "full"
+memory_budget_mb = 2048  # 流式模式下单个时间块 / 并行模式下单个纬度带的内存预算（MB）
+n_workers = os.cpu_count()  # 并行模式的进程数（可用 --workers 覆盖）
+
+# 输出文件的分块与压缩（可用 --chunking / --complevel / --no-shuffle 覆盖）：
+# "map"        每块一天的完整地图，适合逐日读取的聚类阶段（默认）
+# "timeseries" 每块为一小片区域的全部时间步，适合读取格点时间序列的筛选验证脚本
+# "balanced"   每块约一个月 × 一片区域，兼顾两种读取方式
+output_chunking = "map"
+output_complevel = 4  # zlib 压缩级别 1-9
+output_shuffle = True  # 压缩前按字节重排，通常能提高浮点数据的压缩率
+
+# 流式模式下每个格点每个时间步的大致内存开销（字节）：
+# 温度（masked array）+ 阈值查表 + 二值掩码 + 游程计算中的 int32 临时数组
+BYTES_PER_CELL_STEP = 32
 
 
 # ----------------------------------------
 # 加载原始温度数据（ERA5）
 # ----------------------------------------
-def load_temperature(path):
+def open_temperature(path):
+    """
+    打开温度文件并读取坐标与时间轴，温度变量本身不读入内存，由调用者按需切片
+
+    Returns:
+        f: 打开的 Dataset（调用者负责关闭）
+        temp_var: 温度变量，shape: (time, lat, lon)
+        dates: hclib.decode_time_axis 解码的整数日期数组（year / month / day / doy）
+        lats, lons: 坐标
+    """
     f = Dataset(path)
-    temp = f.variables[var_name][:]  # shape: (time, lat, lon)
     # 已经转换过单位，不需要再转换
     # temp = temp - 273.15  # 转为摄氏度
-    time = f.variables["time"]
     lons = f.variables["lon"][:]
     lats = f.variables["lat"][:]
-    time_units = time.units
-    time_calendar = time.calendar if hasattr(time, "calendar") else "standard"
-    dates = num2date(time[:], units=time_units, calendar=time_calendar)
-    f.close()
-    return temp, dates, lats, lons
+    dates = hclib.read_time_axis(f.variables["time"])
+    return f, f.variables[var_name], dates, lats, lons
 
 
-T_actual, dates_actual, lats, lons = load_temperature(temp_path)
-T_clim, dates_clim, _, _ = load_temperature(clim_path)
-
-# ----------------------------------------
-# 计算气候基准期每年同日的第 90 百分位（动态阈值）
-# ----------------------------------------
-T_threshold = np.full_like(T_actual, np.nan)
+def load_temperature(path):
+    f, temp_var, dates, lats, lons = open_temperature(path)
+    temp = hclib.read_variable(temp_var)  # shape: (time, lat, lon)，缺测为 NaN
+    f.close()
+    return temp, dates, lats, lons
 
-for day_index, target_date in enumerate(dates_actual):
-    clim_days = [
-        i
-        for i, d in enumerate(dates_clim)
-        if d.month == target_date.month and d.day == target_date.day
-    ]
-    if not clim_days:
-        continue
-    clim_samples = T_clim[clim_days, :, :]  # shape: (N_years, lat, lon)
-    T_threshold[day_index, :, :] = np.percentile(clim_samples, percentile_level, axis=0)
 
 # ----------------------------------------
-# 生成二值热浪掩码矩阵（实际温度超过动态阈值）
+# 计算气候基准期每个日历日的第 90 百分位（动态阈值表）
 # ----------------------------------------
-heatwave_mask = (T_actual > T_threshold).astype(np.uint8)
+def threshold_cache_key(doy_actual, window_days):
+    return hclib.threshold_cache_key(
+        clim_path,
+        var_name,
+        percentile_level,
+        window_days,
+        doy_actual,
+        hash_content=threshold_cache_hash_content,
+    )
+
+
+def load_cached_threshold_table(doy_actual, window_days, use_cache):
+    """
+    从阈值缓存读取阈值表，未启用缓存或未命中时返回 None
+    """
+    if not use_cache:
+        return None
+    T_threshold_doy = hclib.load_cached_threshold_table(
+        threshold_cache_dir, threshold_cache_key(doy_actual, window_days)
+    )
+    if T_threshold_doy is not None:
+        print("阈值缓存命中，跳过阈值计算")
+    return T_threshold_doy
+
+
+def save_cached_threshold_table(doy_actual, window_days, T_threshold_doy, use_cache):
+    if use_cache:
+        cache_file = hclib.save_cached_threshold_table(
+            threshold_cache_dir,
+            threshold_cache_key(doy_actual, window_days),
+            T_threshold_doy,
+        )
+        print("阈值表已写入缓存：", cache_file)
+
+
+def compute_threshold_table(doy_actual, window_days, use_cache=True):
+    """
+    每个日历日（月/日）只计算一次，得到 (日历日, lat, lon) 的紧凑阈值表，按日历日序号索引。
+    基准期数据按日历日逐次切片读取，不整体读入内存；window_days > 0 时使用滑动窗口。
+    启用缓存时优先读取阈值缓存，未命中则计算后写入缓存
+    """
+    T_threshold_doy = load_cached_threshold_table(doy_actual, window_days, use_cache)
+    if T_threshold_doy is not None:
+        return T_threshold_doy
+
+    f_clim, clim_var, dates_clim, _, _ = open_temperature(clim_path)
+    doy_clim = dates_clim["doy"]
+    T_threshold_doy = hclib.calculate_threshold_table(
+        clim_var,
+        doy_clim,
+        percentile_level,
+        target_days=doy_actual,
+        window_days=window_days,
+    )
+    f_clim.close()
+    save_cached_threshold_table(doy_actual, window_days, T_threshold_doy, use_cache)
+    return T_threshold_doy
 
 
 # ----------------------------------------
@@ -82,108 +166,520 @@ def apply_consecutive_days_filter(mask, min_consecutive_days=3):
     print(f"应用连续{min_consecutive_days}天筛选...")
 
     nt, nlats, nlons = mask.shape
-    filtered_mask = np.zeros_like(mask, dtype=np.uint8)
 
-    # 使用向量化操作提高效率
+    # 对全部格点的时间序列做整体向量化的游程计算，按纬度带分块以控制内存
     print(f"处理 {nlats} x {nlons} = {nlats * nlons} 个格点...")
+    filtered_mask = hclib.consecutive_days_filter(
+        mask, min_consecutive_days, lat_chunk_size=lat_chunk_size
+    )
 
-    # 对每个格点进行时间序列分析
-    processed = 0
-    total = nlats * nlons
-
-    for lat_idx in range(nlats):
-        for lon_idx in range(nlons):
-            time_series = mask[:, lat_idx, lon_idx]
-
-            # 找到连续的热浪期
-            consecutive_periods = find_consecutive_periods(
-                time_series, min_consecutive_days
-            )
-
-            # 标记满足条件的连续期
-            for start, end in consecutive_periods:
-                filtered_mask[start : end + 1, lat_idx, lon_idx] = 1
+    # 统计筛选效果
+    print_filter_summary(np.sum(mask > 0), np.sum(filtered_mask > 0))
 
-            processed += 1
-            if processed % 10000 == 0:
-                print(f"已处理 {processed}/{total} 个格点 ({processed/total*100:.1f}%)")
+    return filtered_mask
 
-    # 统计筛选效果
-    original_count = np.sum(mask > 0)
-    filtered_count = np.sum(filtered_mask > 0)
 
+def print_filter_summary(original_count, filtered_count):
     print(f"原始热浪格点总数: {original_count}")
     print(f"筛选后热浪格点总数: {filtered_count}")
-    print(f"保留比例: {filtered_count / original_count * 100:.2f}%")
+    if original_count > 0:
+        print(f"保留比例: {filtered_count / original_count * 100:.2f}%")
 
-    return filtered_mask
 
+def plan_time_blocks(nt, block_days, overlap):
+    """
+    把时间轴划分为连续的核心块，每块前后各多读 overlap 天。
+    overlap = min_consecutive_days - 1 时，核心块内的连续天数筛选结果与整体计算完全一致：
+    包含某一天的任何长度为 min_consecutive_days 的连续期都落在该天前后 overlap 天之内
 
-def find_consecutive_periods(time_series, min_length):
+    Returns:
+        blocks: [(read_start, read_stop, core_start, core_stop), ...]
     """
-    找到时间序列中连续1的段落，长度至少为min_length
+    blocks = []
+    for core_start in range(0, nt, block_days):
+        core_stop = min(core_start + block_days, nt)
+        read_start = max(0, core_start - overlap)
+        read_stop = min(nt, core_stop + overlap)
+        blocks.append((read_start, read_stop, core_start, core_stop))
+    return blocks
 
-    Args:
-        time_series: 1D二值数组
-        min_length: 最小连续长度
 
-    Returns:
-        periods: 连续期的列表，每个元素为(start, end)元组
+# ----------------------------------------
+# 保存到一个 NetCDF 文件中
+# ----------------------------------------
+def create_output_file(lats, lons, T_threshold_doy, doy_actual, storage, window_days):
     """
-    periods = []
-    start = None
+    创建输出文件并写入时间、坐标与阈值表；T_actual、heatwave_mask 与 hot_run_length
+    由调用者写入。T_threshold_doy 为 None 时阈值表也由调用者写入。
+    storage 为 {"chunking", "complevel", "shuffle"}，决定三维变量的分块形状与压缩参数。
+    时间维为无限维，追加模式可以在文件末尾继续写入新的日期
+    """
+    shape = (len(doy_actual), len(lats), len(lons))
+    compression = {
+        "zlib": True,
+        "complevel": storage["complevel"],
+        "shuffle": storage["shuffle"],
+    }
+    output_nc = Dataset(output_path, "w", format="NETCDF4")
+    output_nc.createDimension("time", None)
+    output_nc.createDimension("lat", len(lats))
+    output_nc.createDimension("lon", len(lons))
+    output_nc.createDimension("dayofyear", hclib.N_CALENDAR_DAYS)
+
+    # 时间变量
+    f_src = Dataset(temp_path)
+    src_time = f_src.variables["time"]
+    time_var = output_nc.createVariable("time", src_time.datatype, ("time",))
+    time_var.setncatts({k: getattr(src_time, k) for k in src_time.ncattrs()})
+    time_var[:] = src_time[:]
+    f_src.close()
+
+    # 空间变量
+    output_nc.createVariable("lat", "f4", ("lat",))[:] = lats
+    output_nc.createVariable("lon", "f4", ("lon",))[:] = lons
+
+    # 写入变量
+    output_nc.createVariable(
+        "T_actual",
+        "f4",
+        ("time", "lat", "lon"),
+        chunksizes=hclib.output_chunk_sizes(storage["chunking"], shape, 4),
+        **compression,
+    )
+    # 阈值只保存 (日历日, lat, lon) 表，按 doy_index 查表得到每个时间步的阈值；
+    # 各阶段总是整行查表，因此每个日历日一块
+    threshold_var = output_nc.createVariable(
+        "T_threshold_doy",
+        "f4",
+        ("dayofyear", "lat", "lon"),
+        chunksizes=(1, len(lats), len(lons)),
+        **compression,
+    )
+    threshold_var.description = (
+        "Percentile threshold per calendar day (leap-year layout, Feb 29 = index 59)"
+    )
+    if T_threshold_doy is not None:
+        threshold_var[:] = T_threshold_doy
+    doy_var = output_nc.createVariable("doy_index", "i2", ("time",))
+    doy_var.description = "Row of T_threshold_doy used by each time step"
+    doy_var[:] = doy_actual
+    # 热浪掩码只有 0/1 两个值，按无符号 8 位布尔布局保存
+    mask_var = output_nc.createVariable(
+        "heatwave_mask",
+        "u1",
+        ("time", "lat", "lon"),
+        chunksizes=hclib.output_chunk_sizes(storage["chunking"], shape, 1),
+        **compression,
+    )
+    mask_var.flag_values = np.array([0, 1], dtype=np.uint8)
+    mask_var.flag_meanings = "no_heatwave heatwave"
+    # 追加模式所需的游程状态：最后一天各格点末尾连续超阈值的天数（筛选前）
+    run_var = output_nc.createVariable("hot_run_length", "i4", ("lat", "lon"))
+    run_var.description = (
+        "Trailing run length of threshold exceedance (before the consecutive-day "
+        "filter) at the last time step"
+    )
+
+    # 记录阈值与筛选参数，追加模式据此检查配置是否一致
+    output_nc.percentile = percentile_level
+    output_nc.threshold_window_days = window_days
+    output_nc.min_consecutive_days = min_consecutive_days
+
+    output_nc.description = (
+        "Processed ERA5 heatwave data with dynamic threshold and mask"
+    )
+    return output_nc
+
 
-    for i, value in enumerate(time_series):
-        if value == 1 and start is None:
-            # 开始一个新的连续期
-            start = i
-        elif value == 0 and start is not None:
-            # 结束当前连续期
-            if i - start >= min_length:
-                periods.append((start, i - 1))
-            start = None
+# ----------------------------------------
+# 处理流程
+# ----------------------------------------
+def run_full(window_days, use_cache, storage):
+    T_actual, dates_actual, lats, lons = load_temperature(temp_path)
+    doy_actual = dates_actual["doy"]
+    T_threshold_doy = compute_threshold_table(doy_actual, window_days, use_cache)
 
-    # 处理序列末尾的情况
-    if start is not None and len(time_series) - start >= min_length:
-        periods.append((start, len(time_series) - 1))
+    # 生成二值热浪掩码矩阵（实际温度超过动态阈值）
+    heatwave_mask = hclib.exceeds_threshold(T_actual, T_threshold_doy, doy_actual)
 
-    return periods
+    hot_run_length = hclib.trailing_run_length(heatwave_mask)
 
+    # 应用连续3天筛选
+    heatwave_mask = apply_consecutive_days_filter(heatwave_mask, min_consecutive_days)
 
-# 应用连续3天筛选
-heatwave_mask = apply_consecutive_days_filter(heatwave_mask, min_consecutive_days=3)
+    output_nc = create_output_file(
+        lats, lons, T_threshold_doy, doy_actual, storage, window_days
+    )
+    output_nc.variables["T_actual"][:] = T_actual
+    output_nc.variables["heatwave_mask"][:] = heatwave_mask
+    output_nc.variables["hot_run_length"][:] = hot_run_length
+    output_nc.close()
 
-# ----------------------------------------
-# 保存到一个 NetCDF 文件中
-# ----------------------------------------
-output_nc = Dataset(output_path, "w", format="NETCDF4")
-output_nc.createDimension("time", len(dates_actual))
-output_nc.createDimension("lat", len(lats))
-output_nc.createDimension("lon", len(lons))
-
-# 时间变量
-f_src = Dataset(temp_path)
-src_time = f_src.variables["time"]
-time_var = output_nc.createVariable("time", src_time.datatype, ("time",))
-time_var.setncatts({k: getattr(src_time, k) for k in src_time.ncattrs()})
-time_var[:] = src_time[:]
-f_src.close()
-
-# 空间变量
-output_nc.createVariable("lat", "f4", ("lat",))[:] = lats
-output_nc.createVariable("lon", "f4", ("lon",))[:] = lons
-
-# 写入变量
-output_nc.createVariable("T_actual", "f4", ("time", "lat", "lon"), zlib=True)[:] = (
-    T_actual
-)
-output_nc.createVariable("T_threshold", "f4", ("time", "lat", "lon"), zlib=True)[:] = (
-    T_threshold
-)
-output_nc.createVariable("heatwave_mask", "i1", ("time", "lat", "lon"), zlib=True)[
-    :
-] = heatwave_mask
 
-output_nc.description = "Processed ERA5 heatwave data with dynamic threshold and mask"
-output_nc.close()
-print("处理完成，数据保存为：", output_path)
+def run_stream(budget_mb, window_days, use_cache, storage):
+    """
+    按时间块流式处理：读取、阈值判断、连续天数筛选、写出，块边界处多读
+    min_consecutive_days - 1 天的重叠区，保证筛选结果与整体计算一致
+    """
+    f_src, temp_var, dates_actual, lats, lons = open_temperature(temp_path)
+    nt = len(dates_actual["doy"])
+    doy_actual = dates_actual["doy"]
+    T_threshold_doy = compute_threshold_table(doy_actual, window_days, use_cache)
+
+    # 根据内存预算确定每块的时间步数
+    overlap = min_consecutive_days - 1
+    bytes_per_step = len(lats) * len(lons) * BYTES_PER_CELL_STEP
+    block_days = max(1, int(budget_mb * 1024**2 // bytes_per_step) - 2 * overlap)
+    blocks = plan_time_blocks(nt, block_days, overlap)
+    print(f"流式处理: {nt} 个时间步, 每块 {block_days} 步, 共 {len(blocks)} 块")
+
+    output_nc = create_output_file(
+        lats, lons, T_threshold_doy, doy_actual, storage, window_days
+    )
+    original_count = 0
+    filtered_count = 0
+    hot_run_length = np.zeros((len(lats), len(lons)), dtype=np.int32)
+    for read_start, read_stop, core_start, core_stop in blocks:
+        T_block = hclib.read_variable(temp_var, slice(read_start, read_stop))
+        raw_mask = hclib.exceeds_threshold(
+            T_block, T_threshold_doy, doy_actual[read_start:read_stop]
+        )
+        filtered_mask = hclib.consecutive_days_filter(
+            raw_mask, min_consecutive_days, lat_chunk_size=lat_chunk_size
+        )
+
+        # 只写出核心块，重叠区仅用于保证块边界处的连续天数判断
+        core = slice(core_start - read_start, core_stop - read_start)
+        output_nc.variables["T_actual"][core_start:core_stop] = T_block[core]
+        output_nc.variables["heatwave_mask"][core_start:core_stop] = filtered_mask[core]
+
+        hot_run_length = hclib.trailing_run_length(raw_mask[core], hot_run_length)
+
+        original_count += np.sum(raw_mask[core] > 0)
+        filtered_count += np.sum(filtered_mask[core] > 0)
+        print(f"已处理时间步 {core_stop}/{nt} ({core_stop / nt * 100:.1f}%)")
+
+    print_filter_summary(original_count, filtered_count)
+    output_nc.variables["hot_run_length"][:] = hot_run_length
+    output_nc.close()
+    f_src.close()
+
+
+def process_lat_band(task):
+    """
+    并行模式的工作进程：独立读取一个纬度带的全部时间步，计算阈值表、热浪掩码与连续天数筛选。
+    threshold_band 不为 None 时（阈值缓存命中）直接使用，不再读取气候基准期数据
+
+    Args:
+        task: (lat_start, lat_stop, doy_actual, doy_clim, window_days, threshold_band)
+
+    Returns:
+        (lat_start, lat_stop, T_band, threshold_band, mask_band, run_band,
+         original_count)
+    """
+    lat_start, lat_stop, doy_actual, doy_clim, window_days, threshold_band = task
+    band = slice(lat_start, lat_stop)
+
+    if threshold_band is None:
+        f_clim = Dataset(clim_path)
+        threshold_band = hclib.calculate_threshold_table(
+            hclib.read_variable(f_clim.variables[var_name], (slice(None), band)),
+            doy_clim,
+            percentile_level,
+            target_days=doy_actual,
+            window_days=window_days,
+        )
+        f_clim.close()
+
+    f_src = Dataset(temp_path)
+    T_band = hclib.read_variable(f_src.variables[var_name], (slice(None), band))
+    f_src.close()
+
+    raw_mask = hclib.exceeds_threshold(T_band, threshold_band, doy_actual)
+    mask_band = hclib.consecutive_days_filter(
+        raw_mask, min_consecutive_days, lat_chunk_size=lat_chunk_size
+    )
+    run_band = hclib.trailing_run_length(raw_mask)
+    return (
+        lat_start,
+        lat_stop,
+        T_band,
+        threshold_band,
+        mask_band,
+        run_band,
+        np.sum(raw_mask > 0),
+    )
+
+
+def run_parallel(budget_mb, workers, window_days, use_cache, storage):
+    """
+    按纬度带并行处理：阈值与连续天数筛选对每个格点相互独立，各纬度带由进程池计算，
+    主进程按完成顺序把每个纬度带写入同一个输出文件。
+    阈值缓存命中时把缓存的阈值表按纬度带分发；未命中时由主进程拼接各纬度带的阈值后写入缓存
+    """
+    f_src, _, dates_actual, lats, lons = open_temperature(temp_path)
+    f_src.close()
+    f_clim, _, dates_clim, _, _ = open_temperature(clim_path)
+    f_clim.close()
+    nt = len(dates_actual["doy"])
+    nlats = len(lats)
+    doy_actual = dates_actual["doy"]
+    doy_clim = dates_clim["doy"]
+    T_threshold_doy = load_cached_threshold_table(doy_actual, window_days, use_cache)
+    cache_hit = T_threshold_doy is not None
+    if not cache_hit:
+        T_threshold_doy = np.full(
+            (hclib.N_CALENDAR_DAYS, nlats, len(lons)), np.nan, dtype=np.float32
+        )
+
+    # 纬度带宽度：受单进程内存预算限制，同时让纬度带数量多于进程数以均衡负载
+    bytes_per_row = nt * len(lons) * BYTES_PER_CELL_STEP
+    rows_by_budget = max(1, int(budget_mb * 1024**2 // bytes_per_row))
+    band_rows = max(1, min(rows_by_budget, int(np.ceil(nlats / (4 * workers)))))
+    tasks = [
+        (
+            lat_start,
+            min(lat_start + band_rows, nlats),
+            doy_actual,
+            doy_clim,
+            window_days,
+            (
+                T_threshold_doy[:, lat_start : lat_start + band_rows]
+                if cache_hit
+                else None
+            ),
+        )
+        for lat_start in range(0, nlats, band_rows)
+    ]
+    print(
+        f"并行处理: {workers} 个进程, 每个纬度带 {band_rows} 行, 共 {len(tasks)} 个纬度带"
+    )
+
+    output_nc = create_output_file(lats, lons, None, doy_actual, storage, window_days)
+    original_count = 0
+    filtered_count = 0
+    with Pool(workers) as pool:
+        for done, result in enumerate(pool.imap_unordered(process_lat_band, tasks)):
+            (
+                lat_start,
+                lat_stop,
+                T_band,
+                threshold_band,
+                mask_band,
+                run_band,
+                band_count,
+            ) = result
+            band = slice(lat_start, lat_stop)
+            output_nc.variables["T_actual"][:, band, :] = T_band
+            output_nc.variables["T_threshold_doy"][:, band, :] = threshold_band
+            T_threshold_doy[:, band, :] = threshold_band
+            output_nc.variables["heatwave_mask"][:, band, :] = mask_band
+            output_nc.variables["hot_run_length"][band, :] = run_band
+
+            original_count += band_count
+            filtered_count += np.sum(mask_band > 0)
+            print(
+                f"已完成纬度带 {done + 1}/{len(tasks)} (行 {lat_start}-{lat_stop - 1})"
+            )
+
+    print_filter_summary(original_count, filtered_count)
+    output_nc.close()
+    if not cache_hit:
+        save_cached_threshold_table(doy_actual, window_days, T_threshold_doy, use_cache)
+
+
+def run_append(source_path, window_days, use_cache):
+    """
+    把 source_path 中比输出文件最后一天更新的日期追加到输出文件末尾：
+    阈值直接查已保存的阈值表（缺少的日历日从气候基准期补算），连续天数筛选由保存的
+    末尾游程长度 hot_run_length 继续，只需回写此前末尾 min_consecutive_days - 1 天的掩码
+    """
+    output_nc = Dataset(output_path, "a")
+    if "hot_run_length" not in output_nc.variables:
+        output_nc.close()
+        raise ValueError(
+            f"{output_path} 中没有 hot_run_length 游程状态，请先用 full / stream / "
+            "parallel 模式重新生成输出文件"
+        )
+    stored = (
+        float(output_nc.percentile),
+        int(output_nc.threshold_window_days),
+        int(output_nc.min_consecutive_days),
+    )
+    if stored != (float(percentile_level), window_days, min_consecutive_days):
+        output_nc.close()
+        raise ValueError(
+            f"输出文件的 (percentile, window_days, min_consecutive_days) = {stored} "
+            "与当前配置不一致，不能追加"
+        )
+
+    # 找出比输出文件最后一天更新的时间步（换算到输出文件的时间单位后比较）
+    out_time = output_nc.variables["time"]
+    nt_old = len(out_time)
+    f_src, temp_var, dates_src, _, _ = open_temperature(source_path)
+    src_time_var = f_src.variables["time"]
+    src_time = src_time_var[:]
+    out_calendar = getattr(out_time, "calendar", "standard")
+    src_calendar = getattr(src_time_var, "calendar", "standard")
+    if (src_time_var.units, src_calendar) != (out_time.units, out_calendar):
+        src_time = date2num(
+            num2date(src_time, units=src_time_var.units, calendar=src_calendar),
+            units=out_time.units,
+            calendar=out_calendar,
+        )
+    new_steps = np.where(src_time > out_time[nt_old - 1])[0]
+    if len(new_steps) == 0:
+        print("没有需要追加的新日期")
+        f_src.close()
+        output_nc.close()
+        return
+
+    # 游程状态只对紧接在最后一天之后的日期有效：新日期在源文件中必须连续，
+    # 且与输出文件的最后一天逐日相接，否则会把缺失日期两侧的游程连在一起
+    steps_dates = num2date(
+        np.concatenate(([out_time[nt_old - 1]], src_time[new_steps])),
+        units=out_time.units,
+        calendar=out_calendar,
+    )
+    day_numbers = np.floor(
+        date2num(steps_dates, "days since 1900-01-01 00:00:00", calendar=out_calendar)
+    )
+    gaps = np.flatnonzero(
+        (np.diff(day_numbers) != 1)
+        | (np.diff(new_steps, prepend=new_steps[0] - 1) != 1)
+    )
+    if len(gaps) > 0:
+        f_src.close()
+        output_nc.close()
+        raise ValueError(
+            f"追加的日期不连续：{steps_dates[gaps[0]].strftime('%Y%m%d')} 之后是 "
+            f"{steps_dates[gaps[0] + 1].strftime('%Y%m%d')}，游程状态无法继续。"
+            f"请补齐缺失日期后用 full / stream / parallel 模式重新生成 {output_path}"
+        )
+
+    T_new = hclib.read_time_steps(temp_var, new_steps)
+    f_src.close()
+    doy_new = dates_src["doy"][new_steps]
+    print(
+        f"追加 {len(new_steps)} 天: {hclib.date_string(dates_src, new_steps[0])} 到 "
+        f"{hclib.date_string(dates_src, new_steps[-1])}"
+    )
+
+    # 只读取新日期用到的阈值表行，缺少的日历日从气候基准期补算并写回阈值表
+    threshold_var = output_nc.variables["T_threshold_doy"]
+    days = np.unique(doy_new)
+    thresholds = hclib.read_variable(threshold_var, days)
+    missing = np.all(np.isnan(thresholds), axis=(1, 2))
+    if np.any(missing):
+        print(f"阈值表缺少 {np.sum(missing)} 个日历日，从气候基准期补算")
+        T_threshold_doy = compute_threshold_table(days[missing], window_days, use_cache)
+        for day in days[missing]:
+            threshold_var[day] = T_threshold_doy[day]
+        thresholds[missing] = T_threshold_doy[days[missing]]
+    raw_mask = hclib.exceeds_threshold(
+        T_new, thresholds, np.searchsorted(days, doy_new)
+    )
+
+    # 由末尾游程长度继续连续天数筛选；标记的前几行对应此前末尾的日期
+    tail = min(min_consecutive_days - 1, nt_old)
+    marks, hot_run_length = hclib.append_consecutive_days_filter(
+        raw_mask,
+        hclib.read_variable(output_nc.variables["hot_run_length"], dtype=None),
+        min_consecutive_days,
+    )
+    marks = marks[min_consecutive_days - 1 - tail :]
+    mask_var = output_nc.variables["heatwave_mask"]
+    tail_mask = hclib.read_variable(mask_var, slice(nt_old - tail, nt_old), dtype=None)
+    updated_tail = tail_mask | marks[:tail]
+    print(f"补标此前末尾 {tail} 天的热浪格点: {np.sum(updated_tail != tail_mask)}")
+
+    new_slice = slice(nt_old, nt_old + len(new_steps))
+    out_time[new_slice] = src_time[new_steps]
+    output_nc.variables["doy_index"][new_slice] = doy_new
+    output_nc.variables["T_actual"][new_slice] = T_new
+    mask_var[nt_old - tail : nt_old] = updated_tail
+    mask_var[new_slice] = marks[tail:]
+    output_nc.variables["hot_run_length"][:] = hot_run_length
+    output_nc.close()
+
+    print_filter_summary(np.sum(raw_mask > 0), np.sum(marks[tail:] > 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="热浪数据预处理：动态阈值、热浪掩码与连续天数筛选"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["full", "stream", "parallel", "append"],
+        default=processing_mode,
+        help="处理模式",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        default=memory_budget_mb,
+        help="流式模式下单个时间块 / 并行模式下单个纬度带的内存预算（MB）",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=n_workers, help="并行模式的进程数"
+    )
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=threshold_window_days,
+        help="阈值滑动窗口半宽（天），0 表示只用同一月日",
+    )
+    parser.add_argument(
+        "--no-threshold-cache",
+        action="store_true",
+        help="不读取也不写入阈值缓存，总是重新计算阈值",
+    )
+    parser.add_argument(
+        "--chunking",
+        choices=hclib.CHUNK_PRESETS,
+        default=output_chunking,
+        help="输出文件三维变量的分块方案",
+    )
+    parser.add_argument(
+        "--complevel",
+        type=int,
+        choices=range(1, 10),
+        default=output_complevel,
+        help="zlib 压缩级别",
+    )
+    parser.add_argument(
+        "--no-shuffle",
+        dest="shuffle",
+        action="store_false",
+        default=output_shuffle,
+        help="关闭压缩前的字节重排（shuffle）过滤器",
+    )
+    parser.add_argument(
+        "--append-source",
+        default=temp_path,
+        help="追加模式读取新日期的温度文件（默认为 temp_path）",
+    )
+    args = parser.parse_args()
+    use_cache = not args.no_threshold_cache
+    storage = {
+        "chunking": args.chunking,
+        "complevel": args.complevel,
+        "shuffle": args.shuffle,
+    }
+
+    if args.mode == "stream":
+        run_stream(args.memory_budget_mb, args.window_days, use_cache, storage)
+    elif args.mode == "parallel":
+        run_parallel(
+            args.memory_budget_mb, args.workers, args.window_days, use_cache, storage
+        )
+    elif args.mode == "append":
+        run_append(args.append_source, args.window_days, use_cache)
+    else:
+        run_full(args.window_days, use_cache, storage)
+    print("处理完成，数据保存为：", output_path)
+
+
+if __name__ == "__main__":
+    main()
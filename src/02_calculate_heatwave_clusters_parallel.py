@@ -4,22 +4,25 @@ This script identifies 2D heatwave clusters for each time step using ERA5 temper
 Adapted from original drought code by Julio E. Herrera Estrada, Ph.D.
 """
 
-import pickle
+import argparse
+import os
 import time
-from datetime import datetime
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 import yaml
 from dateutil.relativedelta import relativedelta
-from mpi4py import MPI
 from netCDF4 import Dataset
 
 import heatwave_clusters_utils as hclib
 
-# Initialize MPI
-comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
-size = comm.Get_size()
+# 执行后端（可用 --backend 覆盖）：serial 单进程；process 单节点进程池，输入数据放在
+# 共享内存中；mpi 主从动态调度（mpi4py 只在这个后端导入，用 mpirun 启动多个进程）
+EXECUTOR_BACKENDS = ("serial", "process", "mpi")
+
+# 日志前缀中的进程名：mpi 为 rank，process 为子进程 pid
+worker_name = "Main"
 
 ##################################################################################
 ############################ LOAD CONFIGURATION ##################################
@@ -39,6 +42,16 @@ heatwave_file_path = (
 lat_var = definitions["lat_var"]
 lon_var = definitions["lon_var"]
 minimum_area_threshold = definitions["minimum_area_threshold"]
+grid_cache_path = definitions.get("grid_cache_path")
+# 每次批量聚类的天数
+cluster_block_days = definitions.get("cluster_block_days", 32)
+# 多进程动态调度时每次分发的天数
+schedule_batch_days = definitions.get("schedule_batch_days", 4)
+# 聚类前是否对温度差做 3x3 邻域中值滤波（去除零散的噪点聚类）
+apply_median_filter = definitions.get("median_filter", False)
+# 执行后端与 process 后端的进程数（不设置时为 CPU 核数）
+executor_backend = definitions.get("executor", "mpi")
+executor_workers = definitions.get("executor_workers") or os.cpu_count()
 
 # Cluster output folder
 clusters_partial_path = definitions["clusters_partial_path"]
@@ -48,154 +61,353 @@ clusters_full_path = f"{clusters_partial_path}/{dataset}/{region}/heatwave/90p/"
 ############################ LOAD INPUT DATA #####################################
 ##################################################################################
 
+# 每个进程只打开文件读取坐标、时间轴等小变量；T_actual、阈值表与 heatwave_mask
+# 不整体读入，工作进程按分到的批次只读取对应的时间步（见 read_block）
 f = Dataset(heatwave_file_path)
-T_actual = f.variables["T_actual"][:]  # shape: (time, lat, lon)
-T_threshold = f.variables["T_threshold"][:]
-heatwave_mask = f.variables["heatwave_mask"][:]
 lons = f.variables[lon_var][:]
 lats = f.variables[lat_var][:]
 
-# 获取实际的时间轴信息
-time_var = f.variables["time"]
-time_units = time_var.units
-time_calendar = time_var.calendar if hasattr(time_var, "calendar") else "standard"
-from netCDF4 import num2date
-
-actual_dates = num2date(time_var[:], units=time_units, calendar=time_calendar)
-f.close()
+# 获取实际的时间轴信息：一次性解码为整数的年/月/日数组
+actual_dates = hclib.read_time_axis(f.variables["time"])
 
 # 找到2011-2020年5-9月的时间索引
-start_date = datetime(start_year, 5, 1)
-end_date = datetime(end_year, 9, 30)
-
-# 筛选出目标时间段的数据
-time_mask = []
-for i, date in enumerate(actual_dates):
-    if (
-        date.year >= start_year
-        and date.year <= end_year
-        and date.month >= 5
-        and date.month <= 9
-    ):
-        time_mask.append(i)
-
-time_mask = np.array(time_mask)
-T_actual_filtered = T_actual[time_mask]
-T_threshold_filtered = T_threshold[time_mask]
-heatwave_mask_filtered = heatwave_mask[time_mask]
+time_mask = np.where(hclib.season_mask(actual_dates, start_year, end_year))[0]
+
+# 每个时间步对应的阈值表 (dayofyear, lat, lon) 行
+doy_index_filtered = hclib.read_time_steps(
+    f.variables["doy_index"], time_mask, dtype=None
+)
 
 nsteps = len(time_mask)
 resolution_lon = np.mean(lons[1:] - lons[:-1])
 resolution_lat = np.mean(lats[1:] - lats[:-1])
 
+# 网格几何（每行格点面积、cos 纬度权重、单位向量）只计算一次并缓存到磁盘
+geometry = hclib.GridGeometry.cached(
+    lons, lats, resolution_lon, resolution_lat, cache_dir=grid_cache_path
+)
+
+# 排除区域（默认只有撒哈拉），质心落在其中的聚类被筛除
+exclusion = hclib.ExclusionRegions.from_config(
+    definitions.get("exclusion_regions"), lons, lats
+)
+
+# 聚类库与配置哈希：输入文件和影响聚类结果的设置不变时，断点续算才沿用已完成的日期
+store_path = os.path.join(clusters_full_path, hclib.CLUSTER_STORE_DIR)
+config_hash = hclib.cluster_config_hash(
+    heatwave_file_path,
+    {
+        "lat_var": lat_var,
+        "lon_var": lon_var,
+        "minimum_area_threshold": minimum_area_threshold,
+        "periodic_bool": periodic_bool,
+        "median_filter": apply_median_filter,
+        "exclusion_regions": definitions.get("exclusion_regions"),
+    },
+)
+
 ##################################################################################
 #################### IDENTIFY HEATWAVE CLUSTERS (PER TIME STEP) ##################
 ##################################################################################
 
 
-import os  # 确保放在文件顶部
+# process 后端的共享内存输入：(T_actual, T_threshold_doy) 的 (RawArray, shape, dtype)
+shared_inputs = None
 
 
-def find_clusters(
-    chunk,
-    actual_dates,
-    time_mask,
-    T_actual_filtered,
-    T_threshold_filtered,
-    heatwave_mask_filtered,
-):
-    chunk_length = len(chunk)
+def shared_array(shape, dtype):
+    """在共享内存中分配数组，返回 (RawArray, shape, dtype) 与可写的 ndarray 视图"""
+    dtype = np.dtype(dtype)
+    raw = RawArray("b", int(np.prod(shape)) * dtype.itemsize)
+    return (raw, shape, dtype.str), shared_array_view((raw, shape, dtype.str))
 
-    # 🛠️ 确保输出路径存在（只执行一次）
-    if not os.path.exists(clusters_full_path):
-        os.makedirs(clusters_full_path)
-
-    for i in range(0, chunk_length):
-        step_t0 = time.time()
-        index = int(chunk[i])
-        # 使用实际的时间轴而不是简单的索引加法
-        current_date = actual_dates[time_mask[index]]
-        safe_date_str = current_date.strftime("%Y%m%d")  # 🆗 无空格的日期字符串
-
-        # STEP 1: Extract 2D fields for this timestep (使用筛选后的数据)
-        # 使用温度差作为聚类输入，并将非热浪像元设为 NaN，确保仅在热浪像元上建立连通域
-        temp_diff = T_actual_filtered[index, :, :] - T_threshold_filtered[index, :, :]
-        data_for_clustering = temp_diff.astype(np.float32)
-        data_for_clustering[data_for_clustering <= 0] = np.nan
-        # 同时构造用于保存的二值掩膜（0/1）
-        binary_mask = np.where(np.isfinite(data_for_clustering), 1.0, np.nan).astype(
-            np.float32
-        )
 
-        # 进度提示（提早打印，便于观察）
-        print(
-            f"[Rank {rank}] {i + 1}/{chunk_length} | global {index + 1}/{nsteps} | date {safe_date_str}: heatwave pixels = {int(np.isfinite(data_for_clustering).sum())}"
-        )
+def shared_array_view(spec):
+    """共享内存数组的 ndarray 视图（不复制）"""
+    raw, shape, dtype = spec
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
 
-        # STEP 2: Identify heatwave clusters using spatial connectivity
-        cluster_count, cluster_dict = hclib.find_drought_clusters(
-            data_for_clustering,
-            lons,
-            lats,
-            resolution_lon,
-            resolution_lat,
-            periodic_bool,
-        )
 
-        # STEP 3: Filter small clusters
-        data_for_clustering, cluster_count, cluster_dict = (
-            hclib.filter_drought_clusters(
-                data_for_clustering, cluster_count, cluster_dict, minimum_area_threshold
-            )
-        )
+def read_block(block):
+    """
+    只读取一批日期的实际温度和这些日期用到的阈值表行（按时间索引的超平面切片，
+    连续的日期合并为一次读取），返回温度差 (day, lat, lon)。process 后端直接从
+    共享内存中取这些日期
+
+    Args:
+        block: 递增的日期序号（time_mask 中的位置）
+    """
+    if shared_inputs is not None:
+        T_actual, T_threshold_doy = (shared_array_view(spec) for spec in shared_inputs)
+        return T_actual[block] - T_threshold_doy[doy_index_filtered[block]]
+
+    T_actual_block = hclib.read_time_steps(f.variables["T_actual"], time_mask[block])
+    doy_rows, doy_inverse = np.unique(doy_index_filtered[block], return_inverse=True)
+    T_threshold_rows = hclib.read_time_steps(f.variables["T_threshold_doy"], doy_rows)
+    return T_actual_block - T_threshold_rows[doy_inverse]
 
-        # STEP 4: Compute heatwave features (intensity, centroid)
-        cluster_dict = hclib.add_heatwave_metrics(
-            cluster_dict, temp_diff, lons, lats, resolution_lon, resolution_lat
+
+def read_day_costs():
+    """
+    每天热浪掩码的格点数（调度代价）；按 cluster_block_days 天一块读取掩码，
+    不读入整个立方体
+    """
+    costs = np.zeros(nsteps, dtype=np.int64)
+    for start in range(0, nsteps, cluster_block_days):
+        stop = min(start + cluster_block_days, nsteps)
+        mask = hclib.read_time_steps(
+            f.variables["heatwave_mask"], time_mask[start:stop], dtype=None
+        )
+        costs[start:stop] = np.count_nonzero(mask.reshape(stop - start, -1), axis=1)
+    return costs
+
+
+def find_clusters(block, actual_dates, time_mask, pruning_counters):
+    """
+    一次批量处理一组日期（不要求连续）：标记、筛选并计算指标
+
+    Returns:
+        block: 按时间顺序排列的日期序号
+        labels: (day, lat, lon) 标签立方体
+        table: 列式聚类表（见 hclib.cluster_day_block）
+    """
+    # 按时间顺序读取
+    block = np.sort(block)
+
+    # STEP 1: Extract the temperature differences of the block (只读取这批日期)
+    # 阈值按日历日从阈值表中查出；温度差为正的像元参与聚类
+    temp_diff = read_block(block)
+    if apply_median_filter:
+        # 可选去噪：整块一次完成中值滤波，再按滤波后的温度差识别聚类
+        temp_diff = hclib.median_filter(temp_diff, periodic_bool)
+
+    # STEP 2-4: Identify heatwave clusters, filter small clusters and compute the
+    # heatwave features (intensity, centroid) for all days of the block
+    labels, table = hclib.cluster_day_block(
+        temp_diff,
+        lons,
+        lats,
+        resolution_lon,
+        resolution_lat,
+        periodic_bool,
+        minimum_area_threshold,
+        geometry,
+        exclusion,
+        pruning_counters,
+    )
+
+    cluster_counts = np.bincount(table["day"], minlength=len(block))
+    for i, index in enumerate(block):
+        # 🆗 无空格的日期字符串
+        safe_date_str = hclib.date_string(actual_dates, time_mask[index])
+        print(
+            f"[{worker_name}] global {index + 1}/{nsteps} | date {safe_date_str}: heatwave pixels = {int((temp_diff[i] > 0).sum())} | clusters={cluster_counts[i]}"
         )
 
-        # 更新用于保存的掩膜（经过面积阈值过滤后，仅保留有效聚类像元为1，其它为NaN）
-        if cluster_count > 0:
-            # 将被过滤后的 data_for_clustering 中的有限值置为1，其它NaN保持
-            binary_mask = np.where(
-                np.isfinite(data_for_clustering), 1.0, np.nan
-            ).astype(np.float32)
-
-        # STEP 5: Save results with safe file names
-        f_name_mask = f"{clusters_full_path}/heatwave-mask_{safe_date_str}.pck"
-        f_name_dict = f"{clusters_full_path}/heatwave-dictionary_{safe_date_str}.pck"
-        f_name_count = f"{clusters_full_path}/heatwave-count_{safe_date_str}.pck"
-
-        with open(f_name_mask, "wb") as f:
-            pickle.dump(binary_mask, f, pickle.HIGHEST_PROTOCOL)
-        with open(f_name_dict, "wb") as f:
-            pickle.dump(cluster_dict, f, pickle.HIGHEST_PROTOCOL)
-        with open(f_name_count, "wb") as f:
-            pickle.dump(cluster_count, f, pickle.HIGHEST_PROTOCOL)
-
-        step_secs = time.time() - step_t0
+    return block, labels, table
+
+
+def process_block(block):
+    """
+    处理一批日期，返回 (进程名, 日期序号, 标签立方体, 聚类表, 耗时, 面积优先筛选计数)
+    """
+    pruning_counters = {}
+    block_t0 = time.time()
+    block, labels, table = find_clusters(
+        block, actual_dates, time_mask, pruning_counters
+    )
+    block_secs = time.time() - block_t0
+    print(
+        f"[{worker_name}] block of {len(block)} days | {block_secs / len(block):.2f}s per day"
+    )
+    return worker_name, block, labels, table, block_secs, pruning_counters
+
+
+def open_store(resume):
+    """
+    驱动进程打开聚类库；resume 时保留清单中配置哈希相同、结果完整的日期，
+    否则从头写入
+    """
+    return hclib.ClusterStoreWriter(
+        store_path,
+        [hclib.date_string(actual_dates, index) for index in time_mask],
+        (len(lats), len(lons)),
+        config_hash,
+        resume,
+    )
+
+
+def plan_batches(writer, batch_days):
+    """只为还没有有效结果的日期按代价从大到小分批"""
+    pending = writer.pending_days()
+    if len(pending) < nsteps:
         print(
-            f"[Rank {rank}] saved {safe_date_str} | clusters={cluster_count} | step={step_secs:.2f}s"
+            f"[{worker_name}] resume: {nsteps - len(pending)} days already done, {len(pending)} to compute"
         )
+    costs = read_day_costs()[pending]
+    return [pending[batch] for batch in hclib.cost_ordered_batches(costs, batch_days)]
+
+
+def save_results(results, writer):
+    """
+    STEP 5: 由一个进程把各批次的结果（按完成顺序）写入聚类库，代替逐日的
+    heatwave-mask / heatwave-dictionary / heatwave-count pck 文件；每批写完后在清单中
+    记录这些日期。最后汇总完成天数、聚类总数、各进程耗时与筛选计数
+    """
+    days_done = 0
+    cluster_total = 0
+    worker_secs = {}
+    pruning_counters = {}
+    for name, block, labels, table, block_secs, counters in results:
+        writer.write_block(block, labels, table)
+        days_done += len(block)
+        cluster_total += len(table["day"])
+        worker_secs[name] = worker_secs.get(name, 0.0) + block_secs
+        for key, value in counters.items():
+            pruning_counters[key] = pruning_counters.get(key, 0) + value
+    writer.close()
+
+    print(f"[{worker_name}] {days_done}/{nsteps} days done | clusters={cluster_total}")
+    for name in sorted(worker_secs):
+        print(f"[{worker_name}] {name} busy {worker_secs[name]:.2f}s")
+    print(f"[{worker_name}] {hclib.format_pruning_counters(pruning_counters)}")
+    print(f"[{worker_name}] saved cluster store {store_path}")
 
 
 ##################################################################################
 ########################### PARALLEL EXECUTION ###################################
 ##################################################################################
 
-offset = 0
-h = np.ceil(nsteps / np.float32(size - offset))
-
-if rank >= offset and rank < size - 1:
-    chunk = np.arange((rank - offset) * h, (rank - offset) * h + h)
-elif rank == size - 1:
-    chunk = np.arange((rank - offset) * h, nsteps)
-
-find_clusters(
-    chunk,
-    actual_dates,
-    time_mask,
-    T_actual_filtered,
-    T_threshold_filtered,
-    heatwave_mask_filtered,
-)
+
+def run_serial(resume):
+    """单进程：按代价顺序以 cluster_block_days 天为一块依次处理"""
+    writer = open_store(resume)
+    batches = plan_batches(writer, cluster_block_days)
+    save_results((process_block(block) for block in batches), writer)
+
+
+def init_process_worker(inputs):
+    """process 后端子进程的初始化：使用共享内存中的输入数据"""
+    global shared_inputs, worker_name
+    shared_inputs = inputs
+    worker_name = f"Worker {os.getpid()}"
+
+
+def run_process(workers, resume):
+    """
+    单节点进程池：主进程把暖季的 T_actual 与阈值表逐块读入共享内存（RawArray）各一份，
+    子进程只取视图、不复制；批次按代价顺序用 imap_unordered 动态分发给空闲的子进程
+    """
+    T_threshold_var = f.variables["T_threshold_doy"]
+    T_actual_spec, T_actual = shared_array((nsteps, len(lats), len(lons)), np.float32)
+    for start in range(0, nsteps, cluster_block_days):
+        stop = min(start + cluster_block_days, nsteps)
+        T_actual[start:stop] = hclib.read_time_steps(
+            f.variables["T_actual"], time_mask[start:stop]
+        )
+    T_threshold_spec, T_threshold_doy = shared_array(T_threshold_var.shape, np.float32)
+    T_threshold_doy[:] = hclib.read_variable(T_threshold_var)
+
+    writer = open_store(resume)
+    batches = plan_batches(writer, schedule_batch_days)
+    print(
+        f"[{worker_name}] scheduling {sum(map(len, batches))} days in {len(batches)} batches of up to {schedule_batch_days} days over {workers} processes"
+    )
+    with Pool(
+        workers,
+        initializer=init_process_worker,
+        initargs=((T_actual_spec, T_threshold_spec),),
+    ) as pool:
+        save_results(pool.imap_unordered(process_block, batches), writer)
+
+
+def run_mpi(resume):
+    """
+    MPI 动态主从调度：rank 0 按代价（当天热浪掩码的格点数）从大到小把日期分成小批次，
+    空闲的进程向 rank 0 请求下一批并回报上一批的结果，直到全部分发完
+    """
+    global worker_name
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    worker_name = f"Rank {rank}"
+    if size == 1:
+        run_serial(resume)
+        return
+
+    TAG_REQUEST = 1
+    TAG_WORK = 2
+    if rank == 0:
+        writer = open_store(resume)
+        batches = plan_batches(writer, schedule_batch_days)
+        print(
+            f"[{worker_name}] scheduling {sum(map(len, batches))} days in {len(batches)} batches of up to {schedule_batch_days} days over {size - 1} workers"
+        )
+
+        def worker_results():
+            next_batch = 0
+            active_workers = size - 1
+            status = MPI.Status()
+            while active_workers > 0:
+                # 工作进程的请求携带上一批的结果（第一次请求为 None）
+                result = comm.recv(
+                    source=MPI.ANY_SOURCE, tag=TAG_REQUEST, status=status
+                )
+                worker = status.Get_source()
+                if next_batch < len(batches):
+                    comm.send(batches[next_batch], dest=worker, tag=TAG_WORK)
+                    next_batch += 1
+                else:
+                    comm.send(None, dest=worker, tag=TAG_WORK)
+                    active_workers -= 1
+                if result is not None:
+                    yield result
+
+        save_results(worker_results(), writer)
+    else:
+        result = None
+        while True:
+            comm.send(result, dest=0, tag=TAG_REQUEST)
+            block = comm.recv(source=0, tag=TAG_WORK)
+            if block is None:
+                break
+            result = process_block(block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="逐日识别热浪聚类")
+    parser.add_argument(
+        "--backend",
+        choices=EXECUTOR_BACKENDS,
+        default=executor_backend,
+        help="执行后端",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=executor_workers,
+        help="process 后端的进程数",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="断点续算：只计算聚类库清单中缺失或配置已改变的日期",
+    )
+    args = parser.parse_args()
+
+    # 🛠️ 确保输出路径存在（只执行一次）
+    os.makedirs(clusters_full_path, exist_ok=True)
+
+    if args.backend == "serial":
+        run_serial(args.resume)
+    elif args.backend == "process":
+        run_process(args.workers, args.resume)
+    else:
+        run_mpi(args.resume)
+    f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -35,14 +35,25 @@ start_year = definitions["start_year"]
 end_year = definitions["end_year"]
 lat_var = definitions["lat_var"]
 lon_var = definitions["lon_var"]
+minimum_area_threshold = definitions["minimum_area_threshold"]
+periodic_bool = definitions["periodic_bool"]
+grid_cache_path = definitions.get("grid_cache_path")
+
+# 追踪引擎："pairwise" 读取 02 脚本的聚类库（或旧版本的逐日 pck 文件）并逐日成对匹配；
+# "volume" 直接从预处理文件按暖季在 (time, lat, lon) 时空体中标记事件，不需要 02 的输出
+tracking_engine = definitions.get("tracking_engine", "pairwise")
+temporal_connectivity = definitions.get("temporal_connectivity", "full")
+# 与 02 脚本相同的可选中值滤波
+apply_median_filter = definitions.get("median_filter", False)
 
 clusters_partial_path = definitions["clusters_partial_path"]
 clusters_full_path = f"{clusters_partial_path}/{dataset}/{region}/{drought_metric}/{drought_threshold_name}"
 
 # File to get coordinates
-f = Dataset(
+heatwave_file_path = (
     definitions["drought_metric_path"] + definitions["drought_metric_file_name"]
 )
+f = Dataset(heatwave_file_path)
 lons = f.variables[lon_var][:]
 lats = f.variables[lat_var][:]
 f.close()
@@ -51,58 +62,151 @@ f.close()
 ########################## TRACK HEATWAVE CLUSTERS THROUGH TIME ##################
 ##################################################################################
 
-start_date = datetime(start_year, 5, 1)
-end_date = datetime(end_year, 9, 30)
-nt = (end_date - start_date).days + 1  # 日数据
 
-# 检查实际可用的聚类文件来确定真实的结束日期
-clusters_partial_path = definitions["clusters_partial_path"]
-clusters_full_path = f"{clusters_partial_path}/{dataset}/{region}/{drought_metric}/{drought_threshold_name}"
+def run_pairwise():
+    """逐日读取 02 脚本保存的聚类字典（聚类库），逐日成对匹配为热浪事件"""
+    start_date = datetime(start_year, 5, 1)
+    end_date = datetime(end_year, 9, 30)
+    nt = (end_date - start_date).days + 1  # 日数据
 
-# 获取所有可用的聚类文件
-dict_files = glob.glob(f"{clusters_full_path}/heatwave-dictionary_*.pck")
-if dict_files:
-    # 从文件名中提取日期，找到真实的结束日期
-    dates = []
-    for f in dict_files:
-        date_str = f.split("_")[-1].replace(".pck", "")
-        try:
-            date_obj = datetime.strptime(date_str, "%Y%m%d")
-            dates.append(date_obj)
-        except:
-            continue
+    # 检查实际可用的聚类文件来确定真实的结束日期
+    # 优先读取 02 脚本写出的聚类库，没有时读取旧版本的逐日 pck 文件
+    store_path = os.path.join(clusters_full_path, hclib.CLUSTER_STORE_DIR)
+    if hclib.ClusterStore.exists(store_path):
+        store = hclib.ClusterStore(store_path)
+        dict_files = [store.date_string(day) for day in range(len(store))]
+    else:
+        dict_files = glob.glob(f"{clusters_full_path}/heatwave-dictionary_*.pck")
+    if dict_files:
+        # 从文件名（或聚类库的日期）中提取日期，找到真实的结束日期
+        dates = []
+        for f in dict_files:
+            date_str = f.split("_")[-1].replace(".pck", "")
+            try:
+                date_obj = datetime.strptime(date_str, "%Y%m%d")
+                dates.append(date_obj)
+            except:
+                continue
+
+        if dates:
+            dates.sort()
+            actual_start_date = dates[0]
+            actual_end_date = dates[-1]
+            actual_nt = len(dates)
+
+            print(
+                f"📅 实际聚类文件日期范围: {actual_start_date.strftime('%Y-%m-%d')} 到 {actual_end_date.strftime('%Y-%m-%d')}"
+            )
+            print(f"📊 实际文件数量: {actual_nt}")
+
+            # 使用实际的日期范围
+            start_date = actual_start_date
+            end_date = actual_end_date
+            nt = actual_nt
+        else:
+            print("❌ 未找到有效的聚类文件")
+            exit(1)
+    else:
+        print("❌ 未找到聚类文件目录")
+        exit(1)
 
-    if dates:
-        dates.sort()
-        actual_start_date = dates[0]
-        actual_end_date = dates[-1]
-        actual_nt = len(dates)
+    hclib.track_heatwave_clusters_and_save(
+        clusters_full_path,
+        start_date,
+        end_date,
+        nt,
+        lons,
+        lats,
+        drought_threshold_name,
+        dataset,
+    )
+
+
+def season_days(f, season_indices, dates, T_threshold_doy):
+    """按时间顺序逐日产生一个暖季的 (date, 温度差)，整季只读取一次"""
+    T_actual = hclib.read_time_steps(f.variables["T_actual"], season_indices)
+    doy_index = hclib.read_time_steps(
+        f.variables["doy_index"], season_indices, dtype=None
+    )
+    temp_diff = T_actual - T_threshold_doy[doy_index]
+    if apply_median_filter:
+        temp_diff = hclib.median_filter(temp_diff, periodic_bool)
+    for i, index in enumerate(season_indices):
+        date = datetime(
+            int(dates["year"][index]),
+            int(dates["month"][index]),
+            int(dates["day"][index]),
+        )
+        yield date, temp_diff[i]
+
+
+def run_volume():
+    """每个暖季在 (time, lat, lon) 时空体中一次性标记热浪事件，直接生成事件表"""
+    resolution_lon = np.mean(lons[1:] - lons[:-1])
+    resolution_lat = np.mean(lats[1:] - lats[:-1])
+    geometry = hclib.GridGeometry.cached(
+        lons, lats, resolution_lon, resolution_lat, cache_dir=grid_cache_path
+    )
+    exclusion = hclib.ExclusionRegions.from_config(
+        definitions.get("exclusion_regions"), lons, lats
+    )
+
+    f = Dataset(heatwave_file_path)
+    dates = hclib.read_time_axis(f.variables["time"])
+    T_threshold_doy = hclib.read_variable(f.variables["T_threshold_doy"])
+
+    print(f"开始按暖季标记热浪事件（时间连通方式: {temporal_connectivity}）...")
+    cluster_data_dictionary = {}
+    pruning_counters = {}
+    first_date = last_date = None
+    for year in range(start_year, end_year + 1):
+        # 每个暖季单独标记，对应 5 月 1 日的边界重置
+        season_indices = np.where(hclib.season_mask(dates, year, year))[0]
+        if len(season_indices) == 0:
+            continue
 
-        print(
-            f"📅 实际聚类文件日期范围: {actual_start_date.strftime('%Y-%m-%d')} 到 {actual_end_date.strftime('%Y-%m-%d')}"
+        events = hclib.label_season_events(
+            season_days(f, season_indices, dates, T_threshold_doy),
+            lons,
+            lats,
+            resolution_lon,
+            resolution_lat,
+            periodic_bool,
+            minimum_area_threshold,
+            temporal_connectivity,
+            geometry,
+            exclusion,
+            pruning_counters,
         )
-        print(f"📊 实际文件数量: {actual_nt}")
+        for event in events:
+            cluster_data_dictionary[len(cluster_data_dictionary)] = event
+        print(f"{year}: {len(season_indices)} 天, 热浪事件 {len(events)} 个")
 
-        # 使用实际的日期范围
-        start_date = actual_start_date
-        end_date = actual_end_date
-        nt = actual_nt
-    else:
-        print("❌ 未找到有效的聚类文件")
-        exit(1)
+        if first_date is None:
+            first_date = hclib.date_string(dates, season_indices[0])
+        last_date = hclib.date_string(dates, season_indices[-1])
+    f.close()
+
+    if first_date is None:
+        print("❌ 预处理文件中没有目标暖季的数据")
+        return
+
+    print(hclib.format_pruning_counters(pruning_counters))
+    print(f"✅ 共识别热浪事件数：{len(cluster_data_dictionary)}")
+
+    output_file = f"{clusters_full_path}/result/tracked_clusters_dictionary_{first_date[:4]}-{last_date[:4]}.pck"
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "wb") as f:
+        pickle.dump(cluster_data_dictionary, f, pickle.HIGHEST_PROTOCOL)
+
+    print(f"✅ 热浪追踪数据保存至：{output_file}")
+
+
+if tracking_engine == "volume":
+    run_volume()
+elif tracking_engine == "pairwise":
+    run_pairwise()
 else:
-    print("❌ 未找到聚类文件目录")
-    exit(1)
-
-hclib.track_heatwave_clusters_and_save(
-    clusters_full_path,
-    start_date,
-    end_date,
-    nt,
-    lons,
-    lats,
-    drought_threshold_name,
-    dataset,
-)
+    raise ValueError(f"未知的追踪引擎 tracking_engine: {tracking_engine}")
 
 print("✅ Done tracking heatwave clusters.")
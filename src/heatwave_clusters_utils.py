@@ -1,11 +1,14 @@
+import hashlib
+import json
 import os
 import pickle
 from calendar import monthrange
+from collections.abc import Mapping
 from datetime import timedelta
 
 import numpy as np
 from dateutil.relativedelta import relativedelta
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals, num2date
 
 #############################################################################################################
 ######################################### DATA PRE-PROCESSING TOOLS #########################################
@@ -195,67 +198,678 @@ def calculate_percentiles_matrix(data_matrix, seasonality_bool):
     return percentile_matrix
 
 
+def find_consecutive_runs(mask, min_length):
+    """
+    沿时间轴（第 0 维）对所有格点一次性找出长度至少为 min_length 的连续 1 段落
+
+    Args:
+        mask: 二值数组 (time, ...)，例如 (time, lat, lon) 的热浪掩码
+        min_length: 最小连续长度
+
+    Returns:
+        in_run: 与 mask 同形状的布尔数组，属于满足条件的连续期的元素为 True
+    """
+    hot = mask > 0
+    nt = hot.shape[0]
+    steps = np.arange(1, nt + 1, dtype=np.int32).reshape((nt,) + (1,) * (hot.ndim - 1))
+
+    # 前向游程长度：当前时刻距最近一个非热浪时刻的步数
+    last_break = np.where(hot, 0, steps)
+    np.maximum.accumulate(last_break, axis=0, out=last_break)
+    run_length = steps - last_break
+
+    # 后向游程长度：在反转的时间轴上做同样的计算
+    last_break = np.where(hot[::-1], 0, steps)
+    np.maximum.accumulate(last_break, axis=0, out=last_break)
+    run_length += (steps - last_break)[::-1]
+
+    # 前向 + 后向 - 1 即该元素所在连续期的总长度
+    return hot & (run_length > min_length)
+
+
+def consecutive_days_filter(mask, min_consecutive_days=3, lat_chunk_size=32):
+    """
+    连续天数筛选的整体向量化实现，按纬度带分块处理以控制内存，结果与逐格点调用
+    find_consecutive_periods 完全一致
+
+    Args:
+        mask: 3D数组 (time, lat, lon)，二值热浪掩码
+        min_consecutive_days: 最小连续天数，默认3天
+        lat_chunk_size: 每次处理的纬度行数
+
+    Returns:
+        filtered_mask: 筛选后的热浪掩码 (uint8)
+    """
+    nt, nlats, nlons = mask.shape
+    filtered_mask = np.zeros((nt, nlats, nlons), dtype=np.uint8)
+
+    for lat_start in range(0, nlats, lat_chunk_size):
+        band = slice(lat_start, min(lat_start + lat_chunk_size, nlats))
+        filtered_mask[:, band, :] = find_consecutive_runs(
+            np.ma.filled(mask[:, band, :], 0), min_consecutive_days
+        )
+
+    return filtered_mask
+
+
+def trailing_run_length(mask, initial=None):
+    """
+    每个格点在时间序列末尾的连续 1 的长度（游程状态），用于在后续时间块或追加的
+    新日期上继续连续天数筛选
+
+    Args:
+        mask: 二值数组 (time, lat, lon)
+        initial: 该段之前的游程长度 (lat, lon)；整段都为 1 的格点在其基础上累加
+
+    Returns:
+        run_length: (lat, lon) int32 数组
+    """
+    hot = mask > 0
+    nt = hot.shape[0]
+    # 末尾第一个非热浪时刻距序列末尾的步数即末尾游程长度；整段为热浪时为 nt
+    all_hot = hot.all(axis=0)
+    run_length = np.where(all_hot, nt, np.argmax(~hot[::-1], axis=0)).astype(np.int32)
+    if initial is not None:
+        run_length += np.where(all_hot, initial, 0).astype(np.int32)
+    return run_length
+
+
+def append_consecutive_days_filter(new_mask, previous_run_length, min_consecutive_days):
+    """
+    在已筛选的序列末尾追加新的日期：根据此前的末尾游程长度更新连续天数筛选，
+    不需要重新读取历史数据
+
+    新日期使此前不足 min_consecutive_days 天的游程达到最小长度时，此前末尾
+    min_consecutive_days - 1 天也要补标为热浪，因此返回的标记包含这几天
+
+    Args:
+        new_mask: 新日期的二值超阈值掩码 (k, lat, lon)
+        previous_run_length: 此前的末尾游程长度 (lat, lon)
+        min_consecutive_days: 最小连续天数
+
+    Returns:
+        marks: (min_consecutive_days - 1 + k, lat, lon) uint8 数组，前
+            min_consecutive_days - 1 行对应此前末尾的日期（与已保存的掩码按位或），
+            其余行为新日期的筛选结果
+        run_length: 追加后的末尾游程长度 (lat, lon)
+    """
+    tail = min_consecutive_days - 1
+    previous_run_length = np.asarray(previous_run_length)
+
+    # 由游程长度还原此前末尾 2 * tail 天的超阈值状态（末尾第 j 天为热浪当且仅当
+    # 游程长度 >= j）。更早开始的游程在这 2 * tail 天内已达到最小长度，截断不影响结果
+    lags = np.arange(2 * tail, 0, -1).reshape(-1, 1, 1)
+    history = previous_run_length[None, :, :] >= lags
+    extended = np.concatenate([history, new_mask > 0], axis=0)
+
+    marks = find_consecutive_runs(extended, min_consecutive_days)[tail:]
+    run_length = trailing_run_length(new_mask, initial=previous_run_length)
+    return marks.astype(np.uint8), run_length
+
+
+# 闰年中每个月第一天之前的累计天数，用于把月/日映射到固定的日历日序号
+_CUMULATIVE_DAYS_LEAP = np.array(
+    [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
+)
+
+# 日历日序号的个数（包含 2 月 29 日）
+N_CALENDAR_DAYS = 366
+
+
+def calendar_day_index(months, days):
+    """
+    把月/日转换为 0-365 的日历日序号。按闰年排布，2 月 29 日单独占一个位置，
+    因此同一月日在所有年份中的序号相同
+
+    Args:
+        months: 月份数组 (1-12)
+        days: 日数组 (1-31)
+
+    Returns:
+        day_index: 与输入同形状的 int16 日历日序号数组
+    """
+    months = np.asarray(months)
+    days = np.asarray(days)
+    return (_CUMULATIVE_DAYS_LEAP[months - 1] + days - 1).astype(np.int16)
+
+
+# 与 numpy.datetime64（公历外推）一致的日历，可以直接用整数运算解码时间轴
+_GREGORIAN_CALENDARS = ("standard", "gregorian", "proleptic_gregorian")
+
+# 时间单位到秒的换算
+_TIME_UNIT_SECONDS = {
+    "seconds": 1,
+    "second": 1,
+    "minutes": 60,
+    "minute": 60,
+    "hours": 3600,
+    "hour": 3600,
+    "days": 86400,
+    "day": 86400,
+}
+
+
+def decode_time_axis(time_values, units, calendar="standard"):
+    """
+    把 NetCDF 时间轴一次性解码为整数的年/月/日/日历日序号数组，之后的季节筛选与
+    同一日历日查找都可以用向量化的布尔掩码完成，不再逐个遍历 cftime 日期对象
+
+    公历类日历直接用 numpy.datetime64 做整数运算；其他日历（noleap、360_day 等）
+    调用一次 num2date 后提取年月日
+
+    Args:
+        time_values: 时间数值数组（或 netCDF 时间变量的 [:]）
+        units: 时间单位，如 "hours since 1900-01-01 00:00:00"
+        calendar: 日历
+
+    Returns:
+        dates: 字典，"year" / "month" / "day" 为 int 数组，"doy" 为 calendar_day_index
+            给出的 int16 日历日序号
+    """
+    time_values = np.asarray(time_values)
+    step = units.split(" since ")[0].strip().lower()
+    if calendar in _GREGORIAN_CALENDARS and step in _TIME_UNIT_SECONDS:
+        ref = num2date(0, units=units, calendar=calendar)
+        ref = np.datetime64(
+            f"{ref.year:04d}-{ref.month:02d}-{ref.day:02d}"
+            f"T{ref.hour:02d}:{ref.minute:02d}:{ref.second:02d}",
+            "s",
+        )
+        seconds = np.round(time_values * _TIME_UNIT_SECONDS[step]).astype(np.int64)
+        moments = ref + seconds.astype("timedelta64[s]")
+        years = moments.astype("datetime64[Y]")
+        month_starts = moments.astype("datetime64[M]")
+        year = years.astype(int) + 1970
+        month = (month_starts - years).astype(int) + 1
+        day = (moments.astype("datetime64[D]") - month_starts).astype(int) + 1
+    else:
+        dates = num2date(time_values, units=units, calendar=calendar)
+        year = np.array([d.year for d in dates])
+        month = np.array([d.month for d in dates])
+        day = np.array([d.day for d in dates])
+
+    return {
+        "year": year,
+        "month": month,
+        "day": day,
+        "doy": calendar_day_index(month, day),
+    }
+
+
+def read_time_axis(time_var):
+    """读取 netCDF 时间变量并用 decode_time_axis 解码"""
+    return decode_time_axis(
+        time_var[:], time_var.units, getattr(time_var, "calendar", "standard")
+    )
+
+
+def season_mask(dates, start_year, end_year, months=(5, 6, 7, 8, 9)):
+    """
+    选出 start_year-end_year 年中指定月份的时间步
+
+    Args:
+        dates: decode_time_axis 返回的日期字典
+        start_year, end_year: 年份范围（包含两端）
+        months: 月份
+
+    Returns:
+        mask: 布尔数组
+    """
+    return (
+        (dates["year"] >= start_year)
+        & (dates["year"] <= end_year)
+        & np.isin(dates["month"], months)
+    )
+
+
+def date_string(dates, index):
+    """返回第 index 个时间步的 YYYYMMDD 字符串"""
+    return (
+        f"{dates['year'][index]:04d}{dates['month'][index]:02d}"
+        f"{dates['day'][index]:02d}"
+    )
+
+
+def calculate_threshold_table(
+    T_clim, clim_day_index, percentile, target_days=None, window_days=0
+):
+    """
+    对气候基准期的每个日历日只计算一次百分位阈值，得到紧凑的 (日历日, lat, lon) 阈值表
+
+    Args:
+        T_clim: 3D数组 (time, lat, lon)，气候基准期温度；也可以直接传入 netCDF 变量，
+            此时每个日历日只读取对应的时间切片（经 read_variable 读为普通 float32 数组）
+        clim_day_index: T_clim 每个时间步的日历日序号（见 calendar_day_index）
+        percentile: 百分位（如 90）
+        target_days: 需要计算阈值的日历日序号，默认为基准期中出现的全部日历日
+        window_days: 滑动窗口半宽（天）。0 表示只用同一日历日的样本；例如 7 表示用
+            前后各 7 天（共 15 个日历日）的全部样本，见 calculate_windowed_threshold_table
+
+    Returns:
+        threshold_table: 3D数组 (N_CALENDAR_DAYS, lat, lon)，float32，没有样本的日历日为 NaN
+    """
+    if window_days > 0:
+        return calculate_windowed_threshold_table(
+            T_clim, clim_day_index, percentile, window_days, target_days
+        )
+
+    _, nlats, nlons = T_clim.shape
+    threshold_table = np.full((N_CALENDAR_DAYS, nlats, nlons), np.nan, dtype=np.float32)
+
+    clim_day_index = np.asarray(clim_day_index)
+    if target_days is None:
+        target_days = clim_day_index
+    for day in np.unique(target_days):
+        clim_days = np.where(clim_day_index == day)[0]
+        if len(clim_days) == 0:
+            continue
+        threshold_table[day] = np.percentile(
+            read_variable(T_clim, clim_days), percentile, axis=0
+        )
+
+    return threshold_table
+
+
+def _window_keys(values):
+    """
+    把 (ncells, k) 的 float32 样本编码为 uint64 排序键：高 32 位为格点序号，低 32 位为
+    保序变换后的浮点位模式。所有格点的有序样本因此可以放在一个全局有序的一维数组中，
+    用一次 np.searchsorted 同时完成所有格点的查找
+    """
+    ncells = values.shape[0]
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    # 负数翻转全部位，非负数翻转符号位，使无符号整数顺序与浮点数顺序一致
+    flip = np.where(bits >> 31, np.uint32(0xFFFFFFFF), np.uint32(0x80000000))
+    cells = np.arange(ncells, dtype=np.uint64)[:, None] << np.uint64(32)
+    return np.sort((cells | (bits ^ flip).astype(np.uint64)).ravel())
+
+
+def _window_values(keys):
+    """_window_keys 的逆变换，返回 float32 样本值"""
+    ordered = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    flip = np.where(ordered >> 31, np.uint32(0x80000000), np.uint32(0xFFFFFFFF))
+    return (ordered ^ flip).view(np.float32)
+
+
+def calculate_windowed_threshold_table(
+    T_clim, clim_day_index, percentile, window_days, target_days=None
+):
+    """
+    滑动窗口百分位阈值：日历日 d 的阈值取基准期中 [d - window_days, d + window_days]
+    （按 366 天循环）内全部样本的百分位。
+
+    所有格点窗口内的样本编码为一个全局有序的排序键数组（见 _window_keys），窗口每滑动
+    一天只删除移出日的样本、把移入日的样本按二分查找的位置插入，不对窗口内全部样本重新
+    排序。百分位按与 np.percentile 默认方式相同的线性插值从有序样本中直接取出；窗口内
+    有 NaN 的格点结果为 NaN（与 np.percentile 一致）
+
+    Args:
+        T_clim: 3D数组 (time, lat, lon) 或 netCDF 变量，气候基准期温度
+        clim_day_index: T_clim 每个时间步的日历日序号
+        percentile: 百分位（如 90）
+        window_days: 窗口半宽（天），如 7 或 15
+        target_days: 需要计算阈值的日历日序号，默认为基准期中出现的全部日历日
+
+    Returns:
+        threshold_table: 3D数组 (N_CALENDAR_DAYS, lat, lon)，float32
+    """
+    _, nlats, nlons = T_clim.shape
+    ncells = nlats * nlons
+    threshold_table = np.full((N_CALENDAR_DAYS, nlats, nlons), np.nan, dtype=np.float32)
+
+    clim_day_index = np.asarray(clim_day_index)
+    if target_days is None:
+        target_days = clim_day_index
+    target_days = np.unique(target_days)
+
+    # 窗口内各日历日的样本 (ncells, nyears)；NaN 记入计数并以 +inf 参与排序
+    samples_in_window = {}
+
+    def day_samples(day):
+        idx = np.where(clim_day_index == day % N_CALENDAR_DAYS)[0]
+        if len(idx) == 0:
+            return np.empty((ncells, 0), dtype=np.float32)
+        samples = read_variable(T_clim, idx)
+        return samples.reshape(len(idx), ncells).T
+
+    def sortable(samples):
+        return np.where(np.isnan(samples), np.float32(np.inf), samples)
+
+    # 所有格点窗口内样本的排序键，全局有序，即每个格点的样本按格点序号连续、升序存放
+    sorted_keys = None
+    nan_count = None
+    previous_day = None
+    for day in target_days:
+        if previous_day is None or day - previous_day > 2 * window_days + 1:
+            # 第一个目标日，或与上一个目标日相距超过窗口宽度：重新建立窗口
+            samples_in_window = {
+                d: day_samples(d)
+                for d in range(day - window_days, day + window_days + 1)
+            }
+            window = np.concatenate(list(samples_in_window.values()), axis=1)
+            nan_count = np.sum(np.isnan(window), axis=1)
+            sorted_keys = _window_keys(sortable(window))
+        else:
+            # 逐日滑动窗口：删除移出日的样本，把移入日的样本归并插入，不整体重排
+            for d in range(previous_day + 1, day + 1):
+                leaving = samples_in_window.pop(d - window_days - 1)
+                entering = day_samples(d + window_days)
+                samples_in_window[d + window_days] = entering
+                if leaving.shape[1] > 0:
+                    nan_count -= np.sum(np.isnan(leaving), axis=1)
+                    leaving_keys = _window_keys(sortable(leaving))
+                    # 相等的键要删除不同的位置：第一个相等元素的位置 + 在相等键中的序号
+                    positions = np.searchsorted(sorted_keys, leaving_keys)
+                    positions += np.arange(len(leaving_keys)) - np.searchsorted(
+                        leaving_keys, leaving_keys
+                    )
+                    sorted_keys = np.delete(sorted_keys, positions)
+                if entering.shape[1] > 0:
+                    nan_count += np.sum(np.isnan(entering), axis=1)
+                    entering_keys = _window_keys(sortable(entering))
+                    sorted_keys = np.insert(
+                        sorted_keys,
+                        np.searchsorted(sorted_keys, entering_keys),
+                        entering_keys,
+                    )
+        previous_day = day
+
+        # 从有序样本中按与 np.percentile 默认方式相同的线性插值取百分位
+        n = len(sorted_keys) // ncells
+        if n == 0:
+            continue
+        rank = percentile / 100.0 * (n - 1)
+        lower = int(np.floor(rank))
+        upper = min(lower + 1, n - 1)
+        fraction = rank - lower
+        sorted_samples = sorted_keys.reshape(ncells, n)
+        low_values = _window_values(sorted_samples[:, lower]).astype(np.float64)
+        high_values = _window_values(sorted_samples[:, upper]).astype(np.float64)
+        with np.errstate(invalid="ignore"):
+            values = low_values + (high_values - low_values) * fraction
+        values[nan_count > 0] = np.nan
+        threshold_table[day % N_CALENDAR_DAYS] = values.reshape(nlats, nlons)
+
+    return threshold_table
+
+
+def threshold_cache_key(
+    clim_path, var_name, percentile, window_days, target_days, hash_content=False
+):
+    """
+    生成阈值缓存的键。键由气候基准文件的身份（绝对路径、大小、修改时间，或可选的
+    大小与文件内容哈希）、变量名、百分位、窗口半宽以及需要计算的日历日集合共同决定
+
+    Args:
+        clim_path: 气候基准期文件路径
+        var_name: 温度变量名
+        percentile: 百分位
+        window_days: 阈值滑动窗口半宽（天）
+        target_days: 需要计算阈值的日历日序号
+        hash_content: True 时用文件内容的 SHA-1 代替路径和修改时间（文件被复制、移动或
+            touch 后仍能命中）
+
+    Returns:
+        key: 十六进制字符串
+    """
+    stat = os.stat(clim_path)
+    identity = {
+        "size": stat.st_size,
+        "var_name": var_name,
+        "percentile": float(percentile),
+        "window_days": int(window_days),
+        "target_days": np.unique(target_days).astype(int).tolist(),
+    }
+    if hash_content:
+        content_hash = hashlib.sha1()
+        with open(clim_path, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                content_hash.update(block)
+        identity["content_sha1"] = content_hash.hexdigest()
+    else:
+        identity["path"] = os.path.abspath(clim_path)
+        identity["mtime_ns"] = stat.st_mtime_ns
+
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_threshold_table(cache_dir, key):
+    """
+    从缓存目录读取阈值表
+
+    Returns:
+        threshold_table: (N_CALENDAR_DAYS, lat, lon) 阈值表；未命中时返回 None
+    """
+    cache_file = os.path.join(cache_dir, f"thresholds_{key}.npz")
+    if not os.path.exists(cache_file):
+        return None
+
+    with np.load(cache_file) as cached:
+        days = cached["days"]
+        thresholds = cached["thresholds"]
+    threshold_table = np.full(
+        (N_CALENDAR_DAYS,) + thresholds.shape[1:], np.nan, dtype=np.float32
+    )
+    threshold_table[days] = thresholds
+    return threshold_table
+
+
+def save_cached_threshold_table(cache_dir, key, threshold_table):
+    """
+    把阈值表写入缓存目录。只保存有阈值的日历日行（days + thresholds 两个数组），
+    先写临时文件再重命名，避免并发运行读到写了一半的缓存
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    days = np.where(np.any(np.isfinite(threshold_table), axis=(1, 2)))[0]
+    cache_file = os.path.join(cache_dir, f"thresholds_{key}.npz")
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_file,
+        days=days.astype(np.int16),
+        thresholds=threshold_table[days].astype(np.float32),
+    )
+    os.replace(tmp_file, cache_file)
+    return cache_file
+
+
+def exceeds_threshold(T_actual, threshold_table, day_index, block_size=366):
+    """
+    按日历日查阈值表，生成二值超阈值掩码，分时间块计算以避免构造完整的阈值立方体
+
+    Args:
+        T_actual: 3D数组 (time, lat, lon)，实际温度
+        threshold_table: (N_CALENDAR_DAYS, lat, lon) 阈值表
+        day_index: T_actual 每个时间步的日历日序号
+        block_size: 每次比较的时间步数
+
+    Returns:
+        mask: 与 T_actual 同形状的 uint8 掩码，超过阈值为 1
+    """
+    nt = T_actual.shape[0]
+    mask = np.zeros(T_actual.shape, dtype=np.uint8)
+    for start in range(0, nt, block_size):
+        block = slice(start, min(start + block_size, nt))
+        mask[block] = T_actual[block] > threshold_table[day_index[block]]
+    return mask
+
+
+CHUNK_PRESETS = ("map", "timeseries", "balanced")
+
+
+def output_chunk_sizes(preset, shape, itemsize, target_bytes=1024**2):
+    """
+    按访问模式为 (time, lat, lon) 变量选择 NetCDF 分块形状
+
+    - "map": 每块一个时间步的完整地图，逐日读取（聚类阶段）只解压需要的日期
+    - "timeseries": 每块包含全部时间步的一小片空间区域，读取格点时间序列（筛选验证）最快
+    - "balanced": 时间与空间都切分，每块约一个月，两种读取方式都不会解压过多无关数据
+
+    Args:
+        preset: "map" / "timeseries" / "balanced"
+        shape: 变量形状 (time, lat, lon)
+        itemsize: 每个元素的字节数
+        target_bytes: "timeseries" / "balanced" 每块的目标字节数
+
+    Returns:
+        chunksizes: (time, lat, lon) 分块形状
+    """
+    nt, nlats, nlons = shape
+    if preset == "map":
+        return (1, nlats, nlons)
+    if preset == "timeseries":
+        chunk_days = nt
+    elif preset == "balanced":
+        chunk_days = min(nt, 31)
+    else:
+        raise ValueError(f"未知的分块方案: {preset}，可选 {CHUNK_PRESETS}")
+
+    # 空间上取近似正方形的分块，使每块约 target_bytes
+    side = int(np.sqrt(max(1, target_bytes // (itemsize * max(1, chunk_days)))))
+    side = max(1, side)
+    return (max(1, chunk_days), min(nlats, side), min(nlons, side))
+
+
+def read_variable(var, index=slice(None), dtype=np.float32):
+    """
+    读取 netCDF 变量（或其切片）为连续的普通 ndarray，不经过 numpy.ma 掩码数组。
+
+    读取时关闭 netCDF4 的自动掩码与缩放，在原始值上一次性识别缺测值
+    （_FillValue / missing_value，两者都没有时用 netCDF 默认填充值），再手动应用
+    scale_factor / add_offset，缺测值置为 NaN。后续的相减、比较与百分位计算都走普通
+    ndarray 的快速路径
+
+    Args:
+        var: netCDF 变量；也可以是 ndarray / MaskedArray（掩码值置为 NaN）
+        index: 切片或索引，与 var[index] 相同
+        dtype: 输出的浮点类型；为 None 时按原始类型返回，不做缺测与缩放处理
+            （用于 heatwave_mask、doy_index 等整数变量）
+
+    Returns:
+        data: C 连续的 ndarray
+    """
+    if not hasattr(var, "set_auto_maskandscale"):
+        data = var[index]
+        if dtype is None:
+            return np.ascontiguousarray(np.ma.getdata(data))
+        if np.ma.isMaskedArray(data):
+            data = np.ma.filled(data.astype(dtype), np.nan)
+        return np.ascontiguousarray(data, dtype=dtype)
+
+    auto_mask, auto_scale = getattr(var, "mask", True), getattr(var, "scale", True)
+    var.set_auto_maskandscale(False)
+    try:
+        raw = var[index]
+    finally:
+        var.set_auto_mask(auto_mask)
+        var.set_auto_scale(auto_scale)
+    if dtype is None:
+        return np.ascontiguousarray(raw)
+
+    attrs = var.ncattrs()
+    fill_values = [
+        np.asarray(var.getncattr(name)).ravel()
+        for name in ("_FillValue", "missing_value")
+        if name in attrs
+    ]
+    if not fill_values and raw.dtype.str[1:] in default_fillvals:
+        fill_values = [np.array([default_fillvals[raw.dtype.str[1:]]])]
+    missing = np.zeros(raw.shape, dtype=bool)
+    for fill_value in np.concatenate(fill_values) if fill_values else []:
+        missing |= raw == fill_value
+    if np.issubdtype(raw.dtype, np.floating):
+        missing |= np.isnan(raw)
+
+    data = raw.astype(dtype)
+    if "scale_factor" in attrs:
+        data *= dtype(var.getncattr("scale_factor"))
+    if "add_offset" in attrs:
+        data += dtype(var.getncattr("add_offset"))
+    data[missing] = np.nan
+    return np.ascontiguousarray(data)
+
+
+def read_time_steps(var, time_indices, dtype=np.float32):
+    """
+    只读取指定时间步：把递增的时间索引合并为连续区间，逐段切片读取后拼接，
+    避免读入整个变量再筛选。每段通过 read_variable 读取为普通 ndarray
+
+    Args:
+        var: NetCDF 变量或数组，第一维为时间
+        time_indices: 递增的时间索引
+        dtype: 同 read_variable
+
+    Returns:
+        data: (len(time_indices), ...) 数组
+    """
+    time_indices = np.asarray(time_indices, dtype=np.int64)
+    if time_indices.size == 0:
+        return read_variable(var, slice(0, 0), dtype)
+    breaks = np.where(np.diff(time_indices) != 1)[0] + 1
+    starts = time_indices[np.r_[0, breaks]]
+    stops = time_indices[np.r_[breaks - 1, time_indices.size - 1]] + 1
+    pieces = [
+        read_variable(var, slice(start, stop), dtype)
+        for start, stop in zip(starts, stops)
+    ]
+    if len(pieces) == 1:
+        return pieces[0]
+    return np.concatenate(pieces)
+
+
 #############################################################################################################
 ####################################### IDENTIFYING DROUGHT CLUSTERS  #######################################
 #############################################################################################################
 
 
-def median_filter(data_matrix):
+def median_filter(data_matrix, periodic_bool=False):
     """
-    This function applies a median filter on a 2D matrix, presumeably a map.
+    This function applies a median filter on a 2D matrix, presumeably a map, or on every map of a 3D
+    block of maps at once. Each real-valued grid cell is replaced by the median of the real values of its
+    8 surrounding grid cells (isolated grid cells keep their value and NaN grid cells stay NaN).
 
     Argument:
-    - data_matrix: 2D matrix (lat, lon) of percentile values for a given time step.
+    - data_matrix: 2D matrix (lat, lon) of percentile values for a given time step, or 3D matrix
+                   (time, lat, lon) of several time steps that are filtered independently.
+    - periodic_bool: Boolean variable, True if the left/right edges of the maps are periodic.
 
     Return:
-    - filtered_matrix: 2D matrix of the same dimensions and orientation as the input
+    - filtered_matrix: Matrix of the same dimensions and orientation as the input
                        but smoothed out by the median filter.
     """
 
-    # Dimensions
-    n, m = data_matrix.shape
-
-    # Initialize matrix where results will be stored
-    filtered_matrix = np.zeros([n, m])
-
-    # Loop through each grid cell
-    for i in range(0, n):
-        for j in range(0, m):
-
-            # Check if grid cell has a real value
-            if np.isnan(data_matrix[i, j]) == False:
-
-                # Check all the surrounding grid cells
-                window_values = []
-                if i < n - 1:
-                    window_values.append(data_matrix[i + 1, j])
-                if j < m - 1:
-                    window_values.append(data_matrix[i, j + 1])
-                if i < n - 1 and j < m - 1:
-                    window_values.append(data_matrix[i + 1, j + 1])
-                if i > 0:
-                    window_values.append(data_matrix[i - 1, j])
-                if j > 0:
-                    window_values.append(data_matrix[i, j - 1])
-                if i > 0 and j > 0:
-                    window_values.append(data_matrix[i - 1, j - 1])
-                if i < n - 1 and j > 0:
-                    window_values.append(data_matrix[i + 1, j - 1])
-                if i > n and j < m - 1:
-                    window_values.append(data_matrix[i - 1, j + 1])
-
-                # Mask any nans that might have been picked up
-                window_values = np.array(window_values)
-                window_values = window_values[~np.isnan(window_values)]
-
-                # Check if grid cell is isolated, otherwise apply filter
-                if len(window_values) == 0:
-                    filtered_matrix[i, j] = data_matrix[i, j]
-                else:
-                    filtered_matrix[i, j] = np.median(window_values)
-            else:
+    data_matrix = np.asarray(data_matrix)
+    n, m = data_matrix.shape[-2:]
+
+    # Surround the maps with NaN so that the neighbours outside the map are ignored; with periodic
+    # edges the first and last columns are neighbours of each other
+    padding = [(0, 0)] * (data_matrix.ndim - 2) + [(1, 1), (1, 1)]
+    padded = np.pad(data_matrix, padding, mode="constant", constant_values=np.nan)
+    if periodic_bool:
+        padded[..., 1:-1, 0] = data_matrix[..., -1]
+        padded[..., 1:-1, -1] = data_matrix[..., 0]
+
+    # The 8 neighbours of every grid cell, sorted with the NaNs last
+    window_values = np.stack(
+        [
+            padded[..., 1 + di : 1 + di + n, 1 + dj : 1 + dj + m]
+            for di in (-1, 0, 1)
+            for dj in (-1, 0, 1)
+            if (di, dj) != (0, 0)
+        ]
+    )
+    window_values.sort(axis=0)
+    nvalid = np.count_nonzero(~np.isnan(window_values), axis=0)
+
+    # Median of the real neighbours: mean of the two middle values (the same one if nvalid is odd)
+    lower = np.take_along_axis(
+        window_values, np.maximum((nvalid - 1) // 2, 0)[np.newaxis], axis=0
+    )[0]
+    upper = np.take_along_axis(window_values, (nvalid // 2)[np.newaxis], axis=0)[0]
+    median = (lower + upper) / 2
 
-                filtered_matrix[i, j] = np.nan
+    # Isolated grid cells keep their value, NaN grid cells stay NaN
+    filtered_matrix = np.where(nvalid > 0, median, data_matrix).astype(np.float64)
+    filtered_matrix[np.isnan(data_matrix)] = np.nan
 
     return filtered_matrix
 
@@ -371,7 +985,101 @@ def find_gridcell_area(center_lon, center_lat, resolution_lon, resolution_lat):
     return area
 
 
-def find_cluster_area(coordinates, lons, lats, resolution_lon, resolution_lat):
+class GridGeometry:
+    """
+    Geometry of a regular lon/lat grid that only has to be computed once per grid: the area of the
+    grid cells of each row (km^2), cos-latitude weights and the unit vectors of the cell centres on
+    the sphere. Instances are memoized per grid in memory and can be cached on disk as .npz files.
+
+    Attributes:
+    - lons, lats: 1D arrays of longitudes and latitudes in degrees (float64)
+    - resolution_lon, resolution_lat: Resolution of the grid in degrees
+    - row_area: 1D array (lat,) with the area in km^2 of one grid cell of each row
+    - coslat: 1D array (lat,) with the cosine of the latitude of each row
+    - unit_vectors: 3D array (lat, lon, 3) with the Cartesian unit vector of each cell centre
+    """
+
+    _memo = {}
+
+    def __init__(self, lons, lats, resolution_lon, resolution_lat):
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.resolution_lon = float(resolution_lon)
+        self.resolution_lat = float(resolution_lat)
+
+        # The area of a grid cell only depends on its latitude
+        self.row_area = find_gridcell_area(
+            0.0, self.lats, self.resolution_lon, self.resolution_lat
+        )
+
+        lat_rad = np.deg2rad(self.lats)
+        lon_rad = np.deg2rad(self.lons)
+        self.coslat = np.cos(lat_rad)
+        self.unit_vectors = np.stack(
+            np.broadcast_arrays(
+                self.coslat[:, None] * np.cos(lon_rad)[None, :],
+                self.coslat[:, None] * np.sin(lon_rad)[None, :],
+                np.sin(lat_rad)[:, None],
+            ),
+            axis=-1,
+        )
+
+    @staticmethod
+    def grid_key(lons, lats, resolution_lon, resolution_lat):
+        """Hash identifying a grid by its coordinates and resolution."""
+        key = hashlib.sha1()
+        key.update(np.asarray(lons, dtype=np.float64).tobytes())
+        key.update(np.asarray(lats, dtype=np.float64).tobytes())
+        resolution = np.array([resolution_lon, resolution_lat], dtype=np.float64)
+        key.update(resolution.tobytes())
+        return key.hexdigest()
+
+    @classmethod
+    def cached(cls, lons, lats, resolution_lon, resolution_lat, cache_dir=None):
+        """
+        Returns the geometry of the given grid, built only once per process. If cache_dir is given,
+        the tables are read from (or written to) cache_dir/grid_<key>.npz.
+        """
+        key = cls.grid_key(lons, lats, resolution_lon, resolution_lat)
+        if key in cls._memo:
+            return cls._memo[key]
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, f"grid_{key}.npz")
+        if cache_file is not None and os.path.exists(cache_file):
+            geometry = cls.__new__(cls)
+            with np.load(cache_file) as cached:
+                for name in ("lons", "lats", "row_area", "coslat", "unit_vectors"):
+                    setattr(geometry, name, cached[name])
+                geometry.resolution_lon, geometry.resolution_lat = cached["resolution"]
+        else:
+            geometry = cls(lons, lats, resolution_lon, resolution_lat)
+            if cache_file is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+                np.savez(
+                    tmp_file,
+                    lons=geometry.lons,
+                    lats=geometry.lats,
+                    resolution=[geometry.resolution_lon, geometry.resolution_lat],
+                    row_area=geometry.row_area,
+                    coslat=geometry.coslat,
+                    unit_vectors=geometry.unit_vectors,
+                )
+                os.replace(tmp_file, cache_file)
+
+        cls._memo[key] = geometry
+        return geometry
+
+    def cell_area(self, rows):
+        """Area in km^2 of the grid cells in the given rows."""
+        return self.row_area[rows]
+
+
+def find_cluster_area(
+    coordinates, lons, lats, resolution_lon, resolution_lat, geometry=None
+):
     """
     This function calculates the area of a cluster by adding the areas of the individual grid cells.
 
@@ -380,33 +1088,21 @@ def find_cluster_area(coordinates, lons, lats, resolution_lon, resolution_lat):
     - lons: 1D array of longitudes for the data_matrix
     - lats: 1D array of latitudes for the data_matrix
     - resolution_lon, resolution_lat: Resolution of the dataset in the longitudinal and latitudinal directions (e.g. 0.5 degrees)
+    - geometry: GridGeometry of the grid (optional, built from the other arguments if not given)
 
     Returns:
     - running_sum: Estimated area of the given drought cluster (km^2)
     """
 
-    # Number of grid cells
-    n = len(coordinates)
-
-    # Initialize running sum
-    running_sum = 0
+    if len(coordinates) == 0:
+        return 0.0
 
-    # Go through each coordinate set
-    for i in range(0, n):
-        # Obtain lon and lat
-        center_lat_idx, center_lon_idx = coordinates[i]
-        center_lat = lats[center_lat_idx]
-        center_lon = lons[center_lon_idx]
+    if geometry is None:
+        geometry = GridGeometry.cached(lons, lats, resolution_lon, resolution_lat)
 
-        # Calculate area
-        area = find_gridcell_area(
-            center_lon, center_lat, resolution_lon, resolution_lat
-        )
-
-        # Update running sum
-        running_sum = running_sum + area
-
-    return running_sum
+    # Add the precomputed areas of the rows of every grid cell
+    center_lat_idx = np.asarray(coordinates)[:, 0]
+    return np.sum(geometry.cell_area(center_lat_idx))
 
 
 def find_weighed_centroid(lats_array, lons_array, intensities, lons, lats):
@@ -514,11 +1210,373 @@ def find_weighed_centroid(lats_array, lons_array, intensities, lons, lats):
         else:
             centroid_lon = centroid_lon_temp + lon_shift
 
-    return centroid_lat, centroid_lon
+    return centroid_lat, centroid_lon
+
+
+def weighted_centroids(
+    pixel_labels, cluster_count, idx_lat, idx_lon, weights, lons, lats
+):
+    """
+    Finds the weighted centroids of all clusters at once. The latitude is the weighted mean latitude
+    and, as in find_weighed_centroid, the longitude is the plain weighted mean of the pixel longitudes.
+    Only clusters that wrap around the edge of a global grid (pixels in both the first and the last
+    column) have their longitudes unwrapped first, around the circular mean longitude of the cluster
+    weighted by the magnitude of the weights, so they get a centroid inside the cluster without the
+    per-cluster histograms of find_weighed_centroid. Clusters that cover a whole row of the grid (the
+    "polar" case of find_weighed_centroid) keep the plain weighted mean as well. The weights may be
+    negative (e.g. 1 - temperature difference); the unwrapping only uses their magnitude.
+
+    Arguments:
+    - pixel_labels: 1D int array with the cluster (0..cluster_count - 1) of each pixel.
+    - cluster_count: Number of clusters.
+    - idx_lat, idx_lon: 1D arrays with the row and column indices of each pixel.
+    - weights: 1D array with the weight (e.g. the intensity) of each pixel.
+    - lons: 1D array of longitudes in degrees.
+    - lats: 1D array of latitudes in degrees.
+
+    Returns:
+    - centroid_lon, centroid_lat: 1D float64 arrays of length cluster_count (NaN for clusters whose
+                                  weights add up to zero), with the longitudes of wrapping clusters
+                                  in the range [min(lons), min(lons) + 360).
+    """
+
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    idx_lon = np.asarray(idx_lon)
+    lons_array = lons[idx_lon]
+    lats_array = lats[idx_lat]
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Only a grid that spans the whole globe can have clusters wrapping around its edge
+    nlons = len(lons)
+    if nlons > 1:
+        spacing = (np.max(lons) - np.min(lons)) / (nlons - 1)
+        global_grid = np.max(lons) - np.min(lons) + 1.5 * spacing >= 360
+    else:
+        global_grid = False
+
+    unwrapped = lons_array
+    wraps = np.zeros(cluster_count, dtype=bool)
+    if global_grid:
+        # Clusters with pixels in both the first and the last column of the grid
+        wraps = (
+            np.bincount(pixel_labels, weights=idx_lon == 0, minlength=cluster_count) > 0
+        )
+        wraps &= (
+            np.bincount(
+                pixel_labels, weights=idx_lon == nlons - 1, minlength=cluster_count
+            )
+            > 0
+        )
+
+        # Clusters covering a whole row of the grid have no meaningful circular mean
+        nlats = len(lats)
+        row_counts = np.bincount(
+            pixel_labels * nlats + idx_lat, minlength=cluster_count * nlats
+        ).reshape(cluster_count, nlats)
+        wraps &= ~(row_counts >= nlons).any(axis=1)
+
+        if wraps.any():
+            # Circular mean longitude of each cluster, weighted by the magnitude of the weights
+            magnitude = np.abs(weights)
+            lon_rad = np.deg2rad(lons_array)
+            mean_direction = np.rad2deg(
+                np.arctan2(
+                    np.bincount(
+                        pixel_labels,
+                        weights=magnitude * np.sin(lon_rad),
+                        minlength=cluster_count,
+                    ),
+                    np.bincount(
+                        pixel_labels,
+                        weights=magnitude * np.cos(lon_rad),
+                        minlength=cluster_count,
+                    ),
+                )
+            )
+
+            # Unwrap the longitudes of the wrapping clusters into [mean - 180, mean + 180)
+            turns = np.floor((lons_array - mean_direction[pixel_labels] + 180) / 360)
+            turns[~wraps[pixel_labels]] = 0
+            unwrapped = np.where(turns != 0, lons_array - 360 * turns, lons_array)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total_weight = np.bincount(
+            pixel_labels, weights=weights, minlength=cluster_count
+        )
+        centroid_lon = (
+            np.bincount(
+                pixel_labels, weights=weights * unwrapped, minlength=cluster_count
+            )
+            / total_weight
+        )
+        centroid_lat = (
+            np.bincount(
+                pixel_labels, weights=weights * lats_array, minlength=cluster_count
+            )
+            / total_weight
+        )
+
+    # Centroids of wrapping clusters back to the longitude range of the grid
+    if wraps.any():
+        lon_min = np.min(lons)
+        centroid_lon = np.where(
+            wraps & (centroid_lon < lon_min),
+            centroid_lon + 360,
+            np.where(
+                wraps & (centroid_lon >= lon_min + 360),
+                centroid_lon - 360,
+                centroid_lon,
+            ),
+        )
+
+    return centroid_lon, centroid_lat
+
+
+def label_clusters(mask, periodic_bool):
+    """
+    Labels the 8-connected clusters of a 2D boolean mask in near-linear time. The mask is first
+    split into horizontal runs of consecutive True pixels, the runs touching each other in adjacent
+    rows (including diagonally) are merged with a union-find structure, and every pixel takes the
+    label of its run's cluster.
+
+    Arguments:
+    - mask: 2D boolean matrix (lat, lon), True for the pixels to be clustered.
+    - periodic_bool: Boolean variable, True if the left/right edges of the array are periodic.
+
+    Returns:
+    - labels: 2D int32 matrix with 0 for the background and 1..cluster_count for the clusters. Labels
+              follow the row-major order of each cluster's first pixel, which is the same order in which
+              find_drought_clusters seeds its clusters.
+    - cluster_count: Number of clusters.
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+    return _label_stacked_rows(mask, periodic_bool, mask.shape[0])
+
+
+def label_clusters_batch(masks, periodic_bool):
+    """
+    Labels the 8-connected clusters of every day of a (day, lat, lon) block in a single pass. The
+    days are stacked along the rows and labeled as in label_clusters, without connecting the last
+    row of one day to the first row of the next.
+
+    Arguments:
+    - masks: 3D boolean matrix (day, lat, lon), True for the pixels to be clustered.
+    - periodic_bool: Boolean variable, True if the left/right edges of the array are periodic.
+
+    Returns:
+    - labels: 3D int32 matrix where each day is labeled exactly as label_clusters would label it
+              (0 for the background, 1..cluster_counts[day] for the clusters).
+    - cluster_counts: 1D int64 array with the number of clusters of each day.
+    """
+
+    masks = np.asarray(masks, dtype=bool)
+    ndays, nlats, nlons = masks.shape
+    stacked, total = _label_stacked_rows(
+        masks.reshape(ndays * nlats, nlons), periodic_bool, nlats
+    )
+    labels = stacked.reshape(ndays, nlats, nlons)
+
+    # Labels are numbered across the whole block in row-major order, so the clusters of each day
+    # are consecutive; the first label of a day is one more than the labels used before it
+    last_label = np.maximum.accumulate(labels.max(axis=(1, 2)).astype(np.int64))
+    offsets = np.concatenate(([0], last_label))[:-1]
+    labels -= np.where(labels > 0, offsets[:, None, None], 0).astype(np.int32)
+
+    return labels, last_label - offsets
+
+
+def _label_stacked_rows(mask, periodic_bool, rows_per_image):
+    """
+    Run-based union-find labeling of a 2D mask made of images of rows_per_image rows stacked along
+    the first axis (see label_clusters). Rows of different images are never connected and labels are
+    numbered in row-major order over the whole stack.
+    """
+
+    nrows, nlons = mask.shape
+    labels = np.zeros((nrows, nlons), dtype=np.int32)
+
+    # Horizontal runs: a run starts at every True pixel whose left neighbour is False. Runs are
+    # numbered in row-major order of their first pixel and each masked pixel gets its run number
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    nruns = np.count_nonzero(starts)
+    if nruns == 0:
+        return labels, 0
+    run_of_pixel = (np.cumsum(starts.ravel()) - 1).reshape(nrows, nlons)
+
+    # Row r + 1 is only a neighbour of row r within the same image
+    same_image = (np.arange(1, nrows) % rows_per_image != 0)[:, None]
+
+    # Pairs of runs that touch: pixels in adjacent rows (vertical and diagonal neighbours) and,
+    # for periodic grids, pixels on the left and right edges of the same or adjacent rows
+    edges = []
+    for shift in (-1, 0, 1):
+        # upper[r, c] is the neighbour of pixel (r + 1, c) at column c - shift in the row above
+        upper = np.roll(mask[:-1], shift, axis=1)
+        upper_runs = np.roll(run_of_pixel[:-1], shift, axis=1)
+        if not periodic_bool and shift != 0:
+            # Without periodicity the column rolled over the edge has no neighbour
+            upper[:, 0 if shift > 0 else -1] = False
+        touching = mask[1:] & upper & same_image
+        edges.append((run_of_pixel[1:][touching], upper_runs[touching]))
+    if periodic_bool and nlons > 1:
+        wrapped = mask[:, 0] & mask[:, -1]
+        edges.append((run_of_pixel[wrapped, 0], run_of_pixel[wrapped, -1]))
+    run_a = np.concatenate([a for a, _ in edges])
+    run_b = np.concatenate([b for _, b in edges])
+    pairs = np.unique(np.minimum(run_a, run_b) * nruns + np.maximum(run_a, run_b))
+
+    # Union-find over the runs; the root of each set is its smallest run number
+    parent = list(range(nruns))
+
+    def find_root(run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    for pair in pairs.tolist():
+        root_a = find_root(pair // nruns)
+        root_b = find_root(pair % nruns)
+        if root_a < root_b:
+            parent[root_b] = root_a
+        elif root_b < root_a:
+            parent[root_a] = root_b
+
+    roots = np.array([find_root(run) for run in range(nruns)])
+    cluster_roots, label_of_run = np.unique(roots, return_inverse=True)
+    labels[mask] = label_of_run[run_of_pixel[mask]] + 1
+
+    return labels, len(cluster_roots)
+
+
+def cluster_statistics(
+    labels,
+    cluster_count,
+    values,
+    lons,
+    lats,
+    resolution_lon,
+    resolution_lat,
+    geometry=None,
+):
+    """
+    Computes the characteristics of all the clusters of a time step in one vectorized pass over the
+    label image, using grouped reductions (np.bincount / np.ufunc.reduceat) instead of per-pixel loops.
+
+    Arguments:
+    - labels: 2D int matrix (lat, lon) with 0 for the background and 1..cluster_count for the clusters
+              (see label_clusters).
+    - cluster_count: Number of clusters.
+    - values: 2D matrix (lat, lon) of pixel values (e.g. the intensities); used for the mean/standard
+              deviation and as weights of the centroid.
+    - lons: 1D array of longitudes in degrees. These must be in the form (-180,180) and NOT in the form (0, 360)
+    - lats: 1D array of latitudes in degrees
+    - resolution_lon, resolution_lat: Resolution of the dataset in the longitudinal and latitudinal directions (e.g. 0.5 degrees)
+    - geometry: GridGeometry of the grid (optional, built from the other arguments if not given)
+
+    Returns:
+    - stats: Dictionary of 1D arrays of length cluster_count, where element k - 1 belongs to cluster k:
+             "pixel_count", "area" (km^2), "mean", "std", "centroid_lon", "centroid_lat" and the bounding
+             box "row_min", "row_max", "col_min", "col_max" (inclusive indices).
+    """
+
+    # Pixels of all clusters in row-major order, stably grouped by cluster
+    idx_lat, idx_lon = np.where(labels > 0)
+    pixel_labels = labels[idx_lat, idx_lon] - 1
+    order = np.argsort(pixel_labels, kind="stable")
+    idx_lat, idx_lon, pixel_labels = idx_lat[order], idx_lon[order], pixel_labels[order]
+    pixel_values = np.asarray(values, dtype=np.float64)[idx_lat, idx_lon]
+
+    return _grouped_statistics(
+        pixel_labels,
+        cluster_count,
+        idx_lat,
+        idx_lon,
+        pixel_values,
+        lons,
+        lats,
+        resolution_lon,
+        resolution_lat,
+        geometry,
+    )
+
+
+def _grouped_statistics(
+    pixel_labels,
+    cluster_count,
+    idx_lat,
+    idx_lon,
+    pixel_values,
+    lons,
+    lats,
+    resolution_lon,
+    resolution_lat,
+    geometry,
+):
+    """
+    Grouped reductions behind cluster_statistics. The pixels (pixel_labels in 0..cluster_count - 1,
+    their row/column indices and float64 values) must be grouped by cluster, in row-major order
+    within each cluster.
+    """
+
+    stats = {}
+    pixel_count = np.bincount(pixel_labels, minlength=cluster_count)
+    stats["pixel_count"] = pixel_count
+
+    # The area of a grid cell only depends on its latitude
+    if geometry is None:
+        geometry = GridGeometry.cached(lons, lats, resolution_lon, resolution_lat)
+    stats["area"] = np.bincount(
+        pixel_labels, weights=geometry.cell_area(idx_lat), minlength=cluster_count
+    )
+
+    # Mean and (population) standard deviation, the latter in a second pass around the mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (
+            np.bincount(pixel_labels, weights=pixel_values, minlength=cluster_count)
+            / pixel_count
+        )
+        squares = (pixel_values - mean[pixel_labels]) ** 2
+        std = np.sqrt(
+            np.bincount(pixel_labels, weights=squares, minlength=cluster_count)
+            / pixel_count
+        )
+    stats["mean"] = mean
+    stats["std"] = std
+
+    # Weighted centroid, wrap-aware for clusters crossing the edge of the map
+    centroid_lon, centroid_lat = weighted_centroids(
+        pixel_labels, cluster_count, idx_lat, idx_lon, pixel_values, lons, lats
+    )
+
+    # Bounding boxes
+    if cluster_count > 0:
+        starts = np.concatenate(([0], np.cumsum(pixel_count)[:-1]))
+        stats["row_min"] = np.minimum.reduceat(idx_lat, starts)
+        stats["row_max"] = np.maximum.reduceat(idx_lat, starts)
+        stats["col_min"] = np.minimum.reduceat(idx_lon, starts)
+        stats["col_max"] = np.maximum.reduceat(idx_lon, starts)
+    else:
+        for key in ("row_min", "row_max", "col_min", "col_max"):
+            stats[key] = np.zeros(0, dtype=np.int64)
+
+    stats["centroid_lon"] = centroid_lon
+    stats["centroid_lat"] = centroid_lat
+
+    return stats
 
 
 def find_drought_clusters(
-    data_matrix, lons, lats, resolution_lon, resolution_lat, periodic_bool
+    data_matrix,
+    lons,
+    lats,
+    resolution_lon,
+    resolution_lat,
+    periodic_bool,
+    geometry=None,
 ):
     """
     This function will find the individual drought clusters for a given time step. Drought clusters
@@ -533,6 +1591,7 @@ def find_drought_clusters(
     - periodic_bool: Boolean variable, True if we want to treat the left/right edges of the array as periodic (e.g. if
         we are calculating clusters over a global map), False otherwise (e.g. if we are identifying clusters within a
         smaller region).
+    - geometry: GridGeometry of the grid (optional, built from the other arguments if not given)
 
     Returns:
     - cluster_count: Number of drought clusters above the area threshold identified for the current
@@ -541,172 +1600,237 @@ def find_drought_clusters(
                           in this current time step.
     """
 
-    # Find the indices in each dimension of the pixels under drought
-    idx_lat, idx_lon = np.where(np.isfinite(data_matrix))
-
-    # Link them so they become coordinates
-    linked_indices = list(zip(idx_lat, idx_lon))
+    # Label the 8-connected clusters of pixels under drought (see label_clusters)
+    labels, cluster_count = label_clusters(np.isfinite(data_matrix), periodic_bool)
 
-    # Number of pixels under drought
-    npixels = len(idx_lat)
+    # Characteristics of all clusters in one pass; the intensity of each pixel is 1 - value
+    stats = cluster_statistics(
+        labels,
+        cluster_count,
+        1 - data_matrix.astype(np.float64),
+        lons,
+        lats,
+        resolution_lon,
+        resolution_lat,
+        geometry,
+    )
 
-    # Initialize cluster count
-    cluster_count = 0
+    # Indices of the pixels under drought in row-major order, grouped by cluster
+    idx_lat, idx_lon = np.where(labels > 0)
+    order = np.argsort(labels[idx_lat, idx_lon], kind="stable")
+    idx_lat, idx_lon = idx_lat[order], idx_lon[order]
+    bounds = np.concatenate(([0], np.cumsum(stats["pixel_count"])))
 
     # Initialize cluster dictionary
     cluster_dictionary = {}
 
-    # Initialize list of pixels that have been clustered
-    clustered_pixels = []
-
-    # Go through every drought pixel to make sure none is left out
-    for i in range(0, npixels):
-
-        # Current pixel used to start cluster (i.e. seed pixel)
-        seed_pixel = linked_indices[i]
+    for cluster in range(1, cluster_count + 1):
+        members = slice(bounds[cluster - 1], bounds[cluster])
+        k = cluster - 1
+        cluster_dictionary[cluster] = {
+            "coordinates": list(zip(idx_lat[members], idx_lon[members])),
+            "area": stats["area"][k],
+            "intensity": stats["mean"][k],
+            "variability": stats["std"][k],
+            "centroid": (stats["centroid_lon"][k], stats["centroid_lat"][k]),
+        }
 
-        # Make sure current pixel hasn't already been assigned to a cluster
-        if seed_pixel not in clustered_pixels:
+    return cluster_count, cluster_dictionary
 
-            # Increase cluster count by 1
-            cluster_count = cluster_count + 1
 
-            # Add current unclustered pixel to the dictionary entry of the new
-            # cluster and to the list of pixels that have been assigned to a cluster
-            cluster_dictionary[cluster_count] = {
-                "coordinates": [],
-                "area": [],
-                "intensity": [],
-                "centroid": [],
-            }
-            cluster_dictionary[cluster_count]["coordinates"].append(seed_pixel)
-            clustered_pixels.append(seed_pixel)
+def cluster_in_Sahara(centroid_lon, centroid_lat):
+    """
+    This function determines whether the current drought cluster centroid falls within the Sahara desert
+    during the current time step.
 
-            # Initialize the list of new pixels added to a cluster and add current pixel
-            new_additions = []
-            new_additions.append(seed_pixel)
+    Argument:
+    - centroid_lat: Latitude in degrees of the cluster centroid.
+    - centroid_lon: Longitude in degrees of the cluster centroid.
 
-            # While more pixels keep being added to the current cluster with each iteration, keep going
-            while len(new_additions) > 0:
+    Returns:
+    - Boolean variable False if the centroid does not fall in the Sahara desert and True otherwise.
+    """
 
-                # Make copy of new additions list to sweep through, and reset list so that new pixels are
-                # added in this coming iteration
-                additions_to_check = list(new_additions)
-                new_additions = []
+    if (
+        centroid_lat >= 20
+        and centroid_lat <= 25
+        and centroid_lon >= -17
+        and centroid_lon <= 34
+    ):
+        return True
+    else:
+        return False
 
-                # Go through each new addition and compare it to the pixels in its surroundings
-                for current_pixel in additions_to_check:
 
-                    # Finding those pixels surrounding the current pixel that are also under drought
-                    positive_matches = check_drought_in_surroundings(
-                        current_pixel, linked_indices, data_matrix, periodic_bool
-                    )
+# Box (lon_min, lon_max, lat_min, lat_max) of the Sahara desert used by cluster_in_Sahara
+SAHARA_BOX = (-17, 34, 20, 25)
 
-                    # Check there was at least one positive match
-                    if len(positive_matches) > 0:
 
-                        # Go through each surrounding pixel under drought and check if they have already been clustered
-                        for pixel in positive_matches:
+class ExclusionRegions:
+    """
+    Regions where clusters are discarded, evaluated against all cluster centroids of a time step
+    (or a block of time steps) at once. A centroid is excluded if it falls in any of:
 
-                            # Check if it has already been assigned
-                            if pixel not in clustered_pixels:
-                                # Add pixel to current cluster dictionary, to the list of clustered pixels,
-                                # and the list of new additions
-                                cluster_dictionary[cluster_count]["coordinates"].append(
-                                    pixel
-                                )
-                                clustered_pixels.append(pixel)
-                                new_additions.append(pixel)
+    - boxes: (lon_min, lon_max, lat_min, lat_max) tuples, bounds included (as in cluster_in_Sahara)
+    - polygons: sequences of (lon, lat) vertices, tested with the even-odd rule
+    - raster: 2D boolean matrix (lat, lon) on the data grid, True for excluded grid cells; a
+              centroid takes the value of the nearest grid cell and centroids more than half a
+              grid cell outside the grid are never excluded
 
-            ## Once the cluster has been finalized, find its approximate area and intensity and centroid
+    The default, ExclusionRegions.sahara(), reproduces cluster_in_Sahara.
+    """
 
-            # List of coordinate indices for current cluster
-            current_cluster_coordinates = cluster_dictionary[cluster_count][
-                "coordinates"
-            ]
+    def __init__(self, boxes=(), polygons=(), raster=None, lons=None, lats=None):
+        self.boxes = [tuple(float(v) for v in box) for box in boxes]
+        self.polygons = [np.asarray(polygon, dtype=np.float64) for polygon in polygons]
+        self.raster = None
+        if raster is not None:
+            self.raster = np.asarray(raster, dtype=bool)
+            self.lons = np.asarray(lons, dtype=np.float64)
+            self.lats = np.asarray(lats, dtype=np.float64)
+            if self.raster.shape != (len(self.lats), len(self.lons)):
+                raise ValueError(
+                    f"Exclusion raster shape {self.raster.shape} does not match the grid "
+                    f"({len(self.lats)}, {len(self.lons)})"
+                )
 
-            # Clean up in case there are any duplicates and resave
-            current_cluster_coordinates = list(set(current_cluster_coordinates))
-            cluster_dictionary[cluster_count][
-                "coordinates"
-            ] = current_cluster_coordinates
-
-            # Initialize arrays of intensities and actual coordinates
-            pixels_in_cluster = len(current_cluster_coordinates)
-            intensities_array = np.zeros(pixels_in_cluster)
-            lons_array = np.zeros(pixels_in_cluster)
-            lats_array = np.zeros(pixels_in_cluster)
-
-            # Sweep through the coordinates and extract each element
-            for j in range(0, pixels_in_cluster):
-                # Indices of current pixel
-                current_lat_idx, current_lon_idx = current_cluster_coordinates[j]
-
-                # Extract intensity of current pixel
-                intensities_array[j] = 1 - data_matrix[current_lat_idx, current_lon_idx]
-
-                # Coordinates of current pixel
-                lons_array[j] = lons[current_lon_idx]
-                lats_array[j] = lats[current_lat_idx]
-
-            # Find mean and standard deviation of cluster intensity
-            mean_cluster_intensity = np.mean(intensities_array)
-            std_cluster_intensity = np.std(intensities_array)
-
-            # Find cluster's centroid
-            centroid_lat, centroid_lon = find_weighed_centroid(
-                lats_array, lons_array, intensities_array, lons, lats
+    @classmethod
+    def sahara(cls):
+        """The Sahara box of cluster_in_Sahara."""
+        return cls(boxes=[SAHARA_BOX])
+
+    @classmethod
+    def from_config(cls, config, lons, lats):
+        """
+        Builds the exclusion regions from the exclusion_regions entry of definitions.yaml:
+
+        - None (entry missing): only the Sahara box
+        - dictionary with the optional keys "sahara" (bool, default True), "boxes" (list of
+          [lon_min, lon_max, lat_min, lat_max]), "polygons" (path to a JSON file with a list of
+          polygons, each a list of [lon, lat] vertices, or a GeoJSON file with Polygon /
+          MultiPolygon geometries whose outer rings are used) and "raster" (path to a .npy
+          boolean matrix (lat, lon) on the data grid)
+        """
+        if config is None:
+            return cls.sahara()
+
+        boxes = list(config.get("boxes", []))
+        if config.get("sahara", True):
+            boxes.append(SAHARA_BOX)
+
+        polygons = []
+        if config.get("polygons") is not None:
+            with open(config["polygons"]) as f:
+                polygons = _polygon_rings(json.load(f))
+
+        raster = None
+        if config.get("raster") is not None:
+            raster = np.load(config["raster"])
+
+        return cls(boxes, polygons, raster, lons, lats)
+
+    def contains(self, centroid_lons, centroid_lats):
+        """Boolean array, True for the centroids that fall in an exclusion region."""
+        x = np.asarray(centroid_lons, dtype=np.float64)
+        y = np.asarray(centroid_lats, dtype=np.float64)
+        excluded = np.zeros(x.shape, dtype=bool)
+
+        for lon_min, lon_max, lat_min, lat_max in self.boxes:
+            excluded |= (
+                (y >= lat_min) & (y <= lat_max) & (x >= lon_min) & (x <= lon_max)
             )
 
-            # Save cluster's characteristics
-            cluster_dictionary[cluster_count]["intensity"] = mean_cluster_intensity
-            cluster_dictionary[cluster_count]["variability"] = std_cluster_intensity
-            cluster_dictionary[cluster_count]["centroid"] = (centroid_lon, centroid_lat)
-
-            # Finding the cluster's approximate area
-            cluster_area = find_cluster_area(
-                current_cluster_coordinates, lons, lats, resolution_lon, resolution_lat
+        for polygon in self.polygons:
+            # Even-odd rule: count the polygon edges crossed by a ray going east of each point
+            inside = np.zeros(x.shape, dtype=bool)
+            x1, y1 = polygon[:, 0], polygon[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            for k in range(len(polygon)):
+                if y1[k] == y2[k]:
+                    continue
+                spans = (y1[k] > y) != (y2[k] > y)
+                crossing = x1[k] + (y - y1[k]) * (x2[k] - x1[k]) / (y2[k] - y1[k])
+                inside ^= spans & (x < crossing)
+            excluded |= inside
+
+        if self.raster is not None and x.size > 0:
+            valid = np.isfinite(x) & np.isfinite(y)
+            col = np.abs(self.lons[None, :] - x[valid][:, None]).argmin(axis=1)
+            row = np.abs(self.lats[None, :] - y[valid][:, None]).argmin(axis=1)
+            # Centroids beyond half a grid cell from the edge of the grid are outside the raster
+            half_lon = (
+                np.abs(np.mean(np.diff(self.lons))) / 2 if len(self.lons) > 1 else 0
             )
+            half_lat = (
+                np.abs(np.mean(np.diff(self.lats))) / 2 if len(self.lats) > 1 else 0
+            )
+            on_grid = (np.abs(self.lons[col] - x[valid]) <= half_lon) & (
+                np.abs(self.lats[row] - y[valid]) <= half_lat
+            )
+            excluded[valid] |= on_grid & self.raster[row, col]
 
-            # Save cluster area
-            cluster_dictionary[cluster_count]["area"] = cluster_area
+        return excluded
 
-    return cluster_count, cluster_dictionary
+
+def _polygon_rings(data):
+    """Outer rings of a JSON list of polygons or of a GeoJSON object."""
+    if isinstance(data, list):
+        return data
+    if data.get("type") == "FeatureCollection":
+        return [
+            ring for feature in data["features"] for ring in _polygon_rings(feature)
+        ]
+    if data.get("type") == "Feature":
+        return _polygon_rings(data["geometry"])
+    if data.get("type") == "Polygon":
+        return [data["coordinates"][0]]
+    if data.get("type") == "MultiPolygon":
+        return [polygon[0] for polygon in data["coordinates"]]
+    raise ValueError(f"Unsupported exclusion polygon type: {data.get('type')}")
 
 
-def cluster_in_Sahara(centroid_lon, centroid_lat):
+def keep_lookup_table(keep, group=None):
     """
-    This function determines whether the current drought cluster centroid falls within the Sahara desert
-    during the current time step.
+    Lookup table that relabels a label image in one indexing operation, new_labels = lookup[labels]:
+    the kept clusters are renumbered 1..n in their original order and the discarded clusters and the
+    background become 0.
 
-    Argument:
-    - centroid_lat: Latitude in degrees of the cluster centroid.
-    - centroid_lon: Longitude in degrees of the cluster centroid.
+    Arguments:
+    - keep: 1D boolean array, element k - 1 is True if cluster k is kept.
+    - group: Optional 1D int array with the group (e.g. the day) of each cluster, in non-decreasing
+             order; the kept clusters are then renumbered 1..n within each group.
 
     Returns:
-    - Boolean variable False if the centroid does not fall in the Sahara desert and True otherwise.
+    - lookup: 1D int32 array of length len(keep) + 1.
     """
 
-    if (
-        centroid_lat >= 20
-        and centroid_lat <= 25
-        and centroid_lon >= -17
-        and centroid_lon <= 34
-    ):
-        return True
-    else:
-        return False
+    keep = np.asarray(keep, dtype=bool)
+    new_label = np.cumsum(keep)
+    if group is not None and len(keep) > 0:
+        # Number of kept clusters in the previous groups
+        group = np.asarray(group)
+        first_of_group = np.searchsorted(group, group)
+        kept_before_group = new_label[first_of_group] - keep[first_of_group]
+        new_label = new_label - kept_before_group
+    lookup = np.zeros(len(keep) + 1, dtype=np.int32)
+    lookup[1:][keep] = new_label[keep]
+    return lookup
 
 
 def filter_drought_clusters(
-    data_matrix, cluster_count, cluster_dictionary, area_threshold
+    data_matrix,
+    cluster_count,
+    cluster_dictionary,
+    area_threshold,
+    exclusion=None,
+    labels=None,
 ):
     """
     This function will take in all the drought clusters and remove those that are smaller
     than the given area threshold. If a drought cluster does not meet the critertion
     then they will be deleted from the drought field. Drought clusters whose centroids fall within
-    the Sahara desert are also removed. This function works using the dictionary created by the
-    find_drought_clusters function.
+    the exclusion regions (by default the Sahara desert) are also removed. This function works using
+    the dictionary created by the find_drought_clusters function.
 
     Argument:
     - data_matrix: 2D matrix for a given time step with the non-drought pixels filtered out.
@@ -716,6 +1840,9 @@ def filter_drought_clusters(
                           in this current time step.
     - area_threshold: Minimum area threshold (km^2) for the drought clusters. Any clusters that are
                       smaller than this threshold will not be included.
+    - exclusion: ExclusionRegions where clusters are discarded (default: ExclusionRegions.sahara()).
+    - labels: Label image of the clusters (e.g. from label_clusters, cluster k has label k). If not given
+              it is rebuilt from the coordinates in cluster_dictionary.
 
     Return:
     - data_matrix: Updated input data matrix where the gridcells belonging to small clusters have been
@@ -726,65 +1853,38 @@ def filter_drought_clusters(
                                    time step.
     """
 
-    # Initiate new dictionary where filtered results will be stored
-    filtered_cluster_dictionary = {}
-
-    # Initialize count of clusters that meet the area criterion
-    filtered_cluster_count = 0
-
-    # Check every cluster
-    for i in range(1, cluster_count + 1):
-
-        # Cluster area and centroid
-        cluster_area = cluster_dictionary[i]["area"]
-        centroid_lon, centroid_lat = cluster_dictionary[i]["centroid"]
-
-        # Check whether cluster is in the Sahara Desert
-        in_sahara = cluster_in_Sahara(centroid_lon, centroid_lat)
-
-        # Compare to given threshold and check if it's in the Sahara
-        if cluster_area >= area_threshold and not in_sahara:
-
-            # Add a count to the number of filtered clusters
-            filtered_cluster_count = filtered_cluster_count + 1
+    if exclusion is None:
+        exclusion = ExclusionRegions.sahara()
+
+    # Area criterion and exclusion regions evaluated for all clusters at once
+    clusters = range(1, cluster_count + 1)
+    areas = np.array([cluster_dictionary[i]["area"] for i in clusters], dtype=float)
+    centroids = np.array(
+        [cluster_dictionary[i]["centroid"] for i in clusters], dtype=float
+    ).reshape(-1, 2)
+    keep = (areas >= area_threshold) & ~exclusion.contains(
+        centroids[:, 0], centroids[:, 1]
+    )
 
-            # Save list of pixels for this cluster and the cluster's characteristics to new dictionary
-            filtered_cluster_dictionary[filtered_cluster_count] = {
-                "coordinates": [],
-                "area": [],
-                "intensity": [],
-                "centroid": [],
-            }
-            filtered_cluster_dictionary[filtered_cluster_count]["coordinates"] = (
-                cluster_dictionary[i]["coordinates"]
-            )
-            filtered_cluster_dictionary[filtered_cluster_count]["area"] = (
-                cluster_dictionary[i]["area"]
-            )
-            filtered_cluster_dictionary[filtered_cluster_count]["intensity"] = (
-                cluster_dictionary[i]["intensity"]
+    if labels is None:
+        labels = np.zeros(np.shape(data_matrix), dtype=np.int32)
+        coordinates = [cluster_dictionary[i]["coordinates"] for i in clusters]
+        if coordinates:
+            idx_lat, idx_lon = np.concatenate(coordinates).reshape(-1, 2).T
+            labels[idx_lat, idx_lon] = np.repeat(
+                clusters, [len(c) for c in coordinates]
             )
-            filtered_cluster_dictionary[filtered_cluster_count]["variability"] = (
-                cluster_dictionary[i]["variability"]
-            )
-            filtered_cluster_dictionary[filtered_cluster_count]["centroid"] = (
-                cluster_dictionary[i]["centroid"]
-            )
-
-        else:
 
-            # List of coordinate indices for current cluster
-            current_cluster_coordinates = cluster_dictionary[i]["coordinates"]
+    # Relabel the label image in one operation: the kept clusters are renumbered 1..n in their
+    # original order, the pixels of the discarded clusters become 0 and are deleted from the
+    # drought field
+    lookup = keep_lookup_table(keep)
+    data_matrix[(labels > 0) & (lookup[labels] == 0)] = np.nan
+    filtered_cluster_dictionary = {
+        int(lookup[i]): cluster_dictionary[i] for i in clusters if keep[i - 1]
+    }
 
-            # Sweep through the coordinates and extract each element
-            for j in range(0, len(current_cluster_coordinates)):
-                # Indices of current pixel
-                current_lat_idx, current_lon_idx = current_cluster_coordinates[j]
-
-                # Delete pixel from drought field
-                data_matrix[current_lat_idx, current_lon_idx] = np.nan
-
-    return data_matrix, filtered_cluster_count, filtered_cluster_dictionary
+    return data_matrix, len(filtered_cluster_dictionary), filtered_cluster_dictionary
 
 
 #############################################################################################################
@@ -1599,38 +2699,47 @@ def Create_NETCDF_File(dims, file, var, var_info, data, tinitial):
     return f
 
 
-def add_heatwave_metrics(cluster_dict, T_diff, lons, lats, res_lon, res_lat):
+def add_heatwave_metrics(
+    cluster_dict, T_diff, lons, lats, res_lon, res_lat, geometry=None
+):
     """
-    添加强度 intensity 和质心 centroid 到每个热浪聚类字典中
+    添加强度 intensity 和质心 centroid 到每个热浪聚类字典中。
+    强度为各格点温度差 × 格点面积之和，格点面积取自 GridGeometry（与聚类面积 area 一致）
     """
-    area_per_grid = res_lon * res_lat * 111**2  # 近似 km^2
-
-    for cid, info in cluster_dict.items():
-        coords = info["coordinates"]  # 格点索引列表
-        weights = []
-        lon_weighted, lat_weighted = 0.0, 0.0
-        total_weight = 0.0
-        intensity = 0.0
+    if geometry is None:
+        geometry = GridGeometry.cached(lons, lats, res_lon, res_lat)
+
+    if len(cluster_dict) == 0:
+        return cluster_dict
+
+    # 把所有聚类的格点拼成一维数组，按聚类分组一次性求和（与逐格点累加的顺序相同）
+    cluster_ids = list(cluster_dict.keys())
+    coords = [np.asarray(cluster_dict[cid]["coordinates"]) for cid in cluster_ids]
+    group = np.repeat(np.arange(len(cluster_ids)), [len(c) for c in coords])
+    ys, xs = np.concatenate(coords).reshape(-1, 2).T
+
+    # 只统计温度差为正的格点
+    diff = np.asarray(T_diff)[ys, xs]
+    positive = diff > 0
+    group, weight = group[positive], diff[positive]
+    ys, xs = ys[positive], xs[positive]
+
+    n = len(cluster_ids)
+    total_weight = np.bincount(group, weights=weight, minlength=n)
+    area_per_grid = geometry.cell_area(ys)  # km^2
+    intensity = np.bincount(group, weights=weight * area_per_grid, minlength=n)
+    # 按温度差加权的质心，跨越日期变更线/周期边界的聚类按圆周平均处理
+    centroid_lon, centroid_lat = weighted_centroids(
+        group, n, ys, xs, weight, lons, lats
+    )
 
-        for y, x in coords:
-            diff = T_diff[y, x]
-            if diff <= 0:
-                continue
-            weight = diff
-            lat_val = lats[y]
-            lon_val = lons[x]
-
-            lon_weighted += lon_val * weight
-            lat_weighted += lat_val * weight
-            intensity += weight * area_per_grid
-            total_weight += weight
-
-        # 添加指标
-        if total_weight > 0:
-            cluster_dict[cid]["intensity"] = float(intensity)
+    # 添加指标
+    for k, cid in enumerate(cluster_ids):
+        if total_weight[k] > 0:
+            cluster_dict[cid]["intensity"] = float(intensity[k])
             cluster_dict[cid]["centroid"] = (
-                float(lon_weighted / total_weight),
-                float(lat_weighted / total_weight),
+                float(centroid_lon[k]),
+                float(centroid_lat[k]),
             )
         else:
             cluster_dict[cid]["intensity"] = 0.0
@@ -1639,20 +2748,803 @@ def add_heatwave_metrics(cluster_dict, T_diff, lons, lats, res_lon, res_lat):
     return cluster_dict
 
 
+# prune_clusters 的计数：标记出的聚类、因面积不足在计算统计量前丢弃的聚类、质心位于
+# 排除区域的聚类、保留的聚类，以及全部聚类格点和其中跳过统计的格点
+PRUNING_COUNTERS = (
+    "clusters",
+    "pruned_by_area",
+    "excluded",
+    "kept",
+    "pixels",
+    "pixels_skipped",
+)
+
+
+def pixel_index_dtype(shape):
+    """格点行/列索引的紧凑整数类型：网格不超过 32767 行列时为 int16，否则为 int32"""
+    return np.int16 if max(shape) <= np.iinfo(np.int16).max else np.int32
+
+
+class ClusterRecord(Mapping):
+    """
+    单个热浪聚类的紧凑记录：格点的行/列索引保存为两个紧凑整数数组（见 pixel_index_dtype），
+    而不是 (np.int64, np.int64) 元组列表，pickle 体积更小、读写更快
+
+    同时兼容原来的字典格式：record["coordinates"] 返回 (row, col) 元组列表，
+    record["area"] / ["intensity"] / ["variability"] / ["centroid"] 与 .get()、.keys()、
+    .items() 照常可用，验证和可视化脚本无需修改读取方式
+
+    Attributes:
+        rows, cols: 格点的行、列索引数组（行优先顺序）
+        area: 面积（km²）
+        intensity: 强度（温度差 × 格点面积之和）
+        variability: 温度差的标准差
+        centroid: 按温度差加权的质心 (lon, lat)
+    """
+
+    __slots__ = ("rows", "cols", "area", "intensity", "variability", "centroid")
+
+    _fields = ("coordinates", "area", "intensity", "variability", "centroid")
+
+    def __init__(self, rows, cols, area, intensity, variability, centroid):
+        self.rows = rows
+        self.cols = cols
+        self.area = area
+        self.intensity = intensity
+        self.variability = variability
+        self.centroid = centroid
+
+    def pixel_indices(self):
+        """格点索引的 (n, 2) 数组，每行为 (row, col)"""
+        return np.stack([self.rows, self.cols], axis=1)
+
+    def __getitem__(self, key):
+        if key == "coordinates":
+            return list(zip(self.rows.tolist(), self.cols.tolist()))
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "coordinates":
+            pixels = np.asarray(value, dtype=np.int64).reshape(-1, 2)
+            dtype = pixel_index_dtype(pixels.max(axis=0, initial=0) + 1)
+            self.rows, self.cols = pixels.T.astype(dtype)
+        elif key in self._fields:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return (
+            f"ClusterRecord(pixels={len(self.rows)}, area={self.area}, "
+            f"intensity={self.intensity}, centroid={self.centroid})"
+        )
+
+
+def cluster_pixel_indices(info):
+    """
+    聚类格点索引的 (n, 2) 数组，兼容 ClusterRecord 和旧的 "coordinates" 元组列表字典
+    """
+    if isinstance(info, ClusterRecord):
+        return info.pixel_indices()
+    return np.asarray(info.get("coordinates", []), dtype=np.int64).reshape(-1, 2)
+
+
+def prune_clusters(
+    group,
+    cluster_count,
+    idx_lat,
+    idx_lon,
+    pixel_values,
+    lons,
+    lats,
+    res_lon,
+    res_lat,
+    geometry,
+    area_threshold=0,
+    exclusion=None,
+    counters=None,
+):
+    """
+    面积优先的聚类筛选：先只用一次 bincount 求各聚类面积，面积小于阈值的聚类直接丢弃，
+    只对剩下的聚类计算质心、标准差等统计量，再用质心做排除区域筛选。结果与先对全部
+    聚类调用 _grouped_statistics 再筛选相同
+
+    Args:
+        group: 每个格点所属聚类 0..cluster_count - 1，按聚类分组、组内为行优先顺序
+        cluster_count: 聚类个数
+        idx_lat, idx_lon: 格点的行、列索引
+        pixel_values: 格点值（float64），用于标准差和质心权重
+        lons, lats: 经纬度一维数组
+        res_lon, res_lat: 经纬度分辨率
+        geometry: 网格几何 GridGeometry
+        area_threshold: 最小聚类面积（km²）
+        exclusion: ExclusionRegions，质心落在其中的聚类被筛除（默认只有撒哈拉）
+        counters: 计数字典（可选），累加 PRUNING_COUNTERS 中的各项
+
+    Returns:
+        keep: 长度为 cluster_count 的布尔数组，True 为保留的聚类
+        stats: 通过面积筛选的聚类的统计量（_grouped_statistics 的结果）
+        large: 长度为 cluster_count 的布尔数组，True 为通过面积筛选的聚类；
+            stats 中保留聚类的位置为 keep[large]
+    """
+    if exclusion is None:
+        exclusion = ExclusionRegions.sahara()
+
+    area = np.bincount(
+        group, weights=geometry.cell_area(idx_lat), minlength=cluster_count
+    )
+    large = area >= area_threshold
+    large_count = int(np.count_nonzero(large))
+    large_pixel = large[group]
+
+    # 通过面积筛选的聚类重新编号为 0..large_count - 1，格点仍按聚类分组
+    large_before = np.cumsum(large) - large
+    stats = _grouped_statistics(
+        large_before[group[large_pixel]],
+        large_count,
+        idx_lat[large_pixel],
+        idx_lon[large_pixel],
+        pixel_values[large_pixel],
+        lons,
+        lats,
+        res_lon,
+        res_lat,
+        geometry,
+    )
+    keep = large.copy()
+    keep[large] = ~exclusion.contains(stats["centroid_lon"], stats["centroid_lat"])
+
+    if counters is not None:
+        kept = int(np.count_nonzero(keep))
+        pixels = len(group)
+        skipped = pixels - int(np.count_nonzero(large_pixel))
+        for key, value in zip(
+            PRUNING_COUNTERS,
+            (
+                cluster_count,
+                cluster_count - large_count,
+                large_count - kept,
+                kept,
+                pixels,
+                skipped,
+            ),
+        ):
+            counters[key] = counters.get(key, 0) + value
+
+    return keep, stats, large
+
+
+def format_pruning_counters(counters):
+    """
+    把 prune_clusters 累加的计数整理成一行摘要
+    """
+    clusters = counters.get("clusters", 0)
+    pixels = counters.get("pixels", 0)
+    pruned = counters.get("pruned_by_area", 0)
+    skipped = counters.get("pixels_skipped", 0)
+    return (
+        f"聚类 {clusters} 个：面积不足跳过统计 {pruned} 个"
+        f"（{100 * pruned / max(clusters, 1):.1f}%，格点 {100 * skipped / max(pixels, 1):.1f}%），"
+        f"排除区域筛除 {counters.get('excluded', 0)} 个，保留 {counters.get('kept', 0)} 个"
+    )
+
+
+def cost_ordered_batches(costs, batch_size):
+    """
+    按代价从大到小把日期分成小批次，供动态调度依次分发：代价大的日期先算，
+    最后剩下的都是代价小的批次，各进程的结束时间更接近
+
+    Args:
+        costs: 每天的代价估计（例如热浪掩码的格点数），一维数组
+        batch_size: 每批的天数
+
+    Returns:
+        batches: 日期序号数组的列表，按分发顺序排列；同一批内按代价从大到小
+    """
+    costs = np.asarray(costs)
+    order = np.argsort(-costs, kind="stable")
+    batch_size = max(int(batch_size), 1)
+    return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def cluster_day_block(
+    temp_diff,
+    lons,
+    lats,
+    res_lon,
+    res_lat,
+    periodic_bool,
+    area_threshold=0,
+    geometry=None,
+    exclusion=None,
+    counters=None,
+):
+    """
+    批量识别一组日期的热浪聚类：对 (day, lat, lon) 的温度差一次完成连通域标记、
+    面积/排除区域筛选（面积优先，见 prune_clusters）和热浪指标计算，结果与逐日调用 find_drought_clusters、
+    filter_drought_clusters、add_heatwave_metrics 相同
+
+    Args:
+        temp_diff: 温度差 (day, lat, lon)，温度差为正的格点参与聚类
+        lons, lats: 经纬度一维数组
+        res_lon, res_lat: 经纬度分辨率
+        periodic_bool: 经度方向是否为周期边界
+        area_threshold: 最小聚类面积（km²）
+        geometry: 网格几何 GridGeometry（可选，不给则由经纬度构造）
+        exclusion: ExclusionRegions，质心落在其中的聚类被筛除（默认只有撒哈拉）
+        counters: 计数字典（可选），见 prune_clusters
+
+    Returns:
+        labels: (day, lat, lon) int32 标签立方体，每天的聚类编号为 1..n（与逐日处理的
+            字典键相同），0 为背景或被筛除的格点
+        table: 列式聚类表，字典的每个值为长度等于聚类总数的一维数组，按 (day, label) 排序：
+            day（块内日序号）、label、pixel_count、area、intensity、variability、
+            centroid_lon、centroid_lat、row_min、row_max、col_min、col_max
+    """
+    if geometry is None:
+        geometry = GridGeometry.cached(lons, lats, res_lon, res_lat)
+    if exclusion is None:
+        exclusion = ExclusionRegions.sahara()
+
+    # 与 02 脚本相同的聚类输入：非正的温度差置为 NaN
+    data = np.asarray(temp_diff).astype(np.float32)
+    data[data <= 0] = np.nan
+    ndays = data.shape[0]
+    labels, counts = label_clusters_batch(np.isfinite(data), periodic_bool)
+
+    # 整个块内的聚类连续编号（按日期、再按当天的标签）
+    total = int(counts.sum())
+    first_cluster = np.concatenate(([0], np.cumsum(counts)))[:-1]
+    cluster_day = np.repeat(np.arange(ndays), counts)
+    days, rows, cols = np.nonzero(labels)
+    group = first_cluster[days] + labels[days, rows, cols] - 1
+    order = np.argsort(group, kind="stable")
+    days, rows, cols, group = days[order], rows[order], cols[order], group[order]
+
+    # 聚类特征，强度取 1 - 值（与 find_drought_clusters 相同），质心用于排除区域筛选；
+    # 只有面积达到阈值的聚类才计算统计量
+    keep, stats, large = prune_clusters(
+        group,
+        total,
+        rows,
+        cols,
+        1 - data[days, rows, cols].astype(np.float64),
+        lons,
+        lats,
+        res_lon,
+        res_lat,
+        geometry,
+        area_threshold,
+        exclusion,
+        counters,
+    )
+    kept_stats = keep[large]
+
+    # 保留的聚类按天重新编号为 1..n，被筛除的聚类格点置 0：查找表一次作用于整个标签立方体
+    lookup = keep_lookup_table(keep, cluster_day)
+    labels = np.where(labels > 0, lookup[labels + first_cluster[:, None, None]], 0)
+    labels = labels.astype(np.int32)
+    kept_before = np.cumsum(keep) - keep
+
+    # 热浪指标（与 add_heatwave_metrics 相同）：强度为温度差 × 格点面积之和，
+    # 质心按温度差加权
+    kept_pixel = keep[group]
+    group = kept_before[group[kept_pixel]]
+    rows, cols = rows[kept_pixel], cols[kept_pixel]
+    weight = np.asarray(temp_diff)[days[kept_pixel], rows, cols]
+    nkept = int(np.count_nonzero(keep))
+    total_weight = np.bincount(group, weights=weight, minlength=nkept)
+    intensity = np.bincount(
+        group, weights=weight * geometry.cell_area(rows), minlength=nkept
+    )
+    centroid_lon, centroid_lat = weighted_centroids(
+        group, nkept, rows, cols, weight, lons, lats
+    )
+
+    table = {
+        "day": cluster_day[keep],
+        "label": lookup[1:][keep],
+        "pixel_count": stats["pixel_count"][kept_stats],
+        "area": stats["area"][kept_stats],
+        "intensity": np.where(total_weight > 0, intensity, 0.0),
+        "variability": stats["std"][kept_stats],
+        "centroid_lon": centroid_lon,
+        "centroid_lat": centroid_lat,
+    }
+    for key in ("row_min", "row_max", "col_min", "col_max"):
+        table[key] = stats[key][kept_stats]
+
+    return labels, table
+
+
+def cluster_block_dictionaries(labels, table):
+    """
+    把 cluster_day_block 的标签立方体和聚类表转换为逐日的聚类字典，即 02 脚本保存的
+    heatwave-dictionary 文件内容
+
+    Args:
+        labels: (day, lat, lon) 标签立方体
+        table: 列式聚类表
+
+    Returns:
+        dictionaries: 长度为 day 的列表，每个元素为 {label: ClusterRecord} 字典
+    """
+    ndays = labels.shape[0]
+    kept_first = np.searchsorted(table["day"], np.arange(ndays))
+
+    # 所有聚类的格点（行优先顺序，按聚类表的行分组）
+    days, rows, cols = np.nonzero(labels)
+    group = kept_first[days] + labels[days, rows, cols] - 1
+    order = np.argsort(group, kind="stable")
+    index_dtype = pixel_index_dtype(labels.shape[1:])
+    rows, cols = rows[order].astype(index_dtype), cols[order].astype(index_dtype)
+    bounds = np.concatenate(([0], np.cumsum(table["pixel_count"])))
+
+    dictionaries = [{} for _ in range(ndays)]
+    for k in range(len(table["day"])):
+        members = slice(bounds[k], bounds[k + 1])
+        dictionaries[table["day"][k]][int(table["label"][k])] = _cluster_record(
+            table, k, rows[members], cols[members]
+        )
+
+    return dictionaries
+
+
+def _cluster_record(table, k, rows, cols):
+    """聚类表第 k 行对应的 ClusterRecord"""
+    if np.isfinite(table["centroid_lon"][k]):
+        centroid = (float(table["centroid_lon"][k]), float(table["centroid_lat"][k]))
+    else:
+        centroid = (None, None)
+    return ClusterRecord(
+        rows,
+        cols,
+        table["area"][k],
+        float(table["intensity"][k]),
+        table["variability"][k],
+        centroid,
+    )
+
+
+# 聚类表的列（cluster_day_block 返回的列式表，以及聚类库中的 table_<列名>.npy）
+CLUSTER_TABLE_COLUMNS = (
+    "day",
+    "label",
+    "pixel_count",
+    "area",
+    "intensity",
+    "variability",
+    "centroid_lon",
+    "centroid_lat",
+    "row_min",
+    "row_max",
+    "col_min",
+    "col_max",
+)
+
+# 02 脚本输出目录下的聚类库子目录
+CLUSTER_STORE_DIR = "cluster_store"
+
+
+def cluster_config_hash(input_path, settings):
+    """
+    聚类结果的配置哈希：由输入文件的身份（绝对路径、大小、修改时间）和影响聚类结果的
+    设置共同决定，用于判断断点续算时已完成的日期是否仍然有效
+
+    Args:
+        input_path: 预处理输出文件路径
+        settings: 影响聚类结果的设置字典（可 JSON 序列化）
+
+    Returns:
+        key: 十六进制字符串
+    """
+    stat = os.stat(input_path)
+    identity = {
+        "path": os.path.abspath(input_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "settings": settings,
+    }
+    return hashlib.sha1(
+        json.dumps(identity, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _replace_atomically(path, write):
+    """先用 write(f) 写临时文件再重命名为 path，读取方不会看到写了一半的文件"""
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        write(f)
+    os.replace(tmp_file, path)
+
+
+class ClusterStoreWriter:
+    """
+    把 02 脚本的逐日聚类结果写入一个聚类库目录，代替每天三个 pck 文件。目录中为
+    .npy 文件（可用 np.load(..., mmap_mode="r") 按需映射）：
+
+        dates.npy            每天的日期 YYYYMMDD (int32)
+        labels.npy           (time, lat, lon) int32 标签立方体，0 为背景
+        table_<列名>.npy     列式聚类表（CLUSTER_TABLE_COLUMNS），按 (day, label) 排序，
+                             day 为库内的日序号
+        day_offsets.npy      每天在聚类表中的行范围 [day_offsets[d], day_offsets[d + 1])
+        pixel_offsets.npy    CSR 格点索引：第 k 个聚类的格点为
+        pixel_rows.npy       pixel_rows / pixel_cols[pixel_offsets[k]:pixel_offsets[k + 1]]
+        pixel_cols.npy       （行优先顺序，与 ClusterRecord 相同）
+        manifest.json        完成清单：配置哈希、每个已完成日期的聚类数与格点数、
+                             所在的批次文件，以及聚类库是否已写完（complete）
+        parts/               每批的聚类表（断点续算时重新读取）
+
+    只由一个进程写入：标签立方体按批次写入预先分配的映射文件，每批的聚类表先写临时
+    文件再重命名为 parts/ 下的批次文件，最后更新清单（同样先写临时文件再重命名），
+    所以清单中的日期一定已经完整写入。close() 时把全部聚类表排序保存，再按日期顺序
+    扫描一遍标签立方体生成 CSR 格点索引
+
+    Args:
+        path: 聚类库目录
+        dates: 每天的日期字符串 YYYYMMDD（库内日序号的顺序）
+        shape: 网格形状 (lat, lon)
+        config_hash: 配置哈希（见 cluster_config_hash）
+        resume: True 时保留清单中配置哈希相同、批次文件完整的日期（见 pending_days），
+            否则从头写入
+    """
+
+    def __init__(self, path, dates, shape, config_hash=None, resume=False):
+        self.path = path
+        self.config_hash = config_hash
+        self.dates = np.asarray(dates, dtype=np.int32)
+        self.parts_path = os.path.join(path, "parts")
+        os.makedirs(self.parts_path, exist_ok=True)
+        labels_file = os.path.join(path, "labels.npy")
+        shape = (len(self.dates),) + tuple(shape)
+
+        manifest = self._read_manifest() if resume else None
+        if (
+            manifest is not None
+            and os.path.exists(labels_file)
+            and np.array_equal(np.load(os.path.join(path, "dates.npy")), self.dates)
+            and np.load(labels_file, mmap_mode="r").shape == shape
+        ):
+            self.done, self.tables = self._load_completed_days(manifest["days"])
+            self._write_manifest(complete=False)
+            self.labels = np.load(labels_file, mmap_mode="r+")
+        else:
+            self.done, self.tables = {}, []
+            self._write_manifest(complete=False)
+            for name in os.listdir(self.parts_path):
+                os.remove(os.path.join(self.parts_path, name))
+            _replace_atomically(
+                os.path.join(path, "dates.npy"), lambda f: np.save(f, self.dates)
+            )
+            self.labels = np.lib.format.open_memmap(
+                labels_file, mode="w+", dtype=np.int32, shape=shape
+            )
+        self.part_count = len(os.listdir(self.parts_path))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, "manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, complete):
+        manifest = {
+            "config_hash": self.config_hash,
+            "complete": complete,
+            "days": self.done,
+        }
+        _replace_atomically(
+            os.path.join(self.path, "manifest.json"),
+            lambda f: f.write(json.dumps(manifest, indent=1).encode()),
+        )
+
+    def _load_completed_days(self, days):
+        """
+        读取清单中仍然有效的日期：配置哈希与本次相同，批次文件存在，且其中这一天的
+        聚类数与格点数与清单一致
+        """
+        day_index = {int(date): day for day, date in enumerate(self.dates)}
+        done, tables = {}, []
+        parts = {}
+        for date, entry in days.items():
+            if entry.get("config_hash") == self.config_hash and int(date) in day_index:
+                parts.setdefault(entry["part"], []).append(date)
+        for part, part_dates in parts.items():
+            try:
+                with np.load(os.path.join(self.parts_path, part)) as data:
+                    table = {key: data[key] for key in CLUSTER_TABLE_COLUMNS}
+            except (OSError, ValueError, KeyError):
+                continue
+            keep = np.zeros(len(table["day"]), dtype=bool)
+            for date in part_dates:
+                rows = table["day"] == day_index[int(date)]
+                entry = days[date]
+                if (
+                    np.count_nonzero(rows) == entry["clusters"]
+                    and int(table["pixel_count"][rows].sum()) == entry["pixels"]
+                ):
+                    done[date] = entry
+                    keep |= rows
+            tables.append({key: table[key][keep] for key in CLUSTER_TABLE_COLUMNS})
+        return done, tables
+
+    def pending_days(self):
+        """还没有有效结果的库内日序号"""
+        return np.array(
+            [day for day, date in enumerate(self.dates) if str(date) not in self.done],
+            dtype=np.int64,
+        )
+
+    def write_block(self, days, labels, table):
+        """
+        写入 cluster_day_block 处理的一批日期，并在清单中记录这些日期
+
+        Args:
+            days: 这批日期的库内日序号（与 labels 的第一维对应）
+            labels: (day, lat, lon) 标签立方体
+            table: 列式聚类表，day 列为批内的日序号
+        """
+        days = np.asarray(days)
+        self.labels[days] = labels
+        self.labels.flush()
+        table = dict(table)
+        table["day"] = days[table["day"]]
+        self.tables.append(table)
+
+        part = f"part_{self.part_count:06d}.npz"
+        while os.path.exists(os.path.join(self.parts_path, part)):
+            self.part_count += 1
+            part = f"part_{self.part_count:06d}.npz"
+        self.part_count += 1
+        _replace_atomically(
+            os.path.join(self.parts_path, part),
+            lambda f: np.savez(f, **{key: table[key] for key in CLUSTER_TABLE_COLUMNS}),
+        )
+        clusters = np.bincount(np.searchsorted(days, table["day"]), minlength=len(days))
+        pixels = np.bincount(
+            np.searchsorted(days, table["day"]),
+            weights=table["pixel_count"],
+            minlength=len(days),
+        )
+        for i, day in enumerate(days):
+            self.done[str(self.dates[day])] = {
+                "config_hash": self.config_hash,
+                "clusters": int(clusters[i]),
+                "pixels": int(pixels[i]),
+                "part": part,
+            }
+        self._write_manifest(complete=False)
+
+    def close(self):
+        """保存聚类表与日期索引，生成 CSR 格点索引，并把清单标记为已写完"""
+        ndays, nlats, nlons = self.labels.shape
+        self.labels.flush()
+        if self.tables:
+            table = {
+                key: np.concatenate([t[key] for t in self.tables])
+                for key in CLUSTER_TABLE_COLUMNS
+            }
+        else:
+            table = {key: np.zeros(0, dtype=np.int64) for key in CLUSTER_TABLE_COLUMNS}
+        order = np.lexsort((table["label"], table["day"]))
+        for key in CLUSTER_TABLE_COLUMNS:
+            _replace_atomically(
+                os.path.join(self.path, f"table_{key}.npy"),
+                lambda f: np.save(f, table[key][order]),
+            )
+        day_offsets = np.searchsorted(table["day"][order], np.arange(ndays + 1)).astype(
+            np.int64
+        )
+        pixel_offsets = np.concatenate(
+            ([0], np.cumsum(table["pixel_count"][order]))
+        ).astype(np.int64)
+        for name, array in (
+            ("day_offsets", day_offsets),
+            ("pixel_offsets", pixel_offsets),
+        ):
+            _replace_atomically(
+                os.path.join(self.path, f"{name}.npy"), lambda f: np.save(f, array)
+            )
+
+        # 按日期顺序扫描标签立方体，依次写入每天各聚类的格点（按标签分组、行优先）
+        index_dtype = pixel_index_dtype((nlats, nlons))
+        pixel_files = [
+            os.path.join(self.path, f"pixel_{name}.npy") for name in ("rows", "cols")
+        ]
+        pixel_rows, pixel_cols = (
+            np.lib.format.open_memmap(
+                f"{pixel_file}.{os.getpid()}.tmp",
+                mode="w+",
+                dtype=index_dtype,
+                shape=(int(pixel_offsets[-1]),),
+            )
+            for pixel_file in pixel_files
+        )
+        for day in range(ndays):
+            labels = np.asarray(self.labels[day])
+            rows, cols = np.nonzero(labels)
+            pixel_order = np.argsort(labels[rows, cols], kind="stable")
+            start = pixel_offsets[day_offsets[day]]
+            pixel_rows[start : start + len(rows)] = rows[pixel_order]
+            pixel_cols[start : start + len(rows)] = cols[pixel_order]
+        pixel_rows.flush()
+        pixel_cols.flush()
+        del pixel_rows, pixel_cols, self.labels
+        for pixel_file in pixel_files:
+            os.replace(f"{pixel_file}.{os.getpid()}.tmp", pixel_file)
+        self._write_manifest(complete=True)
+
+
+class ClusterStore:
+    """
+    读取 ClusterStoreWriter 写出的聚类库。所有数组都以只读内存映射方式打开，读取某一天
+    只会读入这一天的标签图和聚类表的几行
+
+    Args:
+        path: 聚类库目录
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.dates = np.load(os.path.join(path, "dates.npy"))
+        self.labels = load("labels")
+        self.table = {key: load(f"table_{key}") for key in CLUSTER_TABLE_COLUMNS}
+        self.day_offsets = load("day_offsets")
+        self.pixel_offsets = load("pixel_offsets")
+        self.pixel_rows = load("pixel_rows")
+        self.pixel_cols = load("pixel_cols")
+
+    @staticmethod
+    def exists(path):
+        """
+        path 是否为已写完的聚类库目录：清单标记为 complete；没有清单的旧聚类库以
+        最后写入的 pixel_cols.npy 为准
+        """
+        manifest_file = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_file):
+            return os.path.exists(os.path.join(path, "pixel_cols.npy"))
+        try:
+            with open(manifest_file) as f:
+                return bool(json.load(f).get("complete"))
+        except (OSError, ValueError):
+            return False
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_string(self, day):
+        """库内第 day 天的日期字符串 YYYYMMDD"""
+        return str(int(self.dates[day]))
+
+    def day_index(self, date_str):
+        """日期字符串 YYYYMMDD 对应的库内日序号"""
+        day = int(np.searchsorted(self.dates, int(date_str)))
+        if day == len(self.dates) or self.dates[day] != int(date_str):
+            raise KeyError(date_str)
+        return day
+
+    def cluster_rows(self, day):
+        """第 day 天的聚类在聚类表中的行范围"""
+        return slice(int(self.day_offsets[day]), int(self.day_offsets[day + 1]))
+
+    def count(self, day):
+        """第 day 天的聚类个数（即原 heatwave-count 文件的内容）"""
+        rows = self.cluster_rows(day)
+        return rows.stop - rows.start
+
+    def mask(self, day):
+        """第 day 天的聚类掩膜，聚类格点为 1、其它为 NaN（即原 heatwave-mask 文件的内容）"""
+        return np.where(self.labels[day] > 0, 1.0, np.nan).astype(np.float32)
+
+    def date_strings(self):
+        """全部日期字符串 YYYYMMDD（按时间顺序）"""
+        return [self.date_string(day) for day in range(len(self))]
+
+    def load_day(self, date_str):
+        """某一天的 (mask, dictionary, count)，与旧版本三个 pck 文件的内容相同"""
+        day = self.day_index(date_str)
+        return self.mask(day), self.dictionary(day), self.count(day)
+
+    def pixel_indices(self, k):
+        """聚类表第 k 行聚类的格点索引 (n, 2) 数组"""
+        members = slice(int(self.pixel_offsets[k]), int(self.pixel_offsets[k + 1]))
+        return np.stack([self.pixel_rows[members], self.pixel_cols[members]], axis=1)
+
+    def dictionary(self, day):
+        """第 day 天的 {label: ClusterRecord} 字典（即原 heatwave-dictionary 文件的内容）"""
+        dictionary = {}
+        rows = self.cluster_rows(day)
+        for k in range(rows.start, rows.stop):
+            members = slice(int(self.pixel_offsets[k]), int(self.pixel_offsets[k + 1]))
+            dictionary[int(self.table["label"][k])] = _cluster_record(
+                self.table,
+                k,
+                np.array(self.pixel_rows[members]),
+                np.array(self.pixel_cols[members]),
+            )
+        return dictionary
+
+
+class PickleClusterFiles:
+    """
+    旧版本 02 脚本逐日写出的 heatwave-mask / heatwave-dictionary / heatwave-count pck 文件，
+    提供与 ClusterStore 相同的 date_strings() / load_day() 读取接口
+
+    Args:
+        path: 02 脚本的输出目录
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def date_strings(self):
+        """全部日期字符串 YYYYMMDD（按时间顺序）"""
+        import glob
+
+        return sorted(
+            f.split("_")[-1].replace(".pck", "")
+            for f in glob.glob(f"{self.path}/heatwave-mask_*.pck")
+        )
+
+    def load_day(self, date_str):
+        """某一天的 (mask, dictionary, count)"""
+        day = []
+        for name in ("mask", "dictionary", "count"):
+            with open(f"{self.path}/heatwave-{name}_{date_str}.pck", "rb") as f:
+                day.append(pickle.load(f))
+        return tuple(day)
+
+
+def open_cluster_output(cluster_path):
+    """
+    打开 02 脚本的输出：有聚类库时返回 ClusterStore，否则返回读取旧版本逐日 pck 文件的
+    PickleClusterFiles
+    """
+    store_path = os.path.join(cluster_path, CLUSTER_STORE_DIR)
+    if ClusterStore.exists(store_path):
+        return ClusterStore(store_path)
+    return PickleClusterFiles(cluster_path)
+
+
 def clusters_are_connected(info1, info2, distance_threshold=1):
     """
     判断两个聚类是否相连：是否共享或相邻格点（基于 index)
     """
-    coords1 = set(info1.get("coordinates", []))
-    coords2 = set(info2.get("coordinates", []))
+    pixels1 = cluster_pixel_indices(info1)
+    pixels2 = cluster_pixel_indices(info2)
+    if len(pixels1) == 0 or len(pixels2) == 0:
+        return False
 
-    # 简化版：只要有重叠或相邻格点就认为连接
-    for y1, x1 in coords1:
-        for y2, x2 in coords2:
-            if (
-                abs(y1 - y2) <= distance_threshold
-                and abs(x1 - x2) <= distance_threshold
-            ):
+    # 只要有重叠或相邻格点就认为连接：把第二个聚类在 (2d+1)x(2d+1) 邻域内平移，
+    # 检查平移后的格点是否与第一个聚类重合
+    width = (
+        int(max(pixels1[:, 1].max(), pixels2[:, 1].max())) + 2 * distance_threshold + 1
+    )
+    keys1 = pixels1[:, 0].astype(np.int64) * width + pixels1[:, 1]
+    keys2 = pixels2[:, 0].astype(np.int64) * width + pixels2[:, 1]
+    for dy in range(-distance_threshold, distance_threshold + 1):
+        for dx in range(-distance_threshold, distance_threshold + 1):
+            if np.isin(keys2 + (dy * width + dx), keys1).any():
                 return True
     return False
 
@@ -1676,24 +3568,40 @@ def track_heatwave_clusters_and_save(
     import glob
     from datetime import datetime
     print(f"🔍 搜索路径: {cluster_path}")
-    dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
-    print(f"🔍 找到文件数量: {len(dict_files)}")
-    if not dict_files:
-        print("❌ 未找到聚类文件")
-        return
-
-    # 提取日期并排序
-    file_dates = []
-    for f in dict_files:
-        date_str = f.split("_")[-1].replace(".pck", "")
-        try:
-            date_obj = datetime.strptime(date_str, "%Y%m%d")
-            file_dates.append((date_obj, f))
-        except Exception as e:
-            print(f"⚠️ 日期解析失败: {date_str} - {e}")
-            continue
-    
-    print(f"📊 成功解析日期的文件数量: {len(file_dates)}")
+    store_path = os.path.join(cluster_path, CLUSTER_STORE_DIR)
+    if ClusterStore.exists(store_path):
+        # 02 脚本写出的聚类库：按库内日序号逐日读取
+        store = ClusterStore(store_path)
+        file_dates = [
+            (datetime.strptime(store.date_string(day), "%Y%m%d"), day)
+            for day in range(len(store))
+        ]
+        load_clusters = store.dictionary
+        print(f"📊 聚类库中的天数: {len(file_dates)}")
+    else:
+        # 旧版本输出的逐日 pck 文件
+        dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
+        print(f"🔍 找到文件数量: {len(dict_files)}")
+        if not dict_files:
+            print("❌ 未找到聚类文件")
+            return
+
+        # 提取日期并排序
+        file_dates = []
+        for f in dict_files:
+            date_str = f.split("_")[-1].replace(".pck", "")
+            try:
+                date_obj = datetime.strptime(date_str, "%Y%m%d")
+                file_dates.append((date_obj, f))
+            except Exception as e:
+                print(f"⚠️ 日期解析失败: {date_str} - {e}")
+                continue
+
+        print(f"📊 成功解析日期的文件数量: {len(file_dates)}")
+
+        def load_clusters(file_dict):
+            with open(file_dict, "rb") as f:
+                return pickle.load(f)
 
     file_dates.sort(key=lambda x: x[0])
     print(f"📊 找到 {len(file_dates)} 个聚类文件")
@@ -1702,9 +3610,10 @@ def track_heatwave_clusters_and_save(
     event_id_counter = 0
 
     previous_clusters = {}
+    previous_event_ids = {}
     previous_date = None
 
-    for i, (date, file_dict) in enumerate(file_dates):
+    for i, (date, source) in enumerate(file_dates):
         if i % 100 == 0:
             print(f"处理进度: {i+1}/{len(file_dates)} - {date.strftime('%Y-%m-%d')}")
 
@@ -1718,7 +3627,9 @@ def track_heatwave_clusters_and_save(
                 previous_clusters = {}
                 previous_date = None
 
-        current_clusters = pickle.load(open(file_dict, "rb"))
+        current_clusters = load_clusters(source)
+        # 新建事件的聚类对应的事件编号（聚类记录本身不再附带额外字段）
+        current_event_ids = {}
 
         # 将当前聚类分配到热浪事件中
         for cid, info in current_clusters.items():
@@ -1728,7 +3639,7 @@ def track_heatwave_clusters_and_save(
             if previous_clusters:
                 for prev_cid, prev_info in previous_clusters.items():
                     if clusters_are_connected(info, prev_info):
-                        matched_event = prev_info.get("__event_id__")
+                        matched_event = previous_event_ids.get(prev_cid)
                         break
 
             if matched_event is not None:
@@ -1745,7 +3656,7 @@ def track_heatwave_clusters_and_save(
                     info.get("centroid", (None, None))
                 )
                 cluster_data_dictionary[matched_event]["daily_coordinates"][date] = (
-                    info.get("coordinates", [])
+                    cluster_pixel_indices(info)
                 )
             else:
                 # 创建新事件
@@ -1756,12 +3667,13 @@ def track_heatwave_clusters_and_save(
                     "total_intensity": info.get("intensity", 0),
                     "max_area": info.get("area", 0),
                     "centroid_trajectory": {date: info.get("centroid", (None, None))},
-                    "daily_coordinates": {date: info.get("coordinates", [])},
+                    "daily_coordinates": {date: cluster_pixel_indices(info)},
                 }
-                current_clusters[cid]["__event_id__"] = event_id_counter
+                current_event_ids[cid] = event_id_counter
                 event_id_counter += 1
 
         previous_clusters = current_clusters
+        previous_event_ids = current_event_ids
         previous_date = date
 
     print(f"✅ 共识别热浪事件数：{len(cluster_data_dictionary)}")
@@ -1773,3 +3685,241 @@ def track_heatwave_clusters_and_save(
         pickle.dump(cluster_data_dictionary, f, pickle.HIGHEST_PROTOCOL)
 
     print(f"✅ 热浪追踪数据保存至：{output_file}")
+
+
+# 时空连通方式："face" 只连接前一天同一格点，"full" 连接前一天 3x3 邻域内的格点
+# （与 clusters_are_connected 的相邻判断一致）
+TEMPORAL_CONNECTIVITY = ("face", "full")
+
+
+def link_consecutive_labels(
+    previous_labels, labels, periodic_bool, temporal_connectivity="full"
+):
+    """
+    找出相邻两天在时空体中相连的聚类对
+
+    Args:
+        previous_labels: 前一天的标签图 (lat, lon)，0 为背景
+        labels: 当天的标签图 (lat, lon)，0 为背景
+        periodic_bool: 经度方向是否为周期边界
+        temporal_connectivity: "face" 或 "full"（见 TEMPORAL_CONNECTIVITY）
+
+    Returns:
+        pairs: (n, 2) int64 数组，每行为相连的（前一天标签, 当天标签），已去重
+    """
+    if temporal_connectivity not in TEMPORAL_CONNECTIVITY:
+        raise ValueError(
+            f"temporal_connectivity 必须为 {TEMPORAL_CONNECTIVITY} 之一: {temporal_connectivity}"
+        )
+    offsets = (0,) if temporal_connectivity == "face" else (-1, 0, 1)
+    nlats = labels.shape[0]
+    current = labels > 0
+
+    previous_ids, current_ids = [], []
+    for dy in offsets:
+        # rows[r] 为前一天第 r - dy 行，越界的行没有邻居
+        rows = np.zeros_like(previous_labels)
+        rows[max(dy, 0) : nlats + min(dy, 0)] = previous_labels[
+            max(-dy, 0) : nlats - max(dy, 0)
+        ]
+        for dx in offsets:
+            shifted = np.roll(rows, dx, axis=1)
+            if not periodic_bool and dx != 0:
+                # 没有周期边界时，绕回到另一侧的列没有邻居
+                shifted[:, 0 if dx > 0 else -1] = 0
+            touching = current & (shifted > 0)
+            previous_ids.append(shifted[touching])
+            current_ids.append(labels[touching])
+
+    pairs = np.stack(
+        [np.concatenate(previous_ids), np.concatenate(current_ids)], axis=1
+    ).astype(np.int64)
+    return np.unique(pairs, axis=0)
+
+
+def label_season_events(
+    days,
+    lons,
+    lats,
+    res_lon,
+    res_lat,
+    periodic_bool,
+    area_threshold=0,
+    temporal_connectivity="full",
+    geometry=None,
+    exclusion=None,
+    counters=None,
+):
+    """
+    在一个暖季的 (time, lat, lon) 时空体中一次性标记热浪事件：每天按 8 邻域标记
+    温度差为正的聚类（与 02 脚本相同，并去掉面积小于 area_threshold 或质心位于排除
+    区域的聚类），再用并查集把相邻两天相连的聚类合并为同一事件。逐日流式处理，
+    只保留前一天的标签图，不需要逐日 pck 文件和成对追踪
+
+    一个事件在同一天可以包含多个聚类（分裂/合并），当天的面积、强度为这些聚类之和，
+    质心为所有格点按温度差加权的平均位置
+
+    Args:
+        days: 按时间顺序的 (date, temp_diff) 可迭代对象，temp_diff 为当天的温度差 (lat, lon)；
+            一次调用只处理一个暖季，季节之间不相连（对应 5 月 1 日的边界重置）
+        lons, lats: 经纬度一维数组
+        res_lon, res_lat: 经纬度分辨率
+        periodic_bool: 经度方向是否为周期边界
+        area_threshold: 每日聚类的最小面积（km²）
+        temporal_connectivity: "face" 或 "full"（见 TEMPORAL_CONNECTIVITY）
+        geometry: 网格几何 GridGeometry（可选，不给则由经纬度构造）
+        exclusion: ExclusionRegions，质心落在其中的聚类被筛除（默认只有撒哈拉）
+        counters: 计数字典（可选），见 prune_clusters
+
+    Returns:
+        events: 事件字典列表，按首次出现的顺序排列，字段与 track_heatwave_clusters_and_save
+            的结果相同：start, end, duration, total_intensity, max_area,
+            centroid_trajectory, daily_coordinates（每天为 (n, 2) 的紧凑格点索引数组）
+    """
+    if geometry is None:
+        geometry = GridGeometry.cached(lons, lats, res_lon, res_lat)
+    if exclusion is None:
+        exclusion = ExclusionRegions.sahara()
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    index_dtype = pixel_index_dtype((len(lats), len(lons)))
+
+    # 每个（日期, 聚类）为并查集中的一个节点，节点按日期、再按聚类标签的顺序编号，
+    # 集合的根为编号最小（最早出现）的节点
+    parent = []
+    node_date, node_stats, node_coordinates = [], [], []
+
+    def find_root(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    previous_labels = None
+    previous_first_node = 0
+    for date, temp_diff in days:
+        temp_diff = np.asarray(temp_diff, dtype=np.float64)
+        labels, cluster_count = label_clusters(temp_diff > 0, periodic_bool)
+
+        # 聚类格点（行优先顺序，按聚类分组）
+        idx_lat, idx_lon = np.where(labels > 0)
+        group = labels[idx_lat, idx_lon] - 1
+        order = np.argsort(group, kind="stable")
+        idx_lat, idx_lon, group = idx_lat[order], idx_lon[order], group[order]
+
+        # 面积优先的面积与排除区域筛选，质心权重与 find_drought_clusters 相同（1 - 温度差）
+        keep, stats, large = prune_clusters(
+            group,
+            cluster_count,
+            idx_lat,
+            idx_lon,
+            1 - temp_diff[idx_lat, idx_lon],
+            lons,
+            lats,
+            res_lon,
+            res_lat,
+            geometry,
+            area_threshold,
+            exclusion,
+            counters,
+        )
+        labels = keep_lookup_table(keep)[labels]
+        cluster_count = int(np.count_nonzero(keep))
+
+        # 保留下来的聚类的格点与强度、质心的分组求和
+        kept_pixel = keep[group]
+        group = (np.cumsum(keep) - keep)[group[kept_pixel]]
+        idx_lat, idx_lon = idx_lat[kept_pixel], idx_lon[kept_pixel]
+        weight = temp_diff[idx_lat, idx_lon]
+        area = stats["area"][keep[large]]
+        intensity = np.bincount(
+            group,
+            weights=weight * geometry.cell_area(idx_lat),
+            minlength=cluster_count,
+        )
+        bounds = np.concatenate(
+            ([0], np.cumsum(np.bincount(group, minlength=cluster_count)))
+        )
+
+        first_node = len(parent)
+        for k in range(cluster_count):
+            parent.append(first_node + k)
+            node_date.append(date)
+            members = slice(bounds[k], bounds[k + 1])
+            node_stats.append((area[k], intensity[k], weight[members]))
+            node_coordinates.append(
+                np.stack([idx_lat[members], idx_lon[members]], axis=1).astype(
+                    index_dtype
+                )
+            )
+
+        # 与前一天相连的聚类并入同一事件
+        if previous_labels is not None:
+            for previous_label, label in link_consecutive_labels(
+                previous_labels, labels, periodic_bool, temporal_connectivity
+            ).tolist():
+                root_a = find_root(previous_first_node + previous_label - 1)
+                root_b = find_root(first_node + label - 1)
+                if root_a < root_b:
+                    parent[root_b] = root_a
+                elif root_b < root_a:
+                    parent[root_a] = root_b
+
+        previous_labels = labels
+        previous_first_node = first_node
+
+    # 按事件汇总：节点按时间顺序编号，同一事件同一天的节点相邻出现
+    events = {}
+    for node in range(len(parent)):
+        root = find_root(node)
+        date = node_date[node]
+        area, intensity, weight = node_stats[node]
+        if root not in events:
+            events[root] = {"days": {}, "total_intensity": 0.0}
+        event = events[root]
+        event["total_intensity"] += float(intensity)
+        day = event["days"].setdefault(date, [0.0, [], []])
+        day[0] += area
+        day[1].append(node_coordinates[node])
+        day[2].append(weight)
+
+    event_list = []
+    for root in sorted(events):
+        days_of_event = events[root]["days"]
+        dates = list(days_of_event)
+        centroid_trajectory = {}
+        for date, day in days_of_event.items():
+            # 当天属于该事件的所有格点按温度差加权的质心
+            day[1] = np.concatenate(day[1])
+            weight = np.concatenate(day[2])
+            centroid_lon, centroid_lat = weighted_centroids(
+                np.zeros(len(weight), dtype=np.intp),
+                1,
+                day[1][:, 0],
+                day[1][:, 1],
+                weight,
+                lons,
+                lats,
+            )
+            if weight.sum() > 0:
+                centroid_trajectory[date] = (
+                    float(centroid_lon[0]),
+                    float(centroid_lat[0]),
+                )
+            else:
+                centroid_trajectory[date] = (None, None)
+        event_list.append(
+            {
+                "start": dates[0],
+                "end": dates[-1],
+                "duration": len(dates),
+                "total_intensity": events[root]["total_intensity"],
+                "max_area": float(max(day[0] for day in days_of_event.values())),
+                "centroid_trajectory": centroid_trajectory,
+                "daily_coordinates": {
+                    date: day[1] for date, day in days_of_event.items()
+                },
+            }
+        )
+
+    return event_list
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对比 netCDF4 默认的掩码数组读取（var[:]）与 hclib.read_variable 普通 ndarray 读取的各阶段耗时
+
+用法（在项目根目录运行）：
+    python utils/benchmark_loader.py
+    python utils/benchmark_loader.py --clim ./data/era5_daily_mean_201105-201109_CHINA_new.nc --days 200
+"""
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
+
+def best_time(func, repeat):
+    """运行 repeat 次，返回最短耗时（秒）与最后一次的结果"""
+    best = np.inf
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def report(stage, t_masked, t_plain):
+    print(
+        f"{stage:<28s} 掩码数组 {t_masked:8.3f}s | 普通数组 {t_plain:8.3f}s | "
+        f"加速 {t_masked / t_plain:5.2f}x"
+    )
+
+
+def benchmark_load(f, repeat):
+    """阶段 1 / 2：读取整个 T_actual"""
+    var = f.variables["T_actual"]
+    t_masked, _ = best_time(lambda: var[:], repeat)
+    t_plain, _ = best_time(lambda: hclib.read_variable(var), repeat)
+    report("读取 T_actual", t_masked, t_plain)
+
+
+def benchmark_threshold(clim_path, var_name, repeat):
+    """阶段 1：按日历日计算 90 百分位阈值表"""
+    f_clim = Dataset(clim_path)
+    var = f_clim.variables[var_name]
+    masked = var[:]
+    plain = hclib.read_variable(var)
+    f_clim.close()
+    n = masked.shape[0]
+    # 把基准期按 153 天一个暖季循环编号，只用于计时
+    day_index = (np.arange(n) % 153).astype(np.int16)
+
+    def percentile_table(data):
+        # 与 hclib.calculate_threshold_table 相同的逐日历日百分位
+        return [
+            np.percentile(data[np.where(day_index == day)[0]], 90, axis=0)
+            for day in np.unique(day_index)
+        ]
+
+    with warnings.catch_warnings():
+        # np.percentile 对掩码数组会提示 partition 忽略掩码
+        warnings.simplefilter("ignore", UserWarning)
+        t_masked, _ = best_time(lambda: percentile_table(masked), repeat)
+    t_plain, _ = best_time(lambda: percentile_table(plain), repeat)
+    report("阈值表（逐日历日百分位）", t_masked, t_plain)
+
+
+def benchmark_exceedance(f, repeat):
+    """阶段 1：实际温度与阈值表比较生成热浪掩码"""
+    doy_index = hclib.read_variable(f.variables["doy_index"], dtype=None)
+    masked = (f.variables["T_actual"][:], f.variables["T_threshold_doy"][:])
+    plain = (
+        hclib.read_variable(f.variables["T_actual"]),
+        hclib.read_variable(f.variables["T_threshold_doy"]),
+    )
+    t_masked, _ = best_time(
+        lambda: hclib.exceeds_threshold(masked[0], masked[1], doy_index), repeat
+    )
+    t_plain, _ = best_time(
+        lambda: hclib.exceeds_threshold(plain[0], plain[1], doy_index), repeat
+    )
+    report("超阈值掩码", t_masked, t_plain)
+
+
+def benchmark_cluster_input(f, n_days, repeat):
+    """阶段 2：逐日构造聚类输入（温度差、非热浪置 NaN、二值掩膜）"""
+    doy_index = hclib.read_variable(f.variables["doy_index"], dtype=None)[:n_days]
+    masked = (f.variables["T_actual"][:n_days], f.variables["T_threshold_doy"][:])
+    plain = (
+        hclib.read_variable(f.variables["T_actual"], slice(0, n_days)),
+        hclib.read_variable(f.variables["T_threshold_doy"]),
+    )
+
+    def cluster_inputs(T_actual, T_threshold_doy):
+        # 与 02_calculate_heatwave_clusters_parallel.py 中 find_clusters 的 STEP 1 相同
+        for index in range(len(doy_index)):
+            temp_diff = T_actual[index, :, :] - T_threshold_doy[doy_index[index], :, :]
+            data_for_clustering = temp_diff.astype(np.float32)
+            data_for_clustering[data_for_clustering <= 0] = np.nan
+            np.where(np.isfinite(data_for_clustering), 1.0, np.nan).astype(np.float32)
+
+    t_masked, _ = best_time(lambda: cluster_inputs(*masked), repeat)
+    t_plain, _ = best_time(lambda: cluster_inputs(*plain), repeat)
+    report(f"聚类输入构造（{len(doy_index)} 天）", t_masked, t_plain)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="掩码数组与普通数组读取路径的耗时对比")
+    parser.add_argument(
+        "--processed",
+        default="./data/processed/heatwave_processed.nc",
+        help="预处理输出文件",
+    )
+    parser.add_argument("--clim", default=None, help="气候基准期文件（不指定则跳过阈值计时）")
+    parser.add_argument("--var-name", default="t2m", help="气候基准期文件中的温度变量名")
+    parser.add_argument("--days", type=int, default=100, help="聚类输入构造计时的天数")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数（取最短）")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.processed):
+        print(f"❌ 数据文件不存在: {args.processed}")
+        return
+
+    print("=== 掩码数组 vs 普通数组 ===")
+    f = Dataset(args.processed)
+    benchmark_load(f, args.repeat)
+    if args.clim is not None:
+        benchmark_threshold(args.clim, args.var_name, args.repeat)
+    benchmark_exceedance(f, args.repeat)
+    benchmark_cluster_input(f, args.days, args.repeat)
+    f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,26 @@
 调试数据预处理结果
 """
 
+import os
+import sys
+
 import numpy as np
 from netCDF4 import Dataset, num2date
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
 def debug_heatwave_data():
     """调试热浪数据"""
     
     # 加载处理后的数据
     f = Dataset("./data/processed/heatwave_processed.nc")
-    T_actual = f.variables["T_actual"][:]
-    T_threshold = f.variables["T_threshold"][:]
-    heatwave_mask = f.variables["heatwave_mask"][:]
+    T_actual = hclib.read_variable(f.variables["T_actual"])
+    # 阈值以 (日历日, lat, lon) 表保存，按 doy_index 展开为逐日阈值
+    doy_index = hclib.read_variable(f.variables["doy_index"], dtype=None)
+    T_threshold = hclib.read_variable(f.variables["T_threshold_doy"])[doy_index]
+    heatwave_mask = hclib.read_variable(f.variables["heatwave_mask"], dtype=None)
     
     # 获取时间信息
     time_var = f.variables["time"]
@@ -4,23 +4,30 @@
 调试第二步聚类识别的时间筛选
 """
 
+import os
+import sys
+
 import numpy as np
 from netCDF4 import Dataset, num2date
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
 def debug_step2_timing():
     """调试第二步的时间筛选逻辑"""
     
     # 加载处理后的数据
     f = Dataset("./data/processed/heatwave_processed.nc")
-    T_actual = f.variables["T_actual"][:]
-    heatwave_mask = f.variables["heatwave_mask"][:]
+    T_actual = hclib.read_variable(f.variables["T_actual"])
+    heatwave_mask = hclib.read_variable(f.variables["heatwave_mask"], dtype=None)
     
     # 获取时间信息
     time_var = f.variables["time"]
     time_units = time_var.units
     time_calendar = time_var.calendar if hasattr(time_var, "calendar") else "standard"
     actual_dates = num2date(time_var[:], units=time_units, calendar=time_calendar)
+    date_index = hclib.read_time_axis(time_var)
     f.close()
     
     print(f"=== 原始数据信息 ===")
@@ -40,13 +47,7 @@ def debug_step2_timing():
     print(f"结束日期: {end_date}")
     
     # 筛选出目标时间段的数据
-    time_mask = []
-    for i, date in enumerate(actual_dates):
-        if (date.year >= start_year and date.year <= end_year and 
-            date.month >= 5 and date.month <= 9):
-            time_mask.append(i)
-    
-    time_mask = np.array(time_mask)
+    time_mask = np.where(hclib.season_mask(date_index, start_year, end_year))[0]
     print(f"\n=== 筛选结果 ===")
     print(f"筛选出的天数: {len(time_mask)}")
     print(f"筛选出的日期范围: {actual_dates[time_mask[0]]} 到 {actual_dates[time_mask[-1]]}")
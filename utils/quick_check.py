@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-快速检查pck文件的基本信息
+快速检查聚类结果（聚类库或pck文件）的基本信息
 """
 
 import os
-import pickle
 import glob
+import sys
 from datetime import datetime
 
+# 聚类字典中的 ClusterRecord 由 heatwave_clusters_utils 定义，反序列化时需要能导入 src 下的模块
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
 def quick_check():
     cluster_path = "./clusters_output/ERA5/China/heatwave/90p"
     
@@ -16,24 +20,30 @@ def quick_check():
         print(f"❌ 路径不存在: {cluster_path}")
         return
     
-    # 检查文件数量
-    mask_files = glob.glob(f"{cluster_path}/heatwave-mask_*.pck")
-    dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
-    count_files = glob.glob(f"{cluster_path}/heatwave-count_*.pck")
-    
-    print(f"📁 文件统计:")
-    print(f"  Mask文件: {len(mask_files)}")
-    print(f"  Dictionary文件: {len(dict_files)}")
-    print(f"  Count文件: {len(count_files)}")
-    
-    if len(mask_files) == 0:
-        print("❌ 没有找到任何pck文件")
+    # 检查文件数量：02 脚本的聚类库，或旧版本的逐日 pck 文件
+    output = hclib.open_cluster_output(cluster_path)
+    if isinstance(output, hclib.ClusterStore):
+        print(f"📁 聚类库: {output.path}")
+        print(f"  天数: {len(output)}")
+        print(f"  聚类总数: {len(output.table['day'])}")
+    else:
+        mask_files = glob.glob(f"{cluster_path}/heatwave-mask_*.pck")
+        dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
+        count_files = glob.glob(f"{cluster_path}/heatwave-count_*.pck")
+
+        print(f"📁 文件统计:")
+        print(f"  Mask文件: {len(mask_files)}")
+        print(f"  Dictionary文件: {len(dict_files)}")
+        print(f"  Count文件: {len(count_files)}")
+
+    date_strings = output.date_strings()
+    if len(date_strings) == 0:
+        print("❌ 没有找到任何聚类结果")
         return
     
     # 检查日期范围
     dates = []
-    for f in mask_files:
-        date_str = f.split('_')[-1].replace('.pck', '')
+    for date_str in date_strings:
         try:
             date_obj = datetime.strptime(date_str, '%Y%m%d')
             dates.append((date_str, date_obj))
@@ -50,25 +60,13 @@ def quick_check():
     for i in sample_indices:
         if i < len(dates):
             date_str = dates[i][0]
-            check_sample(cluster_path, date_str)
+            check_sample(output, date_str)
 
-def check_sample(cluster_path, date_str):
+def check_sample(output, date_str):
     """检查单个样本"""
     try:
-        # 检查mask
-        mask_file = f"{cluster_path}/heatwave-mask_{date_str}.pck"
-        with open(mask_file, 'rb') as f:
-            mask = pickle.load(f)
-        
-        # 检查dictionary
-        dict_file = f"{cluster_path}/heatwave-dictionary_{date_str}.pck"
-        with open(dict_file, 'rb') as f:
-            cluster_dict = pickle.load(f)
-        
-        # 检查count
-        count_file = f"{cluster_path}/heatwave-count_{date_str}.pck"
-        with open(count_file, 'rb') as f:
-            count = pickle.load(f)
+        # 检查mask、dictionary与count（聚类库只映射这一天）
+        mask, cluster_dict, count = output.load_day(date_str)
         
         print(f"  {date_str}: 形状{mask.shape}, 热浪格点{np.sum(mask > 0)}, 聚类{len(cluster_dict)}, 计数{count}")
         
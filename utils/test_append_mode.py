@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试预处理的追加模式（01_data_preprocessing.py --mode append）
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+
+import numpy as np
+from netCDF4 import Dataset
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+# 脚本文件名以数字开头，不能直接 import
+spec = importlib.util.spec_from_file_location(
+    "data_preprocessing", os.path.join(SRC_DIR, "01_data_preprocessing.py")
+)
+preprocessing = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(preprocessing)
+
+STORAGE = {"chunking": "map", "complevel": 1, "shuffle": True}
+
+
+def write_temperature(path, days, temperature):
+    """写一个逐日温度文件，days 为相对 2011-05-01 的天数"""
+    nt, nlats, nlons = temperature.shape
+    f = Dataset(path, "w")
+    f.createDimension("time", None)
+    f.createDimension("lat", nlats)
+    f.createDimension("lon", nlons)
+    time_var = f.createVariable("time", "f8", ("time",))
+    time_var.units = "days since 2011-05-01 00:00:00"
+    time_var.calendar = "standard"
+    time_var[:] = days
+    f.createVariable("lat", "f4", ("lat",))[:] = np.linspace(20, 40, nlats)
+    f.createVariable("lon", "f4", ("lon",))[:] = np.linspace(80, 120, nlons)
+    f.createVariable(preprocessing.var_name, "f4", ("time", "lat", "lon"))[
+        :
+    ] = temperature
+    f.close()
+
+
+def read_output(path):
+    with Dataset(path) as f:
+        return {
+            name: np.asarray(f.variables[name][:])
+            for name in (
+                "time",
+                "doy_index",
+                "T_actual",
+                "heatwave_mask",
+                "hot_run_length",
+            )
+        }
+
+
+def prepare(workdir):
+    """气候基准期与 60 天的实际温度，部分格点的热浪跨越追加边界（第 40、41、50 天）"""
+    rng = np.random.RandomState(0)
+    preprocessing.clim_path = os.path.join(workdir, "clim.nc")
+    preprocessing.threshold_cache_dir = os.path.join(workdir, "threshold_cache")
+    days = np.arange(60)
+    clim = np.concatenate([rng.rand(60, 4, 5) + year for year in range(3)]).astype(
+        np.float32
+    )
+    write_temperature(
+        preprocessing.clim_path,
+        np.concatenate([days + 365 * year for year in range(3)]),
+        clim,
+    )
+    temperature = rng.rand(60, 4, 5) * 3.5
+    temperature[38:43, :2] = 5
+    temperature[48:53, 2:, :3] = 5
+    return days, temperature.astype(np.float32)
+
+
+def run_full(workdir, name, days, temperature):
+    preprocessing.temp_path = os.path.join(workdir, f"{name}.nc")
+    preprocessing.output_path = os.path.join(workdir, f"{name}_processed.nc")
+    write_temperature(preprocessing.temp_path, days, temperature)
+    preprocessing.run_full(0, False, STORAGE)
+    return preprocessing.output_path
+
+
+def test_append_matches_full():
+    """先处理前 40 天再逐段追加，与一次处理全部 60 天的结果相同"""
+
+    print("\n=== 追加模式与整体重算对比 ===")
+    with tempfile.TemporaryDirectory() as workdir:
+        days, temperature = prepare(workdir)
+        expected = read_output(run_full(workdir, "full", days, temperature))
+
+        appended = run_full(workdir, "part", days[:40], temperature[:40])
+        for stop in (41, 50, 60):
+            source = os.path.join(workdir, f"source_{stop}.nc")
+            write_temperature(source, days[:stop], temperature[:stop])
+            preprocessing.run_append(source, 0, False)
+        result = read_output(appended)
+
+        for name, values in expected.items():
+            same = np.array_equal(result[name], values)
+            print(f"{name}: {'一致' if same else '❌ 不一致'}")
+            assert same, f"追加结果的 {name} 与整体重算不一致"
+        assert expected["heatwave_mask"][38:43, :2].all()
+        assert expected["heatwave_mask"][48:53, 2:, :3].all()
+
+
+def test_append_rejects_gap():
+    """新日期与输出文件最后一天之间缺少日期时拒绝追加，输出文件不变"""
+
+    print("\n=== 缺少日期时拒绝追加 ===")
+    with tempfile.TemporaryDirectory() as workdir:
+        days, temperature = prepare(workdir)
+        output = run_full(workdir, "part", days[:40], temperature[:40])
+        before = read_output(output)
+
+        # 第 41 天（下标 40）缺失
+        source = os.path.join(workdir, "gapped.nc")
+        keep = np.r_[0:40, 41:60]
+        write_temperature(source, days[keep], temperature[keep])
+        try:
+            preprocessing.run_append(source, 0, False)
+        except ValueError as error:
+            print(f"已拒绝: {error}")
+        else:
+            raise AssertionError("缺少日期的追加没有被拒绝")
+
+        after = read_output(output)
+        for name, values in before.items():
+            assert np.array_equal(after[name], values), f"拒绝追加后 {name} 被修改"
+
+
+if __name__ == "__main__":
+    test_append_matches_full()
+    test_append_rejects_gap()
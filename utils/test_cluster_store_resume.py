@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试聚类库的断点续算（02_calculate_heatwave_clusters_parallel.py --resume）：
+中断后续算只计算缺失的日期，结果与不中断的运行相同；配置改变后清单失效
+"""
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
+LONS = np.arange(80, 95.01, 1.0)
+LATS = np.arange(20, 32.01, 1.0)
+DATES = [20110501 + day for day in range(20)]
+BATCH_DAYS = 3
+
+
+def make_temp_diff():
+    rng = np.random.RandomState(0)
+    return (rng.rand(len(DATES), len(LATS), len(LONS)) - 0.6).astype(np.float32)
+
+
+def run_stage(path, temp_diff, config_hash, resume=False, crash_after=None):
+    """
+    与 02 脚本相同的写入流程：打开聚类库，只为待算的日期分批（乱序，模拟动态调度），
+    逐批聚类并写入。crash_after 批之后直接返回、不调用 close()，模拟进程被杀掉
+
+    Returns:
+        computed: 本次计算的日序号
+    """
+    writer = hclib.ClusterStoreWriter(
+        path, DATES, (len(LATS), len(LONS)), config_hash, resume
+    )
+    pending = writer.pending_days()
+    batches = [
+        pending[start : start + BATCH_DAYS]
+        for start in range(0, len(pending), BATCH_DAYS)
+    ][::-1]
+    computed = []
+    for count, block in enumerate(batches):
+        if crash_after is not None and count == crash_after:
+            return computed
+        labels, table = hclib.cluster_day_block(
+            temp_diff[block], LONS, LATS, 1.0, 1.0, False
+        )
+        writer.write_block(block, labels, table)
+        computed.extend(block.tolist())
+    writer.close()
+    return computed
+
+
+def read_store(path):
+    """聚类库中除清单与批次文件之外的全部数组"""
+    return {
+        name: np.load(os.path.join(path, name))
+        for name in sorted(os.listdir(path))
+        if name.endswith(".npy")
+    }
+
+
+def assert_same_store(result, expected):
+    assert sorted(result) == sorted(expected), "聚类库的文件不同"
+    for name, values in expected.items():
+        same = np.array_equal(result[name], values)
+        print(f"{name}: {'一致' if same else '❌ 不一致'}")
+        assert same, f"{name} 与不中断的运行不一致"
+
+
+def test_resume_after_crash():
+    """中断后续算只计算缺失的日期，最终结果与不中断的运行相同"""
+
+    print("\n=== 中断后续算 ===")
+    temp_diff = make_temp_diff()
+    with tempfile.TemporaryDirectory() as workdir:
+        reference = os.path.join(workdir, "reference")
+        run_stage(reference, temp_diff, "config")
+        expected = read_store(reference)
+
+        store = os.path.join(workdir, "resumed")
+        done = run_stage(store, temp_diff, "config", crash_after=3)
+        assert not hclib.ClusterStore.exists(store)
+
+        # 被杀掉时正在写的一批：标签已部分写入但尚未记入清单
+        torn = sorted(set(range(len(DATES))) - set(done))[:BATCH_DAYS]
+        labels = np.load(os.path.join(store, "labels.npy"), mmap_mode="r+")
+        labels[torn] = 99
+        labels.flush()
+        del labels
+
+        computed = run_stage(store, temp_diff, "config", resume=True)
+        print(f"中断前完成 {len(done)} 天，续算 {len(computed)} 天")
+        assert sorted(computed) == sorted(set(range(len(DATES))) - set(done))
+        assert hclib.ClusterStore.exists(store)
+        assert_same_store(read_store(store), expected)
+
+        # 已写完的聚类库续算时不再计算任何日期，结果不变
+        assert run_stage(store, temp_diff, "config", resume=True) == []
+        assert_same_store(read_store(store), expected)
+
+
+def test_config_change_invalidates_manifest():
+    """配置哈希改变后清单中的日期全部失效，续算重新计算全部日期"""
+
+    print("\n=== 配置改变 ===")
+    temp_diff = make_temp_diff()
+    with tempfile.TemporaryDirectory() as workdir:
+        store = os.path.join(workdir, "store")
+        run_stage(store, temp_diff, "config")
+
+        # 输入文件或聚类设置改变时配置哈希随之改变
+        input_path = os.path.join(workdir, "input.nc")
+        with open(input_path, "wb") as f:
+            f.write(b"heatwave")
+        settings = {"minimum_area_threshold": 100}
+        key = hclib.cluster_config_hash(input_path, settings)
+        assert key == hclib.cluster_config_hash(input_path, dict(settings))
+        assert key != hclib.cluster_config_hash(
+            input_path, {"minimum_area_threshold": 200}
+        )
+        os.utime(input_path, ns=(0, 0))
+        assert key != hclib.cluster_config_hash(input_path, settings)
+
+        # 新的输入使用新的配置：不能沿用任何日期
+        changed = temp_diff + 0.2
+        computed = run_stage(store, changed, "changed-config", resume=True)
+        print(f"配置改变后重新计算 {len(computed)} 天")
+        assert sorted(computed) == list(range(len(DATES)))
+
+        reference = os.path.join(workdir, "reference")
+        run_stage(reference, changed, "changed-config")
+        assert_same_store(read_store(store), read_store(reference))
+
+
+if __name__ == "__main__":
+    test_resume_after_crash()
+    test_config_change_invalidates_manifest()
@@ -4,8 +4,14 @@
 测试连续3天筛选功能
 """
 
+import os
+import sys
+
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
 def find_consecutive_periods(time_series, min_length):
     """
     找到时间序列中连续1的段落，长度至少为min_length
@@ -66,5 +72,46 @@ def test_consecutive_filter():
     
     print(f"\n✅ 连续3天筛选功能测试完成")
 
+def periods_to_mask(time_series, min_length):
+    """把 find_consecutive_periods 的结果展开为掩码"""
+    mask = np.zeros(len(time_series), dtype=np.uint8)
+    for start, end in find_consecutive_periods(time_series, min_length):
+        mask[start : end + 1] = 1
+    return mask
+
+def test_vectorized_filter():
+    """对比 hclib.consecutive_days_filter 与逐格点扫描的结果"""
+
+    print(f"\n=== 向量化筛选一致性检查 ===")
+    min_length = 3
+
+    # 固定测试用例（与 test_consecutive_filter 相同）
+    test_cases = [
+        np.array([0, 1, 1, 1, 0, 1, 1, 0, 1, 1, 1, 1, 0]),
+        np.array([0, 1, 1, 0, 1, 0, 1, 1, 0]),
+        np.array([1, 1, 1, 0, 0, 1, 1, 1, 1, 1]),
+        np.array([1, 1, 1, 1, 1]),
+        np.array([0, 0, 0, 0, 0]),
+    ]
+    for i, case in enumerate(test_cases):
+        vectorized = hclib.consecutive_days_filter(case[:, None, None], min_length)
+        same = np.array_equal(vectorized[:, 0, 0], periods_to_mask(case, min_length))
+        print(f"测试用例{i + 1}: {'一致' if same else '❌ 不一致'}")
+        assert same, f"测试用例{i + 1} 与逐格点扫描不一致"
+
+    # 随机三维掩码（纬度行数不是分块大小的整数倍，覆盖分块边界）
+    rng = np.random.RandomState(0)
+    cube = (rng.rand(200, 37, 11) < 0.6).astype(np.uint8)
+    vectorized = hclib.consecutive_days_filter(cube, min_length, lat_chunk_size=8)
+    mismatches = 0
+    for lat_idx in range(cube.shape[1]):
+        for lon_idx in range(cube.shape[2]):
+            expected = periods_to_mask(cube[:, lat_idx, lon_idx], min_length)
+            if not np.array_equal(vectorized[:, lat_idx, lon_idx], expected):
+                mismatches += 1
+    print(f"随机掩码 {cube.shape}: 不一致格点数 {mismatches}")
+    assert mismatches == 0, f"随机掩码有 {mismatches} 个格点与逐格点扫描不一致"
+
 if __name__ == "__main__":
     test_consecutive_filter()
+    test_vectorized_filter()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试聚类加权质心（hclib.weighted_centroids）
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
+
+def grouped_pixels(labels):
+    """把标签图展开为按聚类分组、组内行优先的格点（与 prune_clusters 的输入相同）"""
+    rows, cols = np.nonzero(labels)
+    group = labels[rows, cols] - 1
+    order = np.argsort(group, kind="stable")
+    return group[order], rows[order], cols[order]
+
+
+def test_negative_weights():
+    """权重为 1 - 温度差（超过 1 K 时为负）时，区域网格上的质心仍在聚类内"""
+
+    print("\n=== 负权重质心 ===")
+
+    lons = np.arange(70, 140.01, 0.5)
+    lats = np.arange(20, 50.01, 0.5)
+    temp_diff = np.full((len(lats), len(lons)), np.nan)
+    rows = (lats >= 30) & (lats <= 35)
+    cols = (lons >= 95) & (lons <= 105)
+    temp_diff[np.ix_(rows, cols)] = 3.0
+
+    labels, cluster_count = hclib.label_clusters(np.isfinite(temp_diff), False)
+    stats = hclib.cluster_statistics(
+        labels, cluster_count, 1 - temp_diff, lons, lats, 0.5, 0.5
+    )
+    print(f"质心: ({stats['centroid_lon'][0]:.2f}, {stats['centroid_lat'][0]:.2f})")
+    assert np.isclose(stats["centroid_lon"][0], 100)
+    assert np.isclose(stats["centroid_lat"][0], 32.5)
+
+    # 排除区域筛选按正确的质心进行
+    group, idx_lat, idx_lon = grouped_pixels(labels)
+    geometry = hclib.GridGeometry.cached(lons, lats, 0.5, 0.5)
+    for box, expected in (((95, 105, 20, 50), False), ((275, 280, 20, 50), True)):
+        keep, _, _ = hclib.prune_clusters(
+            group,
+            cluster_count,
+            idx_lat,
+            idx_lon,
+            1 - temp_diff[idx_lat, idx_lon],
+            lons,
+            lats,
+            0.5,
+            0.5,
+            geometry,
+            exclusion=hclib.ExclusionRegions(boxes=[box]),
+        )
+        print(f"排除区域 {box}: {'保留' if keep[0] else '筛除'}")
+        assert keep[0] == expected
+
+
+def test_matches_find_weighed_centroid():
+    """与逐聚类的 find_weighed_centroid 对比（区域网格与跨越日期变更线的全球网格，正负权重）"""
+
+    print("\n=== 与 find_weighed_centroid 对比 ===")
+
+    rng = np.random.RandomState(0)
+    grids = (
+        (np.arange(70, 140.01, 0.5), np.arange(20, 50.01, 0.5), False),
+        (np.arange(-180, 180, 5.0), np.arange(-60, 60.01, 5.0), True),
+    )
+    for lons, lats, periodic in grids:
+        for offset in (0.0, 1.0):
+            mask = rng.rand(len(lats), len(lons)) < 0.3
+            labels, cluster_count = hclib.label_clusters(mask, periodic)
+            weights = 1 - (rng.rand(len(lats), len(lons)) * 4 - offset)
+            group, idx_lat, idx_lon = grouped_pixels(labels)
+            centroid_lon, centroid_lat = hclib.weighted_centroids(
+                group,
+                cluster_count,
+                idx_lat,
+                idx_lon,
+                weights[idx_lat, idx_lon],
+                lons,
+                lats,
+            )
+
+            mismatches = 0
+            for k in range(cluster_count):
+                pixels = group == k
+                w = weights[idx_lat[pixels], idx_lon[pixels]]
+                if abs(w.sum()) < 1e-9:
+                    continue
+                lat, lon = hclib.find_weighed_centroid(
+                    lats[idx_lat[pixels]], lons[idx_lon[pixels]], w, lons, lats
+                )
+                lon_error = abs((centroid_lon[k] - lon + 180) % 360 - 180)
+                if not (np.isclose(centroid_lat[k], lat) and lon_error < 1e-6):
+                    mismatches += 1
+            print(f"网格 {len(lats)}×{len(lons)}，{cluster_count} 个聚类: 不一致 {mismatches}")
+            assert mismatches == 0
+
+
+if __name__ == "__main__":
+    test_negative_weights()
+    test_matches_find_weighed_centroid()
@@ -10,6 +10,10 @@ from netCDF4 import Dataset
 import matplotlib.pyplot as plt
 from datetime import datetime
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
 
 def verify_consecutive_filter():
     """验证连续3天筛选的效果"""
@@ -23,7 +27,7 @@ def verify_consecutive_filter():
         return
     
     f = Dataset(data_path)
-    heatwave_mask = f.variables["heatwave_mask"][:]
+    heatwave_mask = hclib.read_variable(f.variables["heatwave_mask"], dtype=None)
     time_var = f.variables["time"]
     lats = f.variables["lat"][:]
     lons = f.variables["lon"][:]
@@ -32,6 +36,7 @@ def verify_consecutive_filter():
     from netCDF4 import num2date
     actual_dates = num2date(time_var[:], units=time_var.units, 
                            calendar=getattr(time_var, "calendar", "standard"))
+    date_index = hclib.read_time_axis(time_var)
     f.close()
     
     print(f"数据形状: {heatwave_mask.shape}")
@@ -58,7 +63,7 @@ def verify_consecutive_filter():
     
     # 4. 检查特定时间段的热浪模式
     print(f"\n=== 夏季热浪模式检查 ===")
-    check_summer_patterns(heatwave_mask, actual_dates)
+    check_summer_patterns(heatwave_mask, actual_dates, date_index)
     
     # 5. 可视化结果
     visualize_consecutive_filter_results(heatwave_mask, actual_dates, lats, lons)
@@ -122,16 +127,13 @@ def find_consecutive_periods(time_series, min_length):
     
     return periods
 
-def check_summer_patterns(mask, dates):
+def check_summer_patterns(mask, dates, date_index):
     """检查夏季热浪模式"""
     
     # 筛选夏季数据 (6-8月)
-    summer_indices = []
-    for i, date in enumerate(dates):
-        if date.month in [6, 7, 8]:
-            summer_indices.append(i)
+    summer_indices = np.where(np.isin(date_index["month"], [6, 7, 8]))[0]
     
-    if summer_indices:
+    if len(summer_indices) > 0:
         summer_mask = mask[summer_indices]
         summer_dates = [dates[i] for i in summer_indices]
         
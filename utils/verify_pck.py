@@ -1,36 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-验证pck文件正确性的脚本
+验证聚类结果（聚类库或pck文件）正确性的脚本
 """
 
 import os
-import pickle
+import sys
 import numpy as np
 from datetime import datetime
 import glob
 
-def verify_pck_files(cluster_path):
-    """验证pck文件的基本信息"""
-    
-    # 获取所有pck文件
-    mask_files = glob.glob(f"{cluster_path}/heatwave-mask_*.pck")
-    dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
-    count_files = glob.glob(f"{cluster_path}/heatwave-count_*.pck")
-    
-    print(f"=== 文件统计 ===")
-    print(f"Mask文件数量: {len(mask_files)}")
-    print(f"Dictionary文件数量: {len(dict_files)}")
-    print(f"Count文件数量: {len(count_files)}")
+# 聚类字典中的 ClusterRecord 由 heatwave_clusters_utils 定义，反序列化时需要能导入 src 下的模块
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
+
+def verify_pck_files(output):
+    """验证聚类结果的基本信息"""
+    
+    if isinstance(output, hclib.ClusterStore):
+        print(f"=== 聚类库统计 ===")
+        print(f"聚类库: {output.path}")
+        print(f"标签立方体形状: {output.labels.shape}")
+        print(f"聚类总数: {len(output.table['day'])}")
+        print(f"格点索引总数: {len(output.pixel_rows)}")
+    else:
+        # 获取所有pck文件
+        mask_files = glob.glob(f"{output.path}/heatwave-mask_*.pck")
+        dict_files = glob.glob(f"{output.path}/heatwave-dictionary_*.pck")
+        count_files = glob.glob(f"{output.path}/heatwave-count_*.pck")
+
+        print(f"=== 文件统计 ===")
+        print(f"Mask文件数量: {len(mask_files)}")
+        print(f"Dictionary文件数量: {len(dict_files)}")
+        print(f"Count文件数量: {len(count_files)}")
     
     # 检查文件完整性
     print(f"\n=== 文件完整性检查 ===")
-    dates = []
-    for f in mask_files:
-        date_str = f.split('_')[-1].replace('.pck', '')
-        dates.append(date_str)
-    
-    dates.sort()
+    dates = output.date_strings()
     print(f"日期范围: {dates[0]} 到 {dates[-1]}")
     print(f"总天数: {len(dates)}")
     
@@ -41,47 +47,39 @@ def verify_pck_files(cluster_path):
     for date_str in sample_files:
         print(f"\n--- 检查 {date_str} ---")
         
-        # 检查mask文件
-        mask_file = f"{cluster_path}/heatwave-mask_{date_str}.pck"
-        if os.path.exists(mask_file):
-            with open(mask_file, 'rb') as f:
-                mask = pickle.load(f)
-            print(f"  Mask形状: {mask.shape}, 类型: {mask.dtype}")
-            print(f"  热浪格点数: {np.sum(mask > 0)}")
-            print(f"  总格点数: {mask.size}")
-            print(f"  热浪比例: {np.sum(mask > 0) / mask.size * 100:.2f}%")
+        try:
+            mask, cluster_dict, count = output.load_day(date_str)
+        except (OSError, KeyError) as e:
+            print(f"  ❌ 读取失败: {e}")
+            continue
+
+        # 检查mask
+        print(f"  Mask形状: {mask.shape}, 类型: {mask.dtype}")
+        print(f"  热浪格点数: {np.sum(mask > 0)}")
+        print(f"  总格点数: {mask.size}")
+        print(f"  热浪比例: {np.sum(mask > 0) / mask.size * 100:.2f}%")
         
-        # 检查dictionary文件
-        dict_file = f"{cluster_path}/heatwave-dictionary_{date_str}.pck"
-        if os.path.exists(dict_file):
-            with open(dict_file, 'rb') as f:
-                cluster_dict = pickle.load(f)
-            print(f"  聚类数量: {len(cluster_dict)}")
-            
-            if len(cluster_dict) > 0:
-                # 显示第一个聚类的信息
-                first_cluster = cluster_dict[1]
-                print(f"  第一个聚类:")
-                print(f"    面积: {first_cluster.get('area', 'N/A')} km²")
-                print(f"    强度: {first_cluster.get('intensity', 'N/A')}")
-                print(f"    质心: {first_cluster.get('centroid', 'N/A')}")
-                print(f"    格点数: {len(first_cluster.get('coordinates', []))}")
+        # 检查dictionary
+        print(f"  聚类数量: {len(cluster_dict)}")
         
-        # 检查count文件
-        count_file = f"{cluster_path}/heatwave-count_{date_str}.pck"
-        if os.path.exists(count_file):
-            with open(count_file, 'rb') as f:
-                count = pickle.load(f)
-            print(f"  聚类计数: {count}")
+        if len(cluster_dict) > 0:
+            # 显示第一个聚类的信息
+            first_cluster = cluster_dict[1]
+            print(f"  第一个聚类:")
+            print(f"    面积: {first_cluster.get('area', 'N/A')} km²")
+            print(f"    强度: {first_cluster.get('intensity', 'N/A')}")
+            print(f"    质心: {first_cluster.get('centroid', 'N/A')}")
+            print(f"    格点数: {len(first_cluster.get('coordinates', []))}")
+        
+        # 检查count
+        print(f"  聚类计数: {count}")
 
-def check_date_consistency(cluster_path):
+def check_date_consistency(output):
     """检查日期一致性"""
     print(f"\n=== 日期一致性检查 ===")
     
-    mask_files = glob.glob(f"{cluster_path}/heatwave-mask_*.pck")
     dates = []
-    for f in mask_files:
-        date_str = f.split('_')[-1].replace('.pck', '')
+    for date_str in output.date_strings():
         try:
             date_obj = datetime.strptime(date_str, '%Y%m%d')
             dates.append((date_str, date_obj))
@@ -112,29 +110,34 @@ def check_date_consistency(cluster_path):
     else:
         print(f"  日期连续性: 正常")
 
-def check_cluster_quality(cluster_path):
+def check_cluster_quality(output):
     """检查聚类质量"""
     print(f"\n=== 聚类质量检查 ===")
     
-    dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
-    
     total_clusters = 0
     total_days = 0
     cluster_areas = []
     cluster_intensities = []
     
-    for dict_file in dict_files:
-        with open(dict_file, 'rb') as f:
-            cluster_dict = pickle.load(f)
-        
-        total_days += 1
-        total_clusters += len(cluster_dict)
-        
-        for cluster_id, cluster_info in cluster_dict.items():
-            if 'area' in cluster_info:
-                cluster_areas.append(cluster_info['area'])
-            if 'intensity' in cluster_info:
-                cluster_intensities.append(cluster_info['intensity'])
+    if isinstance(output, hclib.ClusterStore):
+        # 聚类库直接读取列式聚类表，不逐日构造字典
+        total_days = len(output)
+        total_clusters = len(output.table['day'])
+        cluster_areas = list(output.table['area'])
+        cluster_intensities = list(output.table['intensity'])
+    
+    else:
+        for date_str in output.date_strings():
+            _, cluster_dict, _ = output.load_day(date_str)
+
+            total_days += 1
+            total_clusters += len(cluster_dict)
+
+            for cluster_id, cluster_info in cluster_dict.items():
+                if 'area' in cluster_info:
+                    cluster_areas.append(cluster_info['area'])
+                if 'intensity' in cluster_info:
+                    cluster_intensities.append(cluster_info['intensity'])
     
     print(f"  总处理天数: {total_days}")
     print(f"  总聚类数: {total_clusters}")
@@ -160,8 +163,9 @@ if __name__ == "__main__":
         print(f"错误: 路径不存在 {cluster_path}")
         exit(1)
     
-    verify_pck_files(cluster_path)
-    check_date_consistency(cluster_path)
-    check_cluster_quality(cluster_path)
+    output = hclib.open_cluster_output(cluster_path)
+    verify_pck_files(output)
+    check_date_consistency(output)
+    check_cluster_quality(output)
     
     print(f"\n=== 验证完成 ===")
@@ -5,23 +5,18 @@
 """
 
 import os
-import pickle
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
-import glob
+
+# 聚类字典中的 ClusterRecord 由 heatwave_clusters_utils 定义，反序列化时需要能导入 src 下的模块
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import heatwave_clusters_utils as hclib
 
 def load_sample_data(cluster_path, date_str):
-    """加载指定日期的数据"""
-    mask_file = f"{cluster_path}/heatwave-mask_{date_str}.pck"
-    dict_file = f"{cluster_path}/heatwave-dictionary_{date_str}.pck"
-    
-    with open(mask_file, 'rb') as f:
-        mask = pickle.load(f)
-    
-    with open(dict_file, 'rb') as f:
-        cluster_dict = pickle.load(f)
-    
+    """加载指定日期的数据（聚类库或pck文件）"""
+    mask, cluster_dict, _ = hclib.open_cluster_output(cluster_path).load_day(date_str)
     return mask, cluster_dict
 
 def visualize_heatwave_map(cluster_path, date_str, save_path=None):
@@ -62,21 +57,19 @@ def visualize_heatwave_map(cluster_path, date_str, save_path=None):
 def plot_cluster_statistics(cluster_path, save_path=None):
     """绘制聚类统计图表"""
     
-    dict_files = glob.glob(f"{cluster_path}/heatwave-dictionary_*.pck")
+    output = hclib.open_cluster_output(cluster_path)
     
     dates = []
     cluster_counts = []
     total_areas = []
     max_intensities = []
     
-    for dict_file in sorted(dict_files):
-        date_str = dict_file.split('_')[-1].replace('.pck', '')
+    for date_str in output.date_strings():
         try:
             date_obj = datetime.strptime(date_str, '%Y%m%d')
             dates.append(date_obj)
             
-            with open(dict_file, 'rb') as f:
-                cluster_dict = pickle.load(f)
+            _, cluster_dict, _ = output.load_day(date_str)
             
             cluster_counts.append(len(cluster_dict))
             
@@ -90,7 +83,7 @@ def plot_cluster_statistics(cluster_path, save_path=None):
                 max_intensities.append(0)
                 
         except Exception as e:
-            print(f"处理文件 {dict_file} 时出错: {e}")
+            print(f"处理日期 {date_str} 时出错: {e}")
     
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(15, 10))
     
@@ -163,8 +156,8 @@ if __name__ == "__main__":
         exit(1)
     
     # 获取一些样本日期
-    mask_files = glob.glob(f"{cluster_path}/heatwave-mask_*.pck")
-    sample_dates = [f.split('_')[-1].replace('.pck', '') for f in mask_files[::len(mask_files)//5]]
+    all_dates = hclib.open_cluster_output(cluster_path).date_strings()
+    sample_dates = all_dates[::len(all_dates)//5]
     
     print("=== 样本日期检查 ===")
     for date_str in sample_dates[:3]:  # 检查前3个样本